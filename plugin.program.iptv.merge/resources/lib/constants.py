@@ -4,6 +4,9 @@ IPTV_SIMPLE_ID = 'pvr.iptvsimple'
 METHOD_PLAYLIST = 'playlist'
 METHOD_EPG = 'epg'
 
+CACHE_MAX_AGE = 60*60*24*7 # 7 days
+INSERT_BATCH_SIZE = 1000
+
 RUN_MERGE_URL = 'run_merge'
 DEFAULT_HTTP_PORT = 8096
 
@@ -1,5 +1,8 @@
-import shutil
+import os
+import re
+import zlib
 import threading
+from email.utils import formatdate, parsedate_tz, mktime_tz
 
 from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 from six.moves.socketserver import ThreadingMixIn
@@ -9,25 +12,57 @@ from slyguy.constants import CHUNK_SIZE
 from slyguy.util import check_port
 
 from .settings import settings
-from .constants import DEFAULT_HTTP_PORT, PLAYLIST_FILE_NAME, RUN_MERGE_URL
-from .merger import Merger, restart_pvr
+from .constants import DEFAULT_HTTP_PORT, PLAYLIST_FILE_NAME, EPG_FILE_NAME, RUN_MERGE_URL
+from .merger import Merger, restart_pvr, local_paths, epg_file_name, merge_due
 
 
 FORCE_LOCK = threading.Lock()
 MERGE_LOCK = threading.Lock()
 
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def _background_merge():
+    # merges (if required) without blocking the request that triggered it
+    # the merger swaps in its output files atomically once complete
+    # the lock is taken here so polling clients don't start a thread per request
+    if not merge_due() or not MERGE_LOCK.acquire(False):
+        return
+
+    def run():
+        try:
+            Merger().merge(force=False)
+        except Exception as e:
+            log.exception(e)
+        finally:
+            MERGE_LOCK.release()
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    try:
+        thread.start()
+    except:
+        MERGE_LOCK.release()
+        raise
+
 
 class RequestHandler(BaseHTTPRequestHandler):
     def setup(self):
         BaseHTTPRequestHandler.setup(self)
         self.request.settimeout(5)
 
+    def do_HEAD(self):
+        self._handle(head=True)
+
     def do_GET(self):
-        path = self.path.lstrip('/').strip('\\')
+        self._handle()
+
+    def _handle(self, head=False):
+        path = self.path.split('?')[0].lstrip('/').strip('\\')
 
-        if path in (PLAYLIST_FILE_NAME,):
-            return self._output_merge(path)
-        elif path == RUN_MERGE_URL:
+        if path in (PLAYLIST_FILE_NAME, EPG_FILE_NAME, EPG_FILE_NAME + '.gz'):
+            return self._output_merge(path, head=head)
+        elif path == RUN_MERGE_URL and not head:
             return self._run_merge()
 
         self.send_response(404)
@@ -54,15 +89,140 @@ class RequestHandler(BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(b"OK")
 
-    def _output_merge(self, name):
-        with MERGE_LOCK:
-            settings.reset()
-            paths = Merger().merge(force=False)
+    def _output_merge(self, name, head=False):
+        settings.reset()
+        paths = local_paths()
 
-        self.send_response(200)
-        self.end_headers()
-        with open(paths[name], 'rb') as f:
-            shutil.copyfileobj(f, self.wfile, length=CHUNK_SIZE)
+        if not all(os.path.exists(x) for x in paths.values()):
+            # nothing to serve yet, so have to wait for the first merge
+            with MERGE_LOCK:
+                settings.reset()
+                Merger().merge(force=False)
+            paths = local_paths()
+        else:
+            _background_merge()
+
+        encoding = None
+        decompress = False
+        if name == PLAYLIST_FILE_NAME:
+            file_path = paths[PLAYLIST_FILE_NAME]
+            content_type = 'audio/x-mpegurl'
+        elif name == epg_file_name():
+            file_path = paths[name]
+            content_type = 'application/gzip' if settings.GZ_EPG.value else 'application/xml'
+        elif name == EPG_FILE_NAME and settings.GZ_EPG.value:
+            # serve the gz output as xml. let the client decompress if it can
+            file_path = paths[epg_file_name()]
+            content_type = 'application/xml'
+            if 'gzip' in self.headers.get('Accept-Encoding', '').lower():
+                encoding = 'gzip'
+            else:
+                decompress = True
+        else:
+            file_path = None
+
+        try:
+            _in = open(file_path, 'rb')
+        except (TypeError, IOError, OSError):
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        with _in:
+            stat = os.fstat(_in.fileno())
+            # output files are swapped in by rename, so the inode changes even if mtime / size don't
+            mtime_ns = getattr(stat, 'st_mtime_ns', None) or int(stat.st_mtime * 1000000000)
+            etag = '"{:x}-{:x}-{:x}{}"'.format(stat.st_ino, mtime_ns, stat.st_size, '-d' if decompress else '')
+            last_modified = formatdate(stat.st_mtime, usegmt=True)
+
+            if self._not_modified(etag, stat.st_mtime):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', last_modified)
+                self.end_headers()
+                return
+
+            start, end = 0, stat.st_size - 1
+            status = 200
+            range_header = self.headers.get('Range')
+            if range_header and not decompress:
+                byte_range = self._parse_range(range_header, stat.st_size)
+                if not byte_range:
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */{}'.format(stat.st_size))
+                    self.end_headers()
+                    return
+                start, end = byte_range
+                status = 206
+
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            if encoding:
+                self.send_header('Content-Encoding', encoding)
+                self.send_header('Vary', 'Accept-Encoding')
+            if not decompress:
+                self.send_header('Accept-Ranges', 'bytes')
+                self.send_header('Content-Length', str(end - start + 1))
+            if status == 206:
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, stat.st_size))
+            self.end_headers()
+
+            if head:
+                return
+
+            if decompress:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                while True:
+                    chunk = _in.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    self.wfile.write(decompressor.decompress(chunk))
+                self.wfile.write(decompressor.flush())
+                return
+
+            _in.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = _in.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    def _not_modified(self, etag, mtime):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            return etag in [x.strip() for x in if_none_match.split(',')] or if_none_match.strip() == '*'
+
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                return int(mtime) <= mktime_tz(parsedate_tz(if_modified_since))
+            except (TypeError, ValueError, OverflowError):
+                return False
+
+        return False
+
+    def _parse_range(self, value, size):
+        # only a single byte range is supported
+        match = RANGE_PATTERN.match(value.strip())
+        if not match or (not match.group(1) and not match.group(2)):
+            return None
+
+        if not match.group(1):
+            # suffix range. last X bytes
+            start = max(0, size - int(match.group(2)))
+            end = size - 1
+        else:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+
+        if start >= size or start > end:
+            return None
+
+        return start, end
 
 
 class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
@@ -105,6 +105,7 @@ class Language(BaseLanguage):
     DEFAULT_USER_AGENT     = 30102
     HTTP_METHOD            = 30103
     HTTP_PORT              = 30104
+    FETCH_WORKERS          = 30105
 
 
 _ = Language()
@@ -0,0 +1,132 @@
+import re
+
+
+# alternation order matches the original attribute pattern so values tokenize the same
+ATTRIBUTE_PATTERN = re.compile(r'''([\w\-]+)=(?:([^,"' ]+)|"([^"]*)"|'([^']*)')''')
+
+
+def strip_quotes(string):
+    quotes = ('"', "'")
+    if string.startswith(quotes) and string.endswith(quotes):
+        string = string[1:-1]
+    return string
+
+
+def parse_attribs(line):
+    attribs = {}
+    match = None
+    for match in ATTRIBUTE_PATTERN.finditer(line):
+        key, plain, double, single = match.groups()
+        if plain is not None:
+            value = plain
+        elif double is not None:
+            value = double
+        else:
+            value = single
+        attribs[key.lower()] = value
+    if match:
+        # return the remainder of line after the last match
+        line = line[match.end():]
+    return attribs, line
+
+
+def parse_extinf(extinf, name=None):
+    attribs, extinf = parse_attribs(extinf)
+    chunks = extinf.split(',', 1)
+    if len(chunks) == 2:
+        name = chunks[1].strip() or name
+
+    try:
+        chno = int(attribs.pop('tvg-chno'))
+    except:
+        chno = None
+
+    groups = attribs.pop('group-title', '').strip()
+
+    return {
+        'name': name,
+        'radio': attribs.pop('radio', 'false').lower() == 'true',
+        'chno': chno,
+        'groups': groups.split(';') if groups else [],
+        'epg_id': attribs.pop('tvg-id', None) or attribs.get('tvg-name') or name,
+        'logo': attribs.pop('tvg-logo', None),
+        'attribs': attribs,
+    }
+
+
+class Header(object):
+    __slots__ = ('attribs',)
+
+    def __init__(self, attribs):
+        self.attribs = attribs
+
+
+class Entry(object):
+    __slots__ = ('extinf', 'extgroups', 'properties', 'is_live', 'url', '_info')
+
+    def __init__(self):
+        self.extinf = None
+        self.extgroups = []
+        self.properties = {}
+        self.is_live = True
+        self.url = None
+        self._info = None
+
+    @property
+    def info(self):
+        # the #EXTINF line is only parsed on first access
+        if self._info is None:
+            self._info = parse_extinf(self.extinf or '')
+        return self._info
+
+
+def parse(data):
+    """Tokenizes an m3u playlist in a single pass
+    data is the playlist text / bytes or an iterable of lines (eg. a text file) which is streamed
+
+    Yields a Header for each #EXTM3U line and an Entry for each url.
+    An Entry with no url is yielded when a blank line ends an entry that had #EXTGRP groups
+    """
+    if isinstance(data, bytes):
+        data = data.decode('utf8', 'replace')
+    if isinstance(data, type(u'')):
+        data = data.splitlines()
+
+    entry = None
+    for line in data:
+        line = line.strip()
+
+        if '#EXTM3U' in line:
+            yield Header(parse_attribs(line)[0])
+
+        if entry is None:
+            entry = Entry()
+
+        if not line:
+            if entry.extgroups:
+                yield entry
+            entry = None
+
+        elif line[0] != '#':
+            entry.url = line
+            yield entry
+            entry = None
+
+        elif line.startswith('#EXTINF'):
+            entry.extinf = line
+
+        elif line.startswith('#EXTGRP'):
+            value = line.partition(':')[2].strip()
+            if value:
+                entry.extgroups.extend([strip_quotes(x) for x in value.split(';')])
+
+        elif line.startswith('#KODIPROP') or line.startswith('#EXTVLCOPT'):
+            value = line.partition(':')[2].strip()
+            if value and '=' in value:
+                key, value = value.split('=', 1)
+                entry.properties[key] = value
+
+        elif line.startswith('#EXT-X-PLAYLIST-TYPE'):
+            value = line.partition(':')[2].strip()
+            if value and value.upper() == 'VOD':
+                entry.is_live = False
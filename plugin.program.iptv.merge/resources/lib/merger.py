@@ -1,27 +1,32 @@
 import os
 import re
+import io
 import shutil
 import time
-import gzip
+import zlib
+import struct
 import codecs
+import hashlib
 from looseversion import LooseVersion
 
 import arrow
 from kodi_six import xbmc, xbmcvfs, xbmcaddon
+from six import PY2
 from six.moves.urllib.parse import quote_plus
 
 from slyguy import database, gui, userdata, monitor
 from slyguy.log import log
-from slyguy.util import remove_file, hash_6, FileIO, gzip_extract, xz_extract, run_plugin, safe_copy, unique, restart_service, set_kodi_string
+from slyguy.util import remove_file, hash_6, FileIO, gzip_extract, xz_extract, run_plugin, safe_copy, unique, restart_service, set_kodi_string, async_tasks, load_json, save_json
 from slyguy.session import Session, gdrivedl
 from slyguy.constants import ADDON_PROFILE, CHUNK_SIZE
 from slyguy.exceptions import Error
 
 from .constants import *
-from .models import Source, Playlist, EPG, Channel, merge_info, parse_attribs, strip_quotes
+from .models import Source, Playlist, EPG, Channel, merge_info
 from .language import _
 from .settings import settings
 from . import iptv_manager
+from . import m3u
 
 
 class AddonError(Error):
@@ -56,6 +61,63 @@ def copy_partial_data(file_path, _out, start_index, end_index):
         return
 
 
+def splice_partial_data(file_path, _out, start_index, end_index):
+    # copy a byte range of file_path straight into _out using the kernel (zero-copy)
+    # falls back to a normal buffered copy where sendfile is not available / fails
+    if start_index < 1 or end_index < start_index:
+        return
+
+    if not hasattr(os, 'sendfile'):
+        return copy_partial_data(file_path, _out, start_index, end_index)
+
+    _out.flush()
+    out_index = _out.tell()
+    try:
+        with open(file_path, 'rb') as _in:
+            offset = start_index
+            while offset < end_index:
+                sent = os.sendfile(_out.fileno(), _in.fileno(), offset, end_index - offset)
+                if not sent:
+                    break
+                offset += sent
+    except Exception as e:
+        log.debug('sendfile failed: {}. Falling back to copy'.format(e))
+        _seek_file(_out, out_index)
+        return copy_partial_data(file_path, _out, start_index, end_index)
+
+    # re-sync the buffered writers position with the underlying fd
+    _out.seek(out_index + (offset - start_index), os.SEEK_SET)
+    return offset == end_index
+
+
+def replace_file(src, dst):
+    # atomic where possible so readers (eg. HTTP server) always see a complete file
+    try:
+        os.replace(src, dst)
+    except (AttributeError, OSError):
+        remove_file(dst)
+        shutil.move(src, dst)
+
+
+def local_paths():
+    local_dir = xbmc.translatePath(ADDON_PROFILE)
+    return {
+        PLAYLIST_FILE_NAME: os.path.join(local_dir, PLAYLIST_FILE_NAME),
+        epg_file_name(): os.path.join(local_dir, epg_file_name()),
+    }
+
+
+def _file_checksum(file_path):
+    checksum = hashlib.md5()
+    with FileIO(file_path, 'rb', CHUNK_SIZE) as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
 def _seek_file(f, index, truncate=True):
     cur_index = f.tell()
     if cur_index != index:
@@ -65,6 +127,143 @@ def _seek_file(f, index, truncate=True):
             f.truncate()
 
 
+def _gf2_matrix_times(mat, vec):
+    total = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            total ^= mat[i]
+        vec >>= 1
+        i += 1
+    return total
+
+
+def _gf2_matrix_square(square, mat):
+    for n in range(32):
+        square[n] = _gf2_matrix_times(mat, mat[n])
+
+
+def crc32_combine(crc1, crc2, len2):
+    # port of zlibs crc32_combine (not exposed by python's zlib)
+    # returns the crc32 of A+B given crc32(A), crc32(B) and len(B)
+    if len2 <= 0:
+        return crc1
+
+    even = [0] * 32
+    odd = [0] * 32
+
+    odd[0] = 0xedb88320
+    row = 1
+    for n in range(1, 32):
+        odd[n] = row
+        row <<= 1
+
+    _gf2_matrix_square(even, odd)
+    _gf2_matrix_square(odd, even)
+
+    while True:
+        _gf2_matrix_square(even, odd)
+        if len2 & 1:
+            crc1 = _gf2_matrix_times(even, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+
+        _gf2_matrix_square(odd, even)
+        if len2 & 1:
+            crc1 = _gf2_matrix_times(odd, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+
+    return crc1 ^ crc2
+
+
+class EPGWriter(object):
+    # Writes the merged EPG in a single pass, optionally gzip compressing on the fly.
+    # When compressing, the output is one gzip member (IPTV Simple only reads the first member)
+    # and each section (header, each source, footer) uses its own deflate compressor ending on a
+    # byte aligned flush. A sources byte range is then self contained raw deflate data that can be
+    # spliced into the next merge as-is, using its [crc, size] to keep the gzip trailer valid.
+    GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x02\xff'
+
+    def __init__(self, file_path, compress=False):
+        self.file = FileIO(file_path, 'wb')
+        self._compress = compress
+        self._compressor = None
+        self._crc = 0
+        self._size = 0
+        self._section = [0, 0]
+
+        if self._compress:
+            self.file.write(self.GZIP_HEADER)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def begin(self):
+        self._section = [0, 0]
+        if self._compress:
+            self._compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return self.file.tell()
+
+    def end(self):
+        # returns the sections uncompressed [crc, size]
+        if self._compressor:
+            self.file.write(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+            self._compressor = None
+        self._add_section(self._section)
+        return self._section
+
+    def write(self, data):
+        self._section[1] += len(data)
+        if self._compressor:
+            if PY2:
+                data = bytes(data)
+            self._section[0] = zlib.crc32(data, self._section[0]) & 0xffffffff
+            data = self._compressor.compress(data)
+        self.file.write(data)
+
+    def splice(self, file_path, start_index, end_index, section=None):
+        # copy a section from a previous output made with the same compression
+        if self._compress and not section:
+            return False
+
+        index = self.file.tell()
+        if not splice_partial_data(file_path, self.file, start_index, end_index):
+            _seek_file(self.file, index)
+            return False
+
+        self._add_section(section or [0, end_index - start_index])
+        return True
+
+    def _add_section(self, section):
+        if self._compress:
+            self._crc = crc32_combine(self._crc, section[0], section[1])
+        self._size += section[1]
+
+    def tell(self):
+        return self.file.tell()
+
+    def flush(self):
+        self.file.flush()
+
+    def rewind(self, index):
+        # drops an unfinished section and everything written after index
+        self._compressor = None
+        _seek_file(self.file, index)
+
+    def close(self):
+        if self._compress and not self.file.closed:
+            # final empty deflate block + gzip trailer
+            self.file.write(zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS).flush())
+            self.file.write(struct.pack('<II', self._crc & 0xffffffff, self._size & 0xffffffff))
+        self.file.close()
+
+
 class XMLParser(object):
     def __init__(self, out, epg_ids=None):
         self._out = out
@@ -77,6 +276,10 @@ class XMLParser(object):
 
         self._tag_pattern = re.compile(br'<(channel|programme)(\s[^>]*)?(\/?)>')
         self._attr_pattern = re.compile(br'(\w+)\s*=\s*"([^"]*)"')
+        self._end_tags = {
+            'channel': b'</channel>',
+            'programme': b'</programme>',
+        }
         self._counts = {
             'channel': {'added': 0, 'skipped': 0},
             'programme': {'added': 0, 'skipped': 0},
@@ -98,17 +301,28 @@ class XMLParser(object):
     def parse(self, _in, epg):
         epg.start_index = self._out.tell()
 
-        buffer = b""
+        # single reusable buffer + read cursor. consumed data is only dropped when the next chunk is appended
+        # so each byte is copied a bounded number of times regardless of file size
+        buffer = bytearray()
+        pos = 0
         while True:
             chunk = _in.read(CHUNK_SIZE)
             if not chunk:
                 break
+
+            if pos:
+                del buffer[:pos]
+                pos = 0
             buffer += chunk
 
             while True:
-                match = self._tag_pattern.search(buffer)
+                match = self._tag_pattern.search(buffer, pos)
                 if not match:
-                    break  # No start tag found yet
+                    # keep a possible partial start tag, drop everything before it
+                    last_tag = buffer.rfind(b'<')
+                    if last_tag > pos:
+                        pos = last_tag
+                    break
 
                 tag = match.group(1).decode('utf-8')
                 attr_text = match.group(2) or b''
@@ -118,17 +332,17 @@ class XMLParser(object):
 
                 if is_self_closing:
                     # Self-closing tag; no inner content
-                    raw_element = buffer[start_tag_pos:start_tag_end]
-                    buffer = buffer[start_tag_end:]
+                    element_end = start_tag_end
                 else:
                     # Look for end tag
-                    end_tag = "</{}>".format(tag).encode('utf-8')
+                    end_tag = self._end_tags[tag]
                     end_tag_pos = buffer.find(end_tag, start_tag_end)
                     if end_tag_pos == -1:
+                        pos = start_tag_pos
                         break  # End tag not found yet; need more data
-                    end_tag_end = end_tag_pos + len(end_tag)
-                    raw_element = buffer[start_tag_pos:end_tag_end]
-                    buffer = buffer[end_tag_end:]
+                    element_end = end_tag_pos + len(end_tag)
+
+                pos = element_end
 
                 if tag not in ('channel', 'programme'):
                     self._counts['tags_ignored'] += 1
@@ -142,13 +356,13 @@ class XMLParser(object):
                         continue
 
                 self._counts[tag]['added'] += 1
-                self._out.write(raw_element)
+                self._out.write(memoryview(buffer)[start_tag_pos:element_end])
 
         self._out.flush()
         epg.end_index = self._out.tell()
 
 
-def check_merge_required():
+def merge_due():
     # dont allow auto merge more than every 5mins
     if time.time() - userdata.get('last_run', 0) < 300:
         return False
@@ -167,7 +381,11 @@ def check_merge_required():
         run_ts = now.replace(hour=int(settings.getInt('merge_hour', 3)), minute=0, second=0, microsecond=0).timestamp
         merge_at_hour = userdata.get('last_run', 0) < run_ts and now.timestamp >= run_ts
 
-    if reload_time_hours or merge_at_hour or not xbmcvfs.exists(playlist_path) or not xbmcvfs.exists(epg_path):
+    return bool(reload_time_hours or merge_at_hour or not xbmcvfs.exists(playlist_path) or not xbmcvfs.exists(epg_path))
+
+
+def check_merge_required():
+    if merge_due():
         userdata.set('last_run', int(time.time()))
         return True
     else:
@@ -179,6 +397,7 @@ class Merger(object):
         self.output_dir = output_dir or settings.get('output_dir', '').strip() or ADDON_PROFILE
         self.local_dir = xbmc.translatePath(ADDON_PROFILE)
         self.temp_dir = os.path.join(self.local_dir, 'tmp')
+        self.cache_dir = os.path.join(self.local_dir, 'cache')
 
         if not xbmcvfs.exists(self.local_dir):
             xbmcvfs.mkdirs(self.local_dir)
@@ -189,8 +408,13 @@ class Merger(object):
         if not xbmcvfs.exists(self.temp_dir):
             xbmcvfs.mkdirs(self.temp_dir)
 
+        if not xbmcvfs.exists(self.cache_dir):
+            xbmcvfs.mkdirs(self.cache_dir)
+
         self._playlist_epgs = []
         self._extgroups = []
+        # temp file path -> [(meta path, meta, cache path), ...] waiting on that source to merge
+        self._pending_meta = {}
 
     def _call_addon_method(self, plugin_url, file_path):
         quoted_file_path = quote_plus(file_path)
@@ -210,8 +434,7 @@ class Merger(object):
         archive_type = source.archive_type
 
         if source_type != Source.TYPE_ADDON:
-            self._process_path(path, archive_type, file_path)
-            return
+            return self._process_path(path, archive_type, file_path)
 
         addon_id = path
         addon, data = merge_info(addon_id, merging=True)
@@ -226,36 +449,160 @@ class Merger(object):
 
         if data['type'] == TYPE_IPTV_MANAGER:
             iptv_manager.process_path(paths, file_path)
-            return
+            return self._checksum_changed(paths, file_path)
 
         if type(paths) is not list:
             paths = [paths]
 
+        changed = False
         for path in paths:
             path = path.replace('$ID', addon_id).replace('%24ID', addon_id)
             path = path.replace('$IP', xbmc.getIPAddress()).replace('%24IP', xbmc.getIPAddress())
-            self._process_path(path.strip(), archive_type, file_path)
+            if self._process_path(path.strip(), archive_type, file_path):
+                changed = True
+
+        return changed
+
+    def _fetch_sources(self, sources, method_name, prefix):
+        # download / extract all sources in parallel to their own temp file
+        # results are returned in source order so the merge output stays deterministic
+        def get_task(source, file_path):
+            def task():
+                log.debug('Fetching: {}'.format(source.path))
+                start = time.time()
+                changed = self._process_source(source, method_name, file_path)
+                return time.time() - start, changed
+            return task
+
+        file_paths = []
+        tasks = []
+        for count, source in enumerate(sources):
+            file_path = os.path.join(self.temp_dir, '{}_{}'.format(prefix, count))
+            file_paths.append(file_path)
+            tasks.append(get_task(source, file_path))
+
+        if not tasks:
+            return []
+
+        start = time.time()
+        results = async_tasks(tasks, workers=settings.FETCH_WORKERS.value, raise_on_error=False)
+        log.debug('Fetched {} sources in {:.2f}s'.format(len(tasks), time.time() - start))
+        return list(zip(file_paths, results))
+
+    def _cache_paths(self, key):
+        name = hashlib.md5(key.encode('utf8')).hexdigest()
+        return os.path.join(self.cache_dir, name), os.path.join(self.cache_dir, name + '.json')
+
+    def _checksum_changed(self, key, file_path):
+        # compares the raw source file against the last merge to see if it has changed
+        cache_path, meta_path = self._cache_paths(key)
+        meta = load_json(meta_path, raise_error=False) or {}
+
+        checksum = _file_checksum(file_path)
+        if checksum == meta.get('checksum'):
+            log.debug('Source unchanged: {}'.format(key))
+            os.utime(meta_path, None)
+            return False
+
+        self._defer_meta(file_path, meta_path, {'checksum': checksum})
+        return True
+
+    def _download(self, url, file_path):
+        # conditional GET using the ETag / Last-Modified from the last download
+        # a cached copy is only kept if the server supports either of them
+        cache_path, meta_path = self._cache_paths(url)
+        meta = load_json(meta_path, raise_error=False) or {}
+
+        headers = {}
+        if os.path.exists(cache_path):
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        log.debug('Downloading: {} > {}'.format(url, file_path))
+        resp = Session().chunked_dl(url, file_path, headers=headers)
+
+        if resp.status_code == 304:
+            log.debug('Not Modified. Using cached: {}'.format(cache_path))
+            shutil.copyfile(cache_path, file_path)
+            os.utime(cache_path, None)
+            os.utime(meta_path, None)
+            return resp.url, False
+
+        checksum = _file_checksum(file_path)
+        changed = checksum != meta.get('checksum')
+        if not changed:
+            log.debug('Source unchanged: {}'.format(url))
+
+        meta = {
+            'etag': resp.headers.get('ETag'),
+            'last_modified': resp.headers.get('Last-Modified'),
+            'checksum': checksum,
+        }
+
+        if meta['etag'] or meta['last_modified']:
+            # copied now as file_path may be extracted in place. moved into place by _save_meta
+            shutil.copyfile(file_path, cache_path + '.new')
+            self._defer_meta(file_path, meta_path, meta, cache_path)
+        else:
+            remove_file(cache_path)
+            self._defer_meta(file_path, meta_path, meta)
+
+        return resp.url, changed
+
+    def _defer_meta(self, file_path, meta_path, meta, cache_path=None):
+        # only saved once the source has merged. otherwise a source that failed to parse
+        # would look unchanged on the next merge and its previous data would keep being used
+        self._pending_meta.setdefault(file_path, []).append((meta_path, meta, cache_path))
+
+    def _save_meta(self, file_path):
+        for meta_path, meta, cache_path in self._pending_meta.pop(file_path, []):
+            if cache_path:
+                remove_file(cache_path)
+                os.rename(cache_path + '.new', cache_path)
+            save_json(meta_path, meta, raise_error=False)
+
+    def _discard_meta(self, file_path):
+        for meta_path, meta, cache_path in self._pending_meta.pop(file_path, []):
+            if cache_path:
+                remove_file(cache_path + '.new')
+
+    def _clean_cache(self, max_age=CACHE_MAX_AGE):
+        # remove cached sources that havent been used for a while (eg. removed sources)
+        now = time.time()
+        for name in os.listdir(self.cache_dir):
+            file_path = os.path.join(self.cache_dir, name)
+            try:
+                if now - os.path.getmtime(file_path) > max_age:
+                    os.remove(file_path)
+            except OSError:
+                pass
 
     def _process_path(self, path, archive_type, file_path):
+        cache_key = path
+
         if path.lower().startswith('plugin://'):
             path = self._call_addon_method(path, file_path)
             if not path:
-                return
+                return True
 
+        changed = None
         if path.lower().startswith('http://') or path.lower().startswith('https://'):
             if 'drive.google.com' in path.lower():
                 log.debug('Gdrive Downloading: {} > {}'.format(path, file_path))
                 path = gdrivedl(path, file_path)
             else:
-                log.debug('Downloading: {} > {}'.format(path, file_path))
-                resp = Session().chunked_dl(path, file_path)
-                path = resp.url
+                path, changed = self._download(path, file_path)
 
         elif not xbmcvfs.exists(path):
             raise Error(_(_.LOCAL_PATH_MISSING, path=path))
         else:
             safe_copy(path, file_path)
 
+        if changed is None:
+            changed = self._checksum_changed(cache_key, file_path)
+
         if archive_type == Source.ARCHIVE_AUTO:
             try:
                 with open(file_path, 'rb') as f:
@@ -275,9 +622,10 @@ class Merger(object):
         elif archive_type == Source.ARCHIVE_XZ:
             xz_extract(file_path)
 
+        return changed
+
     def _process_playlist(self, playlist, file_path):
-        channel = None
-        to_create = set()
+        to_create = []
         slugs = set()
         added_count = 0
 
@@ -294,19 +642,17 @@ class Merger(object):
                 return False
 
             for group in hide_groups:
-                if group in channel.groups:
-                    log.debug('Setting channel: {} not visible due to hide group: {}'.format(channel.slug, group))
+                if group in channel['groups']:
+                    log.debug('Setting channel: {} not visible due to hide group: {}'.format(channel['url'], group))
                     return False
 
             return True
 
-        with codecs.open(file_path, 'r', encoding='utf8', errors='replace') as infile:
-            for line in infile:
-                line = line.strip()
-
-                if '#EXTM3U' in line:
-                    #if not playlist.ignore_playlist_epg:
-                    attribs = parse_attribs(line)[0]
+        # streamed line by line so large playlists aren't held in memory
+        with io.open(file_path, 'r', encoding='utf8', errors='replace') as f:
+            for record in m3u.parse(f):
+                if isinstance(record, m3u.Header):
+                    attribs = record.attribs
 
                     if not playlist.get_option('ignore_epgs', False):
                         xml_urls = attribs.get('x-tvg-url', '').split(',')
@@ -321,86 +667,68 @@ class Merger(object):
                     if 'catchup-correction' in attribs:
                         default_attribs['catchup-correction'] = attribs['catchup-correction']
 
-                if not channel:
-                    channel = Channel()
-                    extgroups = []
-
-                if line.startswith('#EXTINF'):
-                    channel.load_extinf(line)
-                    for key in default_attribs:
-                        if key not in channel.attribs:
-                            channel.attribs[key] = default_attribs[key]
-
-                elif line.startswith('#EXTGRP'):
-                    value = line.split(':',1)[1].strip()
-                    if value:
-                        extgroups.extend([strip_quotes(x) for x in value.split(';')])
-
-                elif line.startswith('#KODIPROP') or line.startswith('#EXTVLCOPT'):
-                    value = line.split(':',1)[1].strip()
-                    if value and '=' in value:
-                        key, value = value.split('=', 1)
-                        channel.properties[key] = value
-
-                elif line.startswith('#EXT-X-PLAYLIST-TYPE'):
-                    value = line.split(':',1)[1].strip()
-                    if value and value.upper() == 'VOD':
-                        channel.is_live = False
-
-                elif not line.startswith('#'):
-                    if not line:
-                        self._extgroups.extend(extgroups)
-                        channel = None
-                        continue
+                    continue
 
-                    channel.url = line
-                    channel.playlist = playlist
-                    channel.groups.extend(extgroups)
+                if record.url is None:
+                    self._extgroups.extend(record.extgroups)
+                    continue
 
-                    if playlist.skip_playlist_groups:
-                        channel.groups = []
+                # plain dict rather than a Channel model. inserted as a row below
+                channel = record.info
+                channel.update({
+                    'playlist': playlist.id,
+                    'custom': False,
+                    'properties': record.properties,
+                    'is_live': record.is_live,
+                    'modified': False,
+                })
 
-                    if playlist.group_name:
-                        channel.groups.extend(playlist.group_name.split(';'))
+                for key in default_attribs:
+                    if key not in channel['attribs']:
+                        channel['attribs'][key] = default_attribs[key]
 
-                    if playlist.skip_playlist_chno:
-                        channel.chno = None
+                channel['url'] = record.url
+                channel['groups'].extend(record.extgroups)
 
-                    if playlist.use_start_chno:
-                        if channel.radio:
-                            if channel.chno is None:
-                                channel.chno = chnos['radio']
+                if playlist.skip_playlist_groups:
+                    channel['groups'] = []
 
-                            chnos['radio'] = channel.chno + 1
-                        else:
-                            if channel.chno is None:
-                                channel.chno = chnos['tv']
+                if playlist.group_name:
+                    channel['groups'].extend(playlist.group_name.split(';'))
+
+                if playlist.skip_playlist_chno:
+                    channel['chno'] = None
+
+                if playlist.use_start_chno:
+                    key = 'radio' if channel['radio'] else 'tv'
+                    if channel['chno'] is None:
+                        channel['chno'] = chnos[key]
 
-                            chnos['tv'] = channel.chno + 1
+                    chnos[key] = channel['chno'] + 1
 
-                    channel.groups = [x for x in channel.groups if x.strip()]
-                    channel.visible = is_visible(channel)
+                channel['groups'] = [x for x in channel['groups'] if x.strip()]
+                channel['visible'] = is_visible(channel)
 
-                    channel_id = channel.attribs.get('channel-id') or channel.attribs.get('channelid') or channel.epg_id or channel.url.lower().strip()
-                    channel.slug = slug = '{}.{}'.format(playlist.id, hash_6(channel_id))
-                    channel.order = added_count + 1
+                attribs = channel['attribs']
+                channel_id = attribs.get('channel-id') or attribs.get('channelid') or channel['epg_id'] or record.url.lower()
+                channel['slug'] = slug = '{}.{}'.format(playlist.id, hash_6(channel_id))
+                channel['order'] = added_count + 1
 
-                    count = 1
-                    while channel.slug in slugs:
-                        channel.slug = '{}.{}'.format(slug, count)
-                        count += 1
+                count = 1
+                while channel['slug'] in slugs:
+                    channel['slug'] = '{}.{}'.format(slug, count)
+                    count += 1
 
-                    slugs.add(channel.slug)
-                    to_create.add(channel)
+                slugs.add(channel['slug'])
+                to_create.append(channel)
 
-                    if Channel.bulk_create_lazy(to_create):
-                        to_create.clear()
+                if len(to_create) >= INSERT_BATCH_SIZE:
+                    Channel.insert_rows(to_create)
+                    to_create = []
 
-                    channel = None
-                    added_count += 1
+                added_count += 1
 
-        Channel.bulk_create_lazy(to_create, force=True)
-        to_create.clear()
+        Channel.insert_rows(to_create)
         slugs.clear()
 
         return added_count
@@ -413,13 +741,14 @@ class Merger(object):
             'playlist': {
                 'output': os.path.join(self.output_dir, PLAYLIST_FILE_NAME), # can be remote, kodi style path
                 'local': os.path.join(self.local_dir, PLAYLIST_FILE_NAME), # always local translated path
-                'source': os.path.join(self.temp_dir, 'playlist_source.m3u8'), # always local translated path
+                'build': os.path.join(self.temp_dir, PLAYLIST_FILE_NAME), # always local translated path
+                'sources': [], # always local translated paths
             },
             'epg': {
                 'output': os.path.join(self.output_dir, epg_file_name()), # can be remote, kodi style path
                 'local': os.path.join(self.local_dir, epg_file_name()), # always local translated path
-                'build': os.path.join(self.temp_dir, EPG_FILE_NAME), # always local translated path
-                'source': os.path.join(self.temp_dir, 'epg_source.xml'), # always local translated path
+                'build': os.path.join(self.temp_dir, epg_file_name()), # always local translated path
+                'sources': [], # always local translated paths
             }
         }
 
@@ -427,6 +756,7 @@ class Merger(object):
             return {PLAYLIST_FILE_NAME: paths['playlist']['local'], epg_file_name(): paths['epg']['local']}
 
         userdata.set('last_run', int(time.time()))
+        self._clean_cache()
         ################## PLAYLIST #####################
         start_time = time.time()
         database.connect()
@@ -437,12 +767,20 @@ class Merger(object):
             Playlist.update({Playlist.results: []}).where(Playlist.enabled == False).execute()
             Channel.delete().where(Channel.custom == False, Channel.playlist.not_in(playlists)).execute()
 
+            if progress:
+                progress.update(0, 'Fetching Playlists ({})'.format(len(playlists)))
+
+            fetched = self._fetch_sources([x for x in playlists if x.source_type != Playlist.TYPE_CUSTOM], METHOD_PLAYLIST, 'playlist_source')
+            paths['playlist']['sources'] = [x[0] for x in fetched]
+            fetched = iter(fetched)
+
             for count, playlist in enumerate(playlists):
                 count += 1
 
                 if progress:
                     progress.update(int(count*(100/len(playlists))), 'Merging Playlist ({}/{})'.format(count, len(playlists)), _(playlist.label, _bold=True))
 
+                file_path = None
                 process_took = 0
                 playlist_took = 0
                 error = None
@@ -450,13 +788,16 @@ class Merger(object):
                     log.debug('Processing: {}'.format(playlist.path))
 
                     if playlist.source_type != Playlist.TYPE_CUSTOM:
-                        process_start = time.time()
-                        self._process_source(playlist, METHOD_PLAYLIST, paths['playlist']['source'])
-                        process_took = time.time() - process_start
+                        file_path, result = next(fetched)
+                        if isinstance(result, Exception):
+                            raise result
+
+                        process_took = result[0]
+
                         playlist_start = time.time()
                         with Channel._meta.database.atomic() as transaction:
                             try:
-                                added = self._process_playlist(playlist, paths['playlist']['source'])
+                                added = self._process_playlist(playlist, file_path)
                             except:
                                 transaction.rollback()
                                 raise
@@ -474,15 +815,18 @@ class Merger(object):
                 else:
                     playlist.results.insert(0, [int(time.time()), Playlist.OK, '{} Channels ({:.2f}s + {:.2f}s)'.format(added, process_took, playlist_took)])
                     error = None
+                    self._save_meta(file_path)
 
                 if error:
+                    self._discard_meta(file_path)
                     result = [int(time.time()), Playlist.ERROR, str(error)]
                     if playlist.results and playlist.results[0][1] == Playlist.ERROR:
                         playlist.results[0] = result
                     else:
                         playlist.results.insert(0, result)
 
-                remove_file(paths['playlist']['source'])
+                if file_path:
+                    remove_file(file_path)
 
                 playlist.results = playlist.results[:3]
                 playlist.save()
@@ -491,8 +835,13 @@ class Merger(object):
             starting_ch_no = settings.getInt('start_ch_no', 1)
             groups_disabled = settings.getBool('disable_groups', False)
 
-            with codecs.open(paths['playlist']['local'], 'w', encoding='utf8') as outfile:
-                outfile.write(u'#EXTM3U x-tvg-url="{}"\n'.format(paths['epg']['output']))
+            if settings.HTTP_URL.value:
+                epg_url = settings.HTTP_URL.value + epg_file_name()
+            else:
+                epg_url = paths['epg']['output']
+
+            with codecs.open(paths['playlist']['build'], 'w', encoding='utf8') as outfile:
+                outfile.write(u'#EXTM3U x-tvg-url="{}"\n'.format(epg_url))
 
                 groups = []
                 group_order = settings.get('group_order')
@@ -550,6 +899,7 @@ class Merger(object):
 
                 outfile.write(u'\n')
 
+            replace_file(paths['playlist']['build'], paths['playlist']['local'])
             log.debug('Wrote {} Channels'.format(count))
             Playlist.after_merge()
             safe_copy(paths['playlist']['local'], paths['playlist']['output'])
@@ -557,7 +907,9 @@ class Merger(object):
             database.close()
             if progress:
                 progress.close()
-            remove_file(paths['playlist']['source'])
+            for file_path in paths['playlist']['sources']:
+                remove_file(file_path)
+            remove_file(paths['playlist']['build'])
 
         log.debug('Playlist Merge Time: {0:.2f}'.format(time.time() - start_time))
 
@@ -585,6 +937,19 @@ class Merger(object):
             else:
                 epg_ids = None
 
+            # previous merged data can only be re-used if it was built with the same compression and orphan filter
+            if epg_ids is None:
+                epg_filter = None
+            else:
+                epg_filter = hashlib.md5(u'\n'.join(sorted(x or u'' for x in epg_ids)).encode('utf8')).hexdigest()
+
+            # cleared until this merge completes as epg indexes will point into the new build
+            last_epg = userdata.get('last_epg', {})
+            userdata.delete('last_epg')
+            prev_path = paths['epg']['local']
+            if last_epg.get('gz') != settings.GZ_EPG.value or not os.path.exists(prev_path) or last_epg.get('size') != os.path.getsize(prev_path):
+                prev_path = None
+
             if self._playlist_epgs:
                 epg_urls = [x.path.lower() for x in epgs]
                 for url in self._playlist_epgs:
@@ -593,47 +958,77 @@ class Merger(object):
                         epgs.append(epg)
                         epg_urls.append(url.lower())
 
-            # gzip cant seek, so must do xml first and then gz after
-            with FileIO(paths['epg']['build'], "wb") as _out:
+            if progress:
+                progress.update(0, 'Fetching EPGs ({})'.format(len(epgs)))
+
+            fetched = self._fetch_sources(epgs, METHOD_EPG, 'epg_source')
+            paths['epg']['sources'] = [x[0] for x in fetched]
+
+            sections = {}
+            with EPGWriter(paths['epg']['build'], compress=settings.GZ_EPG.value) as _out:
+                _out.begin()
                 _out.write(b'<?xml version="1.0" encoding="UTF-8"?><tv>')
+                _out.end()
 
                 for count, epg in enumerate(epgs):
+                    file_path, result = fetched[count]
                     count += 1
 
                     if progress: progress.update(int(count*(100/len(epgs))), 'Merging EPG ({}/{})'.format(count, len(epgs)), _(epg.label, _bold=True))
 
                     start_index = _out.tell()
+                    # parser overwrites the indexes, so keep the ones pointing into the previous output
+                    prev_start, prev_end = epg.start_index, epg.end_index
+                    prev_section = last_epg.get('sections', {}).get(str(epg.id))
                     try:
                         log.debug('Processing: {}'.format(epg.path))
-                        process_start = time.time()
-                        self._process_source(epg, METHOD_EPG, paths['epg']['source'])
-                        process_took = time.time() - process_start
+                        if isinstance(result, Exception):
+                            raise result
+
+                        process_took, changed = result
+
                         parser_start = time.time()
-                        with FileIO(paths['epg']['source'], 'rb') as _in:
-                            parser = XMLParser(_out, epg_ids)
-                            parser.parse(_in, epg)
+                        spliced = False
+                        if not changed and prev_path and prev_start > 0 and last_epg.get('filter') == epg_filter:
+                            spliced = _out.splice(prev_path, prev_start, prev_end, prev_section)
+                            if spliced:
+                                log.debug('Source unchanged. Last used XML data spliced')
+                                section = prev_section
+
+                        if not spliced:
+                            with FileIO(file_path, 'rb') as _in:
+                                _out.begin()
+                                parser = XMLParser(_out, epg_ids)
+                                parser.parse(_in, epg)
+                                section = _out.end()
                         parser_took = time.time() - parser_start
+
+                        # indexes always point at the (compressed) section in the output file
+                        epg.start_index = start_index
+                        epg.end_index = _out.tell()
+                        sections[str(epg.id)] = section
                     except Exception as e:
                         log.exception(e)
                         result = [int(time.time()), EPG.ERROR, str(e)]
                     else:
-                        result = [int(time.time()), EPG.OK, '{} ({:.2f}s + {:.2f}s)'.format(parser.epg_count(), process_took, parser_took)]
+                        result = [int(time.time()), EPG.OK, '{} ({:.2f}s + {:.2f}s)'.format('Unchanged' if spliced else parser.epg_count(), process_took, parser_took)]
                         epg.results.insert(0, result)
+                        self._save_meta(file_path)
 
                     if result[1] == EPG.ERROR:
-                        _seek_file(_out, start_index)
+                        self._discard_meta(file_path)
+                        _out.rewind(start_index)
+                        epg.start_index = 0
+                        epg.end_index = 0
 
-                        if epg.start_index > 0:
-                            if copy_partial_data(paths['epg']['local'], _out, epg.start_index, epg.end_index):
+                        if prev_start > 0 and prev_path:
+                            if _out.splice(prev_path, prev_start, prev_end, prev_section):
                                 log.debug('Last used XML data loaded successfully')
                                 epg.start_index = start_index
                                 epg.end_index = _out.tell()
+                                sections[str(epg.id)] = prev_section
                             else:
                                 log.debug('Failed to load last XML data')
-                                epg.start_index = 0
-                                epg.end_index = 0
-                                # rewind in case of partial failed copy
-                                _seek_file(_out, start_index)
 
                         if epg.results and epg.results[0][1] == EPG.ERROR:
                             epg.results[0] = result
@@ -643,26 +1038,21 @@ class Merger(object):
                     epg.results = epg.results[:3]
                     if epg.id:
                         epg.save()
-                    remove_file(paths['epg']['source'])
+                    remove_file(file_path)
 
+                _out.begin()
                 _out.write(b'</tv>')
+                _out.end()
 
-            if settings.GZ_EPG.value:
-                dst = paths['epg']['build'] + '.gz'
-                with open(paths['epg']['build'], "rb") as f_in:
-                    with gzip.open(dst, "wb") as f_out:
-                        shutil.copyfileobj(f_in, f_out)
-                remove_file(paths['epg']['build'])
-                paths['epg']['build'] = dst
-
-            remove_file(paths['epg']['local'])
-            shutil.move(paths['epg']['build'], paths['epg']['local'])
+            replace_file(paths['epg']['build'], paths['epg']['local'])
+            userdata.set('last_epg', {'filter': epg_filter, 'gz': settings.GZ_EPG.value, 'size': os.path.getsize(paths['epg']['local']), 'sections': sections})
             safe_copy(paths['epg']['local'], paths['epg']['output'])
         finally:
             database.close()
             if progress:
                 progress.close()
-            remove_file(paths['epg']['source'])
+            for file_path in paths['epg']['sources']:
+                remove_file(file_path)
             remove_file(paths['epg']['build'])
 
         log.debug('EPG Merge Time: {0:.2f}'.format(time.time() - start_time))
@@ -4,7 +4,6 @@ import time
 import re
 import codecs
 import arrow
-from contextlib import contextmanager
 from looseversion import LooseVersion
 
 import peewee
@@ -22,26 +21,6 @@ from .language import _
 from .settings import settings
 
 
-ATTRIBUTELISTPATTERN = re.compile(r'''([\w\-]+)=([^,"' ]+|"[^"]*"|'[^']*')''')
-
-
-def strip_quotes(string):
-    quotes = ('"', "'")
-    if string.startswith(quotes) and string.endswith(quotes):
-        string = string[1:-1]
-    return string
-
-
-def parse_attribs(line):
-    attribs = {}
-    match = None
-    for match in ATTRIBUTELISTPATTERN.finditer(line):
-        attribs[match.group(1).lower().strip()] = strip_quotes(match.group(2).strip())
-    if match:
-        # return the remainder of line after the last match
-        line = line[match.end():]
-    return attribs, line
-
 @plugin.route()
 def play_channel(slug, **kwargs):
     channel = Channel.get_by_id(slug)
@@ -567,48 +546,48 @@ class Channel(database.Model):
 
     @classmethod
     def epg_ids(cls):
-        query = cls.select(cls.epg_id).where(cls.visible == True).distinct()
-        with cls.merged():
-            return [x[0] for x in query.tuples()]
+        model = cls.merged()
+        query = model.select(model.epg_id).where(model.visible == True).distinct()
+        return [x[0] for x in query.tuples()]
 
     @classmethod
     def playlist_list(cls, radio=None):
-        query = cls.select(cls).join(Playlist).where(cls.visible == True).order_by(cls.chno.asc(nulls='LAST'), cls.playlist.order, cls.order)
+        model = cls.merged()
+        query = model.select(model).join(Playlist).where(model.visible == True).order_by(model.chno.asc(nulls='LAST'), model.playlist.order, model.order)
 
         if radio is not None:
-            query = query.where(cls.radio == radio)
+            query = query.where(model.radio == radio)
 
-        with cls.merged():
-            for channel in query:
-                yield(channel)
+        for channel in query:
+            yield(channel)
 
     @classmethod
     def channel_list(cls, radio=None, playlist_id=0, page=1, page_size=0, search=None):
-        query = cls.select(cls).join(Playlist).order_by(cls.chno.asc(nulls='LAST'), cls.playlist.order, cls.order)
+        model = cls.merged()
+        query = model.select(model).join(Playlist).order_by(model.chno.asc(nulls='LAST'), model.playlist.order, model.order)
 
         if radio is not None:
-            query = query.where(cls.radio == radio)
+            query = query.where(model.radio == radio)
 
         if playlist_id is None:
-            query = query.where(cls.playlist_id.is_null())
+            query = query.where(model.playlist_id.is_null())
         elif playlist_id:
-            query = query.where(cls.playlist_id == playlist_id)
+            query = query.where(model.playlist_id == playlist_id)
 
         if search:
-            query = query.where(cls.name.concat(' ').concat(cls.url) ** '%{}%'.format(search))
+            query = query.where(model.name.concat(' ').concat(model.url) ** '%{}%'.format(search))
 
         if page_size > 0:
             query = query.paginate(page, page_size)
 
-        with cls.merged():
-            for channel in query.prefetch(Playlist):
-                yield(channel)
+        for channel in query.prefetch(Playlist):
+            yield(channel)
 
     @classmethod
-    @contextmanager
     def merged(cls):
-        channel_updates = set()
-
+        # returns the model to query for channels with overrides applied
+        # overridden channels go into a temp table which a temp view unions with the untouched channels
+        rows = []
         for override in Override.select(Override, Channel).join(Channel, on=(Channel.slug == Override.slug), attr='channel'):
             channel = override.channel
 
@@ -621,20 +600,22 @@ class Channel(database.Model):
             channel.modified = True if not channel.custom else False
             channel.attribs.update(override.attribs)
             channel.properties.update(override.properties)
-            channel_updates.add(channel)
+            rows.append(channel.__data__)
 
-        if not channel_updates:
-            yield
-            return
+        if not rows:
+            return cls
 
-        with cls._meta.database.atomic() as transaction:
-            try:
-                Channel.bulk_update(channel_updates, fields=Channel._meta.fields)
-                yield
-                transaction.rollback()
-            except Exception as e:
-                transaction.rollback()
-                raise
+        db = cls._meta.database
+        db.execute_sql('CREATE TEMP TABLE IF NOT EXISTS "{}" AS SELECT * FROM "{}" WHERE 0'.format(
+            ChannelOverride._meta.table_name, cls._meta.table_name))
+        db.execute_sql('CREATE TEMP VIEW IF NOT EXISTS "{view}" AS SELECT * FROM "{table}" WHERE "slug" NOT IN (SELECT "slug" FROM "{override}") UNION ALL SELECT * FROM "{override}"'.format(
+            view=MergedChannel._meta.table_name, table=cls._meta.table_name, override=ChannelOverride._meta.table_name))
+
+        with db.atomic():
+            ChannelOverride.delete().execute()
+            ChannelOverride.insert_rows(rows)
+
+        return MergedChannel
 
     @classmethod
     def from_url(cls, playlist, url):
@@ -649,28 +630,19 @@ class Channel(database.Model):
             custom   = True,
         )
 
-    def load_extinf(self, extinf):
-        attribs, extinf = parse_attribs(extinf)
-        chunks = extinf.split(',', 1)
-        if len(chunks) == 2:
-            name = chunks[1].strip()
-            if name:
-                self.name = name
+class ChannelOverride(Channel):
+    # temp table holding overridden channels. see Channel.merged
+    playlist = peewee.ForeignKeyField(Playlist, backref='+')
 
-        self.radio = attribs.pop('radio', 'false').lower() == 'true'
-
-        try:
-            self.chno = int(attribs.pop('tvg-chno'))
-        except:
-            self.chno = None
+    class Meta:
+        table_name = 'channel_override'
 
-        groups = attribs.pop('group-title', '').strip()
-        if groups:
-            self.groups = groups.split(';')
+class MergedChannel(Channel):
+    # temp view of channels with overrides applied. see Channel.merged
+    playlist = peewee.ForeignKeyField(Playlist, backref='+')
 
-        self.epg_id = attribs.pop('tvg-id', None) or attribs.get('tvg-name') or self.name
-        self.logo = attribs.pop('tvg-logo', None)
-        self.attribs = attribs
+    class Meta:
+        table_name = 'merged_channel'
 
 class Override(database.Model):
     playlist = peewee.ForeignKeyField(Playlist, backref="overrides", on_delete='cascade')
@@ -767,4 +739,6 @@ class Override(database.Model):
         cls.delete().where((cls.fields=={}) & (cls.attribs=={}) & (cls.properties=={}) & (cls.headers=={})).execute()
 
 
-database.init([Playlist, PlaylistOption, EPG, Channel, Override])
+db = database.init([Playlist, PlaylistOption, EPG, Channel, Override])
+# temp models are bound to the db but not created on connect. see Channel.merged
+db.bind([ChannelOverride, MergedChannel], bind_refs=False, bind_backrefs=False)
@@ -1,5 +1,5 @@
 from slyguy.util import restart_service
-from slyguy.constants import ADDON, ADDON_ID, KODI_VERSION
+from slyguy.constants import ADDON, ADDON_ID, KODI_VERSION, DEFAULT_WORKERS
 from slyguy.settings import CommonSettings, is_donor
 from slyguy.settings.types import Bool, Text, Browse, Number, Action
 
@@ -28,6 +28,7 @@ class Settings(CommonSettings):
     ASK_TO_ADD = Bool('ask_to_add', _.ASK_TO_ADD, default=False)
     IPTV_MERGE_PROXY = Bool('iptv_merge_proxy', _.IPTV_MERGE_PROXY, default=True)
     DEFAULT_USER_AGENT = Text('user_agent', _.DEFAULT_USER_AGENT, default=DEFAULT_USERAGENT, parent=IPTV_MERGE_PROXY)
+    FETCH_WORKERS = Number('fetch_workers', _.FETCH_WORKERS, default=DEFAULT_WORKERS, lower_limit=1, upper_limit=20)
     GZ_EPG = Bool('gz_epg', _.GZ_EPG, default=False, visible=KODI_VERSION >= 18, enable=is_donor, disabled_reason=_.SUPPORTER_ONLY)
 
     HTTP_METHOD = Bool('http_method', _.HTTP_METHOD, default=KODI_VERSION >= 21, after_save=lambda val: restart_service(), after_clear=restart_service)
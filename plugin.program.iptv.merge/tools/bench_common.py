@@ -0,0 +1,96 @@
+"""Helpers for the standalone benchmarks in this folder
+
+The benchmarks load just the code they measure straight from the add-on source (or from any git revision of it)
+so they run outside of Kodi. Each variant runs in its own process so peak RSS is measured per variant.
+"""
+import os
+import re
+import ast
+import sys
+import json
+import time
+import subprocess
+
+try:
+    import resource
+except ImportError:
+    # windows
+    resource = None
+
+
+ADDON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHUNK_SIZE = 64 * 1024 # slyguy.constants.CHUNK_SIZE
+
+
+def read_source(rel_path, rev=None):
+    """Returns the source of rel_path (relative to the add-on folder) from the working tree or a git revision.
+    Returns None if it doesn't exist at that revision
+    """
+    if not rev:
+        path = os.path.join(ADDON_DIR, rel_path)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read().decode('utf8')
+
+    prefix = subprocess.check_output(['git', 'rev-parse', '--show-prefix'], cwd=ADDON_DIR).decode('utf8').strip()
+    try:
+        return subprocess.check_output(['git', 'show', '{}:{}{}'.format(rev, prefix, rel_path)], cwd=ADDON_DIR, stderr=subprocess.STDOUT).decode('utf8')
+    except subprocess.CalledProcessError:
+        return None
+
+
+def load(source, names, namespace=None):
+    """Execs only the top level classes / functions / assignments in names from source. Imports are skipped,
+    so anything they need must be passed in namespace
+    """
+    namespace = dict(namespace or {})
+    namespace.setdefault('re', re)
+    namespace.setdefault('CHUNK_SIZE', CHUNK_SIZE)
+
+    nodes = []
+    for node in ast.parse(source).body:
+        if isinstance(node, (ast.ClassDef, ast.FunctionDef)) and node.name in names:
+            nodes.append(node)
+        elif isinstance(node, ast.Assign) and any(getattr(x, 'id', None) in names for x in node.targets):
+            nodes.append(node)
+
+    exec(compile(ast.Module(body=nodes, type_ignores=[]), '<bench>', 'exec'), namespace)
+    missing = [x for x in names if x not in namespace]
+    if missing:
+        raise Exception('{} not found'.format(', '.join(missing)))
+    return namespace
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macos, KB everywhere else
+    return peak / (1024.0 * 1024) if sys.platform == 'darwin' else peak / 1024.0
+
+
+def run_worker(script, args):
+    """Runs script --worker args in a new process and returns the json dict it prints last"""
+    output = subprocess.check_output([sys.executable, script, '--worker'] + args)
+    return json.loads(output.decode('utf8').strip().splitlines()[-1])
+
+
+def report(result):
+    print(json.dumps(result))
+
+
+class Timer(object):
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.took = time.time() - self.start
+
+
+def print_table(rows, columns):
+    widths = [max(len(str(row.get(x, ''))) for row in rows + [dict((x, x) for x in columns)]) for x in columns]
+    print('  '.join(x.ljust(w) for x, w in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(str(row.get(x, '')).ljust(w) for x, w in zip(columns, widths)))
@@ -0,0 +1,144 @@
+"""Benchmarks the XMLTV parser (merger.XMLParser) against a synthetic EPG
+
+Measures throughput and peak RSS of the current code and optionally of another git revision, eg.
+    python tools/bench_epg.py --size 200 --before d4b3ef7
+
+Both variants parse the same file and the md5 of their output must match.
+"""
+import os
+import sys
+import random
+import hashlib
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import bench_common
+
+
+MERGER_PATH = os.path.join('resources', 'lib', 'merger.py')
+
+
+class EPG(object):
+    start_index = None
+    end_index = None
+
+
+class Sink(object):
+    """Stands in for the output file. Hashes instead of writing so disk speed isn't measured"""
+    def __init__(self):
+        self._md5 = hashlib.md5()
+        self._pos = 0
+
+    def write(self, data):
+        self._md5.update(data)
+        self._pos += len(data)
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def hexdigest(self):
+        return self._md5.hexdigest()
+
+
+def generate(path, size_mb, channels, seed=1):
+    rand = random.Random(seed)
+    target = size_mb * 1024 * 1024
+    with open(path, 'wb') as f:
+        f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n<tv generator-info-name="bench">\n')
+        for i in range(channels):
+            f.write('<channel id="ch{0}.bench"><display-name>Channel {0}</display-name><icon src="http://example.com/logo/{0}.png"/></channel>\n'.format(i).encode('utf8'))
+
+        start = 1700000000
+        while f.tell() < target:
+            for i in range(channels):
+                # some programmes point at channels not in the playlist so the orphan check has work to do
+                channel = 'ch{}.bench'.format(i) if i % 10 else 'orphan{}.bench'.format(i)
+                desc = ' '.join(rand.choice(('news', 'sport', 'the', 'live', 'movie', 'series', 'episode', 'weather', 'late', 'show')) for _ in range(rand.randint(10, 60)))
+                f.write((
+                    '<programme start="{start}" stop="{stop}" channel="{channel}">'
+                    '<title lang="en">Programme {n}</title><desc lang="en">{desc}</desc>'
+                    '<category lang="en">Category {cat}</category><episode-num system="xmltv_ns">1.{n}.</episode-num>'
+                    '</programme>\n'
+                ).format(start=start, stop=start + 1800, channel=channel, n=rand.randint(1, 999), desc=desc, cat=rand.randint(1, 20)).encode('utf8'))
+            start += 1800
+        f.write(b'</tv>\n')
+
+
+def worker(args):
+    source = bench_common.read_source(MERGER_PATH, args.rev)
+    XMLParser = bench_common.load(source, ['XMLParser'])['XMLParser']
+
+    epg_ids = None
+    if args.orphans:
+        epg_ids = ['ch{}.bench'.format(i) for i in range(args.channels)]
+
+    sink = Sink()
+    parser = XMLParser(sink, epg_ids=epg_ids)
+    size = os.path.getsize(args.path)
+    with open(args.path, 'rb') as f, bench_common.Timer() as timer:
+        parser.parse(f, EPG())
+
+    bench_common.report({
+        'secs': round(timer.took, 2),
+        'mb_s': round(size / (1024.0 * 1024) / timer.took, 1),
+        'peak_rss_mb': round(bench_common.peak_rss_mb(), 1),
+        'out_mb': round(sink.tell() / (1024.0 * 1024), 1),
+        'md5': sink.hexdigest(),
+        'count': parser.epg_count(),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=100, help='size of the generated xmltv in MB')
+    parser.add_argument('--channels', type=int, default=500)
+    parser.add_argument('--before', help='git revision to compare against')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per variant. best is reported')
+    parser.add_argument('--no-orphans', dest='orphans', action='store_false', help='skip the orphan (epg_ids) check')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--path', help=argparse.SUPPRESS)
+    parser.add_argument('--rev', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        return worker(args)
+
+    variants = [('current', None)]
+    if args.before:
+        variants.insert(0, (args.before, args.before))
+
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, 'epg.xml')
+    try:
+        print('Generating {}MB xmltv with {} channels...'.format(args.size, args.channels))
+        generate(path, args.size, args.channels)
+
+        rows = []
+        for name, rev in variants:
+            worker_args = ['--path', path, '--channels', str(args.channels)]
+            if rev:
+                worker_args += ['--rev', rev]
+            if not args.orphans:
+                worker_args.append('--no-orphans')
+
+            results = [bench_common.run_worker(__file__, worker_args) for _ in range(args.repeat)]
+            best = max(results, key=lambda x: x['mb_s'])
+            best['peak_rss_mb'] = max(x['peak_rss_mb'] for x in results)
+            best['variant'] = name
+            rows.append(best)
+
+        bench_common.print_table(rows, ['variant', 'secs', 'mb_s', 'peak_rss_mb', 'out_mb', 'count', 'md5'])
+        if len(set(row['md5'] for row in rows)) > 1:
+            print('WARNING: output differs between variants')
+            return 1
+    finally:
+        os.remove(path)
+        os.rmdir(tmp_dir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,184 @@
+"""Benchmarks the m3u playlist tokenizer against synthetic playlists
+
+Measures time, channels/s and peak RSS of the current code and optionally of another git revision, eg.
+    python tools/bench_m3u.py --channels 1000 10000 100000 --before d4b3ef7
+
+Revisions without resources/lib/m3u.py run the old per line loop from merger._process_playlist with that
+revision's models.parse_attribs. Peewee Channel construction is left out of both so only tokenizing is compared.
+The md5 of the parsed channels must match across variants.
+"""
+import io
+import os
+import sys
+import json
+import codecs
+import random
+import hashlib
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import bench_common
+
+
+M3U_PATH = os.path.join('resources', 'lib', 'm3u.py')
+MODELS_PATH = os.path.join('resources', 'lib', 'models.py')
+
+
+def generate(path, channels, seed=1):
+    rand = random.Random(seed)
+    with codecs.open(path, 'w', encoding='utf8') as f:
+        f.write(u'#EXTM3U x-tvg-url="http://example.com/epg.xml.gz" tvg-shift="1"\n')
+        for i in range(channels):
+            group = u';'.join(u'Group {}'.format(rand.randint(1, 50)) for _ in range(rand.randint(1, 2)))
+            f.write(u'#EXTINF:-1 tvg-id="ch{0}.bench" tvg-name="Channel {0}" tvg-logo="http://example.com/logo/{0}.png" group-title="{1}" tvg-chno="{0}",Channel {0} é\n'.format(i, group))
+            if i % 7 == 0:
+                f.write(u'#EXTGRP:Extra;\'Quoted\'\n')
+            if i % 5 == 0:
+                f.write(u'#KODIPROP:inputstream=inputstream.adaptive\n')
+                f.write(u'#KODIPROP:inputstream.adaptive.manifest_type=mpd\n')
+            f.write(u'http://example.com/live/{0}.m3u8?token={1:x}\n'.format(i, rand.getrandbits(64)))
+
+
+def current(ns, path):
+    # mirrors merger._process_playlist
+    with io.open(path, 'r', encoding='utf8', errors='replace') as f:
+        for record in ns['parse'](f):
+            if isinstance(record, ns['Header']) or not record.url:
+                continue
+            yield record.info, record.extgroups, record.properties, record.url
+
+
+def legacy(ns, path):
+    # mirrors the d4b3ef7 _process_playlist line loop and Channel.load_extinf
+    parse_attribs, strip_quotes = ns['parse_attribs'], ns['strip_quotes']
+
+    channel = None
+    with codecs.open(path, 'r', encoding='utf8', errors='replace') as infile:
+        for line in infile:
+            line = line.strip()
+
+            if '#EXTM3U' in line:
+                parse_attribs(line)
+
+            if not channel:
+                channel = {'properties': {}}
+                extgroups = []
+
+            if line.startswith('#EXTINF'):
+                attribs, extinf = parse_attribs(line)
+                chunks = extinf.split(',', 1)
+                name = chunks[1].strip() or None if len(chunks) == 2 else None
+                try:
+                    chno = int(attribs.pop('tvg-chno'))
+                except:
+                    chno = None
+                groups = attribs.pop('group-title', '').strip()
+                channel['info'] = {
+                    'name': name,
+                    'radio': attribs.pop('radio', 'false').lower() == 'true',
+                    'chno': chno,
+                    'groups': groups.split(';') if groups else [],
+                    'epg_id': attribs.pop('tvg-id', None) or attribs.get('tvg-name') or name,
+                    'logo': attribs.pop('tvg-logo', None),
+                    'attribs': attribs,
+                }
+
+            elif line.startswith('#EXTGRP'):
+                value = line.split(':',1)[1].strip()
+                if value:
+                    extgroups.extend([strip_quotes(x) for x in value.split(';')])
+
+            elif line.startswith('#KODIPROP') or line.startswith('#EXTVLCOPT'):
+                value = line.split(':',1)[1].strip()
+                if value and '=' in value:
+                    key, value = value.split('=', 1)
+                    channel['properties'][key] = value
+
+            elif not line.startswith('#'):
+                if not line:
+                    channel = None
+                    continue
+
+                yield channel['info'], extgroups, channel['properties'], line
+                channel = None
+
+
+def worker(args):
+    source = bench_common.read_source(M3U_PATH, args.rev)
+    if source is not None:
+        ns = bench_common.load(source, ['ATTRIBUTE_PATTERN', 'strip_quotes', 'parse_attribs', 'parse_extinf', 'Header', 'Entry', 'parse'])
+        func = current
+    else:
+        ns = bench_common.load(bench_common.read_source(MODELS_PATH, args.rev), ['ATTRIBUTELISTPATTERN', 'strip_quotes', 'parse_attribs'])
+        func = legacy
+
+    md5 = hashlib.md5()
+    count = 0
+    with bench_common.Timer() as timer:
+        for info, extgroups, properties, url in func(ns, args.path):
+            count += 1
+            if args.verify:
+                md5.update(json.dumps([info, extgroups, properties, url], sort_keys=True).encode('utf8'))
+
+    bench_common.report({
+        'secs': round(timer.took, 3),
+        'ch_s': int(count / timer.took),
+        'peak_rss_mb': round(bench_common.peak_rss_mb(), 1),
+        'parsed': count,
+        'md5': md5.hexdigest() if args.verify else '',
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--channels', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--before', help='git revision to compare against')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per variant. best is reported')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--path', help=argparse.SUPPRESS)
+    parser.add_argument('--rev', help=argparse.SUPPRESS)
+    parser.add_argument('--verify', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        return worker(args)
+
+    variants = [('current', None)]
+    if args.before:
+        variants.insert(0, (args.before, args.before))
+
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, 'playlist.m3u')
+    rows = []
+    failed = False
+    try:
+        for channels in args.channels:
+            generate(path, channels)
+            size_mb = round(os.path.getsize(path) / (1024.0 * 1024), 1)
+
+            digests = set()
+            for name, rev in variants:
+                worker_args = ['--path', path] + (['--rev', rev] if rev else [])
+                # hashing every channel would dominate the timing so it's a separate run
+                digests.add(bench_common.run_worker(__file__, worker_args + ['--verify'])['md5'])
+
+                results = [bench_common.run_worker(__file__, worker_args) for _ in range(args.repeat)]
+                best = min(results, key=lambda x: x['secs'])
+                best.update(variant=name, channels=channels, size_mb=size_mb, peak_rss_mb=max(x['peak_rss_mb'] for x in results))
+                rows.append(best)
+
+            if len(digests) > 1:
+                print('WARNING: parsed channels differ between variants for {} channels'.format(channels))
+                failed = True
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+        os.rmdir(tmp_dir)
+
+    bench_common.print_table(rows, ['channels', 'size_mb', 'variant', 'secs', 'ch_s', 'peak_rss_mb', 'parsed'])
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,12 +2,17 @@ ACTION_EXIT = (10,)
 ACTION_BACK = (9, 92, 216, 247, 257, 275, 61467, 61448,)
 ACTION_CONTEXT_MENU = (117,)
 ACTION_SHOW_INFO = (11,)
+ACTION_MOVE = (1, 2, 3, 4, 5, 6, 104, 105, 106, 107,)
 
 SEARCHBUTTON = 990
 SEARCHCATEGORY = 991
 NORESULTS = 999
 MENU = 9000
 
+SEARCH_WORKERS = 4
+PAGE_SIZE = 50
+PAGE_PRELOAD = 10
+
 MOVIELABELS = ["genre", "country", "year", "top250", "setid", "rating", "userrating", "playcount", "director", "mpaa", "plot", "plotoutline", "title", "originaltitle", "sorttitle",
                "runtime", "studio", "tagline", "writer", "premiered", "set", "imdbnumber", "lastplayed", "votes", "trailer", "dateadded", "streamdetails", "art", "file", "resume"]
 
@@ -0,0 +1,105 @@
+import re
+from time import time
+from threading import Lock
+from datetime import datetime, timedelta
+
+from slyguy.log import log
+
+from .index import json_rpc, json_rpc_batch
+
+
+# kodi sends no notification when guide data changes so the index just expires.
+# it only lives as long as the search window's script anyway
+EPG_INDEX_EXPIRY = 60*30
+EPG_BATCH_SIZE = 50
+BROADCAST_PROPERTIES = ['starttime', 'endtime', 'runtime', 'genre', 'plot']
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class Index(object):
+    data = None
+    expires = 0
+_index = Index()
+_lock = Lock()
+
+
+def get_channels():
+    result = json_rpc('PVR.GetChannelGroups', {'channeltype': 'tv'}).get('result') or {}
+    group_ids = [x['channelgroupid'] for x in result.get('channelgroups') or []]
+
+    # channels are in multiple groups, so dedupe on id
+    channels = {}
+    for result in json_rpc_batch([('PVR.GetChannels', {'channelgroupid': x, 'properties': ['channel', 'thumbnail']}) for x in group_ids]):
+        for channel in (result or {}).get('channels') or []:
+            channels[channel['channelid']] = channel
+
+    return [channels[x] for x in sorted(channels)]
+
+
+def _build(channels):
+    # title -> [(channel index, starttime, endtime, runtime, genre, plot), ...]
+    # many broadcasts share a title (news, repeats) so searches only need to check each title once
+    titles = {}
+    count = 0
+    for i in range(0, len(channels), EPG_BATCH_SIZE):
+        batch = channels[i:i+EPG_BATCH_SIZE]
+        results = json_rpc_batch([('PVR.GetBroadcasts', {'channelid': x['channelid'], 'properties': BROADCAST_PROPERTIES}) for x in batch])
+        for index, result in enumerate(results, start=i):
+            for item in (result or {}).get('broadcasts') or []:
+                titles.setdefault(item['label'], []).append((index, item['starttime'], item['endtime'], item['runtime'], (item.get('genre') or [''])[0], item['plot']))
+                count += 1
+
+    log.debug('EPG Index: {} broadcasts with {} unique titles over {} channels'.format(count, len(titles), len(channels)))
+    return titles
+
+
+def get_index():
+    """Returns (channels, titles). Both are cached together so repeat searches don't touch PVR at all
+    Kept here instead of mem_cache as large guides are well over its size cap
+    """
+    with _lock:
+        if _index.data is None or _index.expires < time():
+            channels = get_channels()
+            _index.data = (channels, _build(channels))
+            _index.expires = time() + EPG_INDEX_EXPIRY
+        return _index.data
+
+
+def search(query, hours=0):
+    """Returns [(channel, broadcast), ...] of broadcasts with a title matching query
+    hours > 0 only returns broadcasts that haven't finished and start within that many hours
+    """
+    try:
+        pattern = re.compile(query, re.I)
+    except re.error:
+        pattern = re.compile(re.escape(query), re.I)
+
+    channels, titles = get_index()
+
+    start = end = None
+    if hours:
+        now = datetime.utcnow()
+        start = now.strftime(TIME_FORMAT)
+        end = (now + timedelta(hours=hours)).strftime(TIME_FORMAT)
+
+    matches = []
+    for title in titles:
+        if not pattern.search(title):
+            continue
+
+        for index, starttime, endtime, runtime, genre, plot in titles[title]:
+            if start and (endtime < start or starttime > end):
+                continue
+
+            matches.append((index, starttime, channels[index], {
+                'label': title,
+                'starttime': starttime,
+                'endtime': endtime,
+                'runtime': runtime,
+                'genre': genre,
+                'plot': plot,
+            }))
+
+    # channel order from get_channels, then start time
+    matches.sort(key=lambda x: x[:2])
+    return [(x[2], x[3]) for x in matches]
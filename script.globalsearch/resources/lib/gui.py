@@ -1,7 +1,8 @@
 import json
-import operator
 import re
-from difflib import SequenceMatcher
+import threading
+
+from six.moves import queue
 
 from kodi_six import xbmc, xbmcgui
 
@@ -12,9 +13,52 @@ from slyguy.mem_cache import cached
 
 from .defs import *
 from .settings import settings
+from . import index, epg
 
 
 LANGUAGE = ADDON.getLocalizedString
+NORMALISE_PATTERN = re.compile(r'[^\w\s]+', re.U)
+
+
+def normalise(string):
+    return ' '.join(NORMALISE_PATTERN.sub('', string.lower()).split())
+
+
+def rank_key(search):
+    # cheap smart search ordering. exact, then prefix, then every word prefixing a title word, then the rest
+    # shorter titles first within each rank
+    query = normalise(search)
+    words = query.split()
+
+    def key(label):
+        title = normalise(label)
+        if title == query:
+            rank = 0
+        elif title.startswith(query):
+            rank = 1
+        else:
+            title_words = title.split()
+            rank = 2 if all(any(x.startswith(word) for x in title_words) for word in words) else 3
+        return rank, len(title), title
+    return key
+
+
+class Pager(object):
+    """Fetches a category's results a page at a time. fetch(start, end) returns (items, total)"""
+    def __init__(self, fetch):
+        self._fetch = fetch
+        self.start = 0
+        self.total = 0
+        self.first = self.next()
+
+    def next(self):
+        items, self.total = self._fetch(self.start, self.start + PAGE_SIZE)
+        self.start += PAGE_SIZE
+        return items
+
+    @property
+    def more(self):
+        return self.start < self.total
 
 
 class GUI(xbmcgui.WindowXML):
@@ -45,7 +89,7 @@ class GUI(xbmcgui.WindowXML):
                 self._load_favourites()
             self._reset_variables()
             self._init_items()
-            self.menu.reset()
+            self._reset_menu()
             self._set_view()
             self._fetch_items()
 
@@ -107,8 +151,41 @@ class GUI(xbmcgui.WindowXML):
         cats = []
         for key, value in sorted(CATEGORIES.items(), key=lambda x: x[1]['order']):
             if CATEGORIES[key]['enabled']:
-                self._get_items(CATEGORIES[key], self.searchstring)
                 cats.append(CATEGORIES[key])
+
+        # query categories concurrently and show each one as soon as it arrives
+        tasks = queue.Queue()
+        results = queue.Queue()
+        for cat in cats:
+            tasks.put(cat)
+
+        def worker():
+            while True:
+                try:
+                    cat = tasks.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    results.put((cat, self._query_items(cat, self.searchstring)))
+                except Exception as e:
+                    results.put((cat, e))
+
+        for i in range(min(SEARCH_WORKERS, len(cats))):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+
+        waiting = list(cats)
+        while waiting:
+            self.getControl(SEARCHCATEGORY).setLabel(xbmc.getLocalizedString(waiting[0]['label']))
+            self.getControl(SEARCHCATEGORY).setVisible(True)
+            cat, result = results.get()
+            waiting.remove(cat)
+            if isinstance(result, Exception):
+                log.exception(result)
+                continue
+            self._show_items(cat, self.searchstring, result)
+
         self.history[self.level] = {'cats':cats, 'search':self.searchstring}
         self._check_focus()
 
@@ -128,10 +205,63 @@ class GUI(xbmcgui.WindowXML):
             _rules.append('{{"field":"tag", "operator":"contains", "value":"{query}"}}')
         return rule.replace("[[RULES]]", '{{{{"or":[{}]}}}}'.format(', '.join(_rules)))
 
+    def _index_fields(self, cat):
+        if cat['type'] in ('actors', 'tvactors'):
+            return ['cast']
+        elif cat['type'] == 'directors':
+            return ['director']
+        elif cat['type'] in ('movies', 'tvshows', 'episodes'):
+            fields = []
+            if settings.getBool('search_title'):
+                fields.append('title')
+            if settings.getBool('search_originaltitle'):
+                fields.append('originaltitle')
+            if settings.getBool('search_tags'):
+                fields.append('tag')
+            return fields
+        elif cat['type'] == 'musicvideos':
+            return ['title', 'artist']
+        elif cat['type'] == 'artists':
+            return ['artist']
+        elif cat['type'] in ('albums', 'songs'):
+            return ['title']
+        return None
+
+    def _index_search(self, cat, search):
+        # resolves top level searches to [(id, label), ...] from the local index
+        # returns None to fall back to a JSON-RPC library search
+        if self.level > 1 or type(search) != str or not settings.getBool('use_index', True):
+            return None
+
+        fields = self._index_fields(cat)
+        if not fields:
+            return None
+
+        try:
+            return index.search(cat['content'], fields, search)
+        except Exception as e:
+            log.exception(e)
+            return None
+
+    def _index_query(self, cat, search):
+        # only fetches details of the index matches
+        ids = self._index_search(cat, search)
+
+        if ids is None:
+            return None
+
+        items = index.get_details(cat['content'], [x[0] for x in ids], cat['properties'])
+        return {'result': {cat['content']: items}}
+
     def _get_items(self, cat, search):
+        self.getControl(SEARCHCATEGORY).setLabel(xbmc.getLocalizedString(cat['label']))
+        self.getControl(SEARCHCATEGORY).setVisible(True)
+        self._show_items(cat, search, self._query_items(cat, search))
+
+    def _query_items(self, cat, search):
+        # no gui calls in here as it's run from worker threads
         if cat['content'] == 'livetv':
-            self._fetch_channelgroups(cat)
-            return
+            return self._query_livetv(cat)
         if cat['type'] == 'seasonepisodes':
             search = search[0], search[1]
             rule = self._get_rule(cat['rule']).format(query0 = search[0], query1 = search[1])
@@ -139,30 +269,127 @@ class GUI(xbmcgui.WindowXML):
             rule = ''
         else:
             rule = self._get_rule(cat['rule']).format(query = search)
-        self.getControl(SEARCHCATEGORY).setLabel(xbmc.getLocalizedString(cat['label']))
-        self.getControl(SEARCHCATEGORY).setVisible(True)
 
-        #TODO: Pagination for faster more responsive results
-        json_response = self._cached_json_rpc('{"jsonrpc":"2.0", "method":"%s", "params":{"properties":%s, "sort":{"method":"%s"}%s}, "id": 1}' % (cat['method'], json.dumps(cat['properties']), cat['sort'], ', '+rule if rule else ''))
+        if cat['type'] not in ('actors', 'directors', 'tvactors'):
+            return self._query_pages(cat, search, rule)
+
+        # actors / directors are aggregated over every match so aren't paged
+        json_response = self._index_query(cat, search)
+        if json_response is None:
+            json_response = self._cached_json_rpc('{"jsonrpc":"2.0", "method":"%s", "params":{"properties":%s, "sort":{"method":"%s"}%s}, "id": 1}' % (cat['method'], json.dumps(cat['properties']), cat['sort'], ', '+rule if rule else ''))
         if callable(cat['rule']):
             json_response = cat['rule'](search, json_response)
+        return json_response
+
+    def _query_pages(self, cat, search, rule):
+        ranked = settings.getBool('smart_search', True) and type(search) == str
+        matches = self._index_search(cat, search)
+
+        if matches is None and not ranked and not callable(cat['rule']):
+            # kodi already sorts, so just page through it with limits
+            def fetch(start, end):
+                json_response = self._cached_json_rpc('{"jsonrpc":"2.0", "method":"%s", "params":{"properties":%s, "sort":{"method":"%s"}, "limits":{"start":%d, "end":%d}%s}, "id": 1}' % (cat['method'], json.dumps(cat['properties']), cat['sort'], start, end, ', '+rule if rule else ''))
+                result = json_response.get('result') or {}
+                return result.get(cat['content']) or [], result.get('limits', {}).get('total', 0)
+            return Pager(fetch)
+
+        if matches is None:
+            # only ids and labels of every match. details are fetched per page below
+            properties = ['title'] if callable(cat['rule']) else []
+            json_response = self._cached_json_rpc('{"jsonrpc":"2.0", "method":"%s", "params":{"properties":%s, "sort":{"method":"%s"}%s}, "id": 1}' % (cat['method'], json.dumps(properties), cat['sort'], ', '+rule if rule else ''))
+            if callable(cat['rule']):
+                json_response = cat['rule'](search, json_response)
+            id_key = index.DETAILS[cat['content']][1]
+            matches = [(x[id_key], x['label']) for x in (json_response.get('result') or {}).get(cat['content']) or []]
+        elif not ranked:
+            matches.sort(key=lambda x: x[1].lower())
+
+        if ranked:
+            key = rank_key(search)
+            matches.sort(key=lambda x: key(x[1]))
+
+        ids = [x[0] for x in matches]
+        return Pager(lambda start, end: (index.get_details(cat['content'], ids[start:end], cat['properties']), len(ids)))
+
+    def _show_items(self, cat, search, json_response):
+        if cat['content'] == 'livetv':
+            self._show_livetv(cat, json_response)
+            return
+        if cat['type'] == 'seasonepisodes':
+            search = search[0], search[1]
+        pager = None
+        if isinstance(json_response, Pager):
+            pager = json_response
+            json_response = {'result': {cat['content']: pager.first}}
         listitems = []
-        actors = {}
-        directors = {}
         if self.level > 1:
             listitem = xbmcgui.ListItem('..', offscreen=True)
             listitem.setArt({'icon':'DefaultFolderBack.png'})
             listitems.append(listitem)
+        listitems.extend(self._make_listitems(cat, search, json_response))
+        if len(listitems) > 0:
+            if pager:
+                numitems = str(pager.total)
+            elif self.level > 1:
+                numitems = str(len(listitems) - 1)
+            else:
+                numitems = str(len(listitems))
+            if cat['type'] != 'actors' and cat['type'] != 'tvactors':
+                menuitem = xbmcgui.ListItem(xbmc.getLocalizedString(cat['label']), numitems, offscreen=True)
+            else:
+                menuitem = xbmcgui.ListItem(LANGUAGE(cat['label']), numitems, offscreen=True)
+            menuitem.setArt({'icon':cat['menuthumb']})
+            menuitem.setProperty('type', cat['type'])
+            if cat['type'] != 'actors' and cat['type'] != 'directors' and cat['type'] != 'tvactors':
+                menuitem.setProperty('content', cat['content'])
+            elif cat['type'] == 'actors' or cat['type'] == 'tvactors':
+                menuitem.setProperty('content', 'actors')
+            elif cat['type'] == 'directors':
+                menuitem.setProperty('content', 'directors')
+            self._add_menuitem(cat, menuitem)
+            if self.navback:
+                self.menu.selectItem(self.history[self.level]['menuposition'])
+            self.content[cat['type']] = listitems
+            if pager and pager.more:
+                self.pagers[cat['type']] = (cat, search, pager)
+            if self.navback and self.focusset == 'false':
+                if self.history[self.level]['menutype'] == cat['type']:
+                    if cat['type'] != 'actors' and cat['type'] != 'directors' and cat['type'] != 'tvactors':
+                        self.setContent(cat['content'])
+                    elif cat['type'] == 'actors' or cat['type'] == 'tvactors':
+                        self.setContent('actors')
+                    elif cat['type'] == 'directors':
+                        self.setContent('directors')
+                    # load enough pages to get back to where we were
+                    while pager and pager.more and len(listitems) <= self.history[self.level]['containerposition']:
+                        self._next_page(cat, search, pager)
+                    self.addItems(listitems)
+                    # wait for items to be added before we can set focus
+                    xbmc.sleep(100)
+                    self.setCurrentListPosition(self.history[self.level]['containerposition'])
+                    self.menutype = cat['type']
+                    self.focusset = 'true'
+            elif self.focusset == 'false':
+                if cat['type'] != 'actors' and cat['type'] != 'directors' and cat['type'] != 'tvactors':
+                    self.setContent(cat['content'])
+                elif cat['type'] == 'actors' or cat['type'] == 'tvactors':
+                    self.setContent('actors')
+                elif cat['type'] == 'directors':
+                    self.setContent('directors')
+                self.addItems(listitems)
+                # wait for items to be added before we can set focus
+                xbmc.sleep(100)
+                self.setFocusId(self.getCurrentContainerId())
+                self.menutype = cat['type']
+                self.focusset = 'true'
+            process_support()
+
+    def _make_listitems(self, cat, search, json_response):
+        listitems = []
+        actors = {}
+        directors = {}
         if 'result' in json_response and(json_response['result'] != None) and cat['content'] in json_response['result']:
             results = json_response['result'][cat['content']]
-            if settings.getBool('smart_search', True) and type(search) == str:
-                results = sorted(results,
-                                 key = lambda x: SequenceMatcher(None,
-                                                    search.lower().strip().replace(' ', ''),
-                                                    x['label'].lower().strip().replace(' ', '')
-                                                ).ratio(),
-                                 reverse = True)
-
             for item in results:
                 if cat['type'] == 'actors' or cat['type'] == 'tvactors':
                     for item in item['cast']:
@@ -244,118 +471,40 @@ class GUI(xbmcgui.WindowXML):
                     listitem.setArt({'icon':cat['icon'], 'thumb':val['thumb']})
                     listitem.setProperty('content', cat['type'])
                     listitems.append(listitem)
-        if len(listitems) > 0:
-            if self.level > 1:
-                numitems = str(len(listitems) - 1)
-            else:
-                numitems = str(len(listitems))
-            if cat['type'] != 'actors' and cat['type'] != 'tvactors':
-                menuitem = xbmcgui.ListItem(xbmc.getLocalizedString(cat['label']), numitems, offscreen=True)
-            else:
-                menuitem = xbmcgui.ListItem(LANGUAGE(cat['label']), numitems, offscreen=True)
-            menuitem.setArt({'icon':cat['menuthumb']})
-            menuitem.setProperty('type', cat['type'])
-            if cat['type'] != 'actors' and cat['type'] != 'directors' and cat['type'] != 'tvactors':
-                menuitem.setProperty('content', cat['content'])
-            elif cat['type'] == 'actors' or cat['type'] == 'tvactors':
-                menuitem.setProperty('content', 'actors')
-            elif cat['type'] == 'directors':
-                menuitem.setProperty('content', 'directors')
-            self.menu.addItem(menuitem)
-            if self.navback:
-                self.menu.selectItem(self.history[self.level]['menuposition'])
-            self.content[cat['type']] = listitems
-            if self.navback and self.focusset == 'false':
-                if self.history[self.level]['menutype'] == cat['type']:
-                    if cat['type'] != 'actors' and cat['type'] != 'directors' and cat['type'] != 'tvactors':
-                        self.setContent(cat['content'])
-                    elif cat['type'] == 'actors' or cat['type'] == 'tvactors':
-                        self.setContent('actors')
-                    elif cat['type'] == 'directors':
-                        self.setContent('directors')
-                    self.addItems(listitems)
-                    # wait for items to be added before we can set focus
-                    xbmc.sleep(100)
-                    self.setCurrentListPosition(self.history[self.level]['containerposition'])
-                    self.menutype = cat['type']
-                    self.focusset = 'true'
-            elif self.focusset == 'false':
-                if cat['type'] != 'actors' and cat['type'] != 'directors' and cat['type'] != 'tvactors':
-                    self.setContent(cat['content'])
-                elif cat['type'] == 'actors' or cat['type'] == 'tvactors':
-                    self.setContent('actors')
-                elif cat['type'] == 'directors':
-                    self.setContent('directors')
-                self.addItems(listitems)
-                # wait for items to be added before we can set focus
-                xbmc.sleep(100)
-                self.setFocusId(self.getCurrentContainerId())
-                self.menutype = cat['type']
-                self.focusset = 'true'
-            process_support()
+        return listitems
 
-    def _fetch_channelgroups(self, cat):
-        self.getControl(SEARCHCATEGORY).setLabel(xbmc.getLocalizedString(19069))
-        self.getControl(SEARCHCATEGORY).setVisible(True)
-        channelgrouplist = []
-        json_response = self._cached_json_rpc('{"jsonrpc":"2.0", "method":"PVR.GetChannelGroups", "params":{"channeltype":"tv"}, "id":1}')
-        if('result' in json_response) and(json_response['result'] != None) and('channelgroups' in json_response['result']):
-            for item in json_response['result']['channelgroups']:
-                channelgrouplist.append(item['channelgroupid'])
-            if channelgrouplist:
-                self._fetch_channels(cat, channelgrouplist)
-
-    def _fetch_channels(self, cat, channelgrouplist):
-        # get all channel id's
-        channellist = []
-        for channelgroupid in channelgrouplist:
-            json_response = self._cached_json_rpc('{"jsonrpc":"2.0", "method":"PVR.GetChannels", "params":{"channelgroupid":%i, "properties":["channel", "thumbnail"]}, "id":1}' % channelgroupid)
-            if('result' in json_response) and(json_response['result'] != None) and('channels' in json_response['result']):
-                for item in json_response['result']['channels']:
-                    channellist.append(item)
-        if channellist:
-            # remove duplicates
-            channels = [dict(tuples) for tuples in set(tuple(item.items()) for item in channellist)]
-            # sort
-            channels.sort(key=operator.itemgetter('channelid'))
-            self._fetch_livetv(cat, channels)
-
-    def _fetch_livetv(self, cat, channels):
+    def _query_livetv(self, cat):
+        return epg.search(self.searchstring, settings.getInt('livetv_hours', 0))
+
+    def _show_livetv(self, cat, matches):
         listitems = []
-        # get all programs for every channel id
-        for channel in channels:
+        for channel, item in matches:
             channelid = channel['channelid']
             channelname = channel['label']
             channelthumb = channel['thumbnail']
-            json_response = self._cached_json_rpc('{"jsonrpc":"2.0", "method":"PVR.GetBroadcasts", "params":{"channelid":%i, "properties":["starttime", "endtime", "runtime", "genre", "plot"]}, "id":1}' % channelid)
-            if('result' in json_response) and(json_response['result'] != None) and('broadcasts' in json_response['result']):
-                for item in json_response['result']['broadcasts']:
-                    broadcastname = item['label']
-                    livetvmatch = re.search('.*' + self.searchstring + '.*', broadcastname, re.I)
-                    if livetvmatch:
-                        broadcastid = item['broadcastid']
-                        duration = item['runtime']
-                        genre = item['genre'][0]
-                        plot = item['plot']
-                        starttime = item['starttime']
-                        endtime = item['endtime']
-                        listitem = xbmcgui.ListItem(label=broadcastname, offscreen=True)
-                        listitem.setArt({'icon':'DefaultFolder.png', 'thumb':channelthumb})
-                        listitem.setProperty("icon", channelthumb)
-                        listitem.setProperty("genre", genre)
-                        listitem.setProperty("plot", plot)
-                        listitem.setProperty("starttime", starttime)
-                        listitem.setProperty("endtime", endtime)
-                        listitem.setProperty("duration", str(duration))
-                        listitem.setProperty("channelname", channelname)
-                        listitem.setProperty("dbid", str(channelid))
-                        listitems.append(listitem)
+            broadcastname = item['label']
+            duration = item['runtime']
+            genre = item['genre']
+            plot = item['plot']
+            starttime = item['starttime']
+            endtime = item['endtime']
+            listitem = xbmcgui.ListItem(label=broadcastname, offscreen=True)
+            listitem.setArt({'icon':'DefaultFolder.png', 'thumb':channelthumb})
+            listitem.setProperty("icon", channelthumb)
+            listitem.setProperty("genre", genre)
+            listitem.setProperty("plot", plot)
+            listitem.setProperty("starttime", starttime)
+            listitem.setProperty("endtime", endtime)
+            listitem.setProperty("duration", str(duration))
+            listitem.setProperty("channelname", channelname)
+            listitem.setProperty("dbid", str(channelid))
+            listitems.append(listitem)
         if len(listitems) > 0:
             menuitem = xbmcgui.ListItem(xbmc.getLocalizedString(cat['label']), offscreen=True)
             menuitem.setArt({'icon':cat['menuthumb']})
             menuitem.setProperty('type', cat['type'])
             menuitem.setProperty('content', cat['content'])
-            self.menu.addItem(menuitem)
+            self._add_menuitem(cat, menuitem)
             self.content[cat['type']] = listitems
             if self.focusset == 'false':
                 self.setContent(cat['content'])
@@ -365,6 +514,43 @@ class GUI(xbmcgui.WindowXML):
                 self.setFocusId(self.getCurrentContainerId())
                 self.focusset = 'true'
 
+    def _reset_menu(self):
+        self.menu.reset()
+        self.menuitems = []
+        self.pagers = {}
+
+    def _next_page(self, cat, search, pager):
+        listitems = self._make_listitems(cat, search, {'result': {cat['content']: pager.next()}})
+        if not pager.more:
+            self.pagers.pop(cat['type'], None)
+        self.content[cat['type']].extend(listitems)
+        return listitems
+
+    def _load_more(self):
+        # materialises the next page once the list is scrolled near its end
+        paging = self.pagers.get(getattr(self, 'menutype', None))
+        if not paging or self.getFocusId() != self.getCurrentContainerId():
+            return
+        if self.getCurrentListPosition() < self.getListSize() - PAGE_PRELOAD:
+            return
+        self.addItems(self._next_page(*paging))
+
+    def _add_menuitem(self, cat, menuitem):
+        # categories can arrive in any order. keep the menu in category order
+        self.menuitems.append((cat['order'], menuitem))
+        self.menuitems.sort(key=lambda x: x[0])
+        position = [x[1] for x in self.menuitems].index(menuitem)
+        if position == len(self.menuitems) - 1:
+            self.menu.addItem(menuitem)
+            return
+
+        selected = self.menu.getSelectedPosition()
+        self.menu.reset()
+        self.menu.addItems([x[1] for x in self.menuitems])
+        if selected >= position:
+            selected += 1
+        self.menu.selectItem(max(selected, 0))
+
     def _update_list(self, item, content):
         self.clearList()
         # we need some sleep, else the correct container layout won't be loaded
@@ -476,7 +662,7 @@ class GUI(xbmcgui.WindowXML):
         self._reset_variables()
         self._hide_controls()
         self.clearList()
-        self.menu.reset()
+        self._reset_menu()
         self.oldfocus = 0
         self.level += 1
         self.history[self.level - 1]['menuposition']  = self.menuposition
@@ -657,7 +843,7 @@ class GUI(xbmcgui.WindowXML):
         self._reset_variables()
         self._hide_controls()
         self.clearList()
-        self.menu.reset()
+        self._reset_menu()
         self.oldfocus = 0
         cats = self.history[self.level]['cats']
         search = self.history[self.level]['search']
@@ -669,7 +855,7 @@ class GUI(xbmcgui.WindowXML):
     def _new_search(self):
         self.searchstring = search()
         if self.searchstring:
-            self.menu.reset()
+            self._reset_menu()
             self.oldfocus = 0
             self.clearList()
             self.onInit()
@@ -736,6 +922,9 @@ class GUI(xbmcgui.WindowXML):
             self._new_search()
 
     def onAction(self, action):
+        if action.getId() in ACTION_MOVE:
+            self._load_more()
+
         if action.getId() in ACTION_EXIT:
             self._close()
 
@@ -0,0 +1,238 @@
+import os
+import re
+import json
+import unicodedata
+from threading import Lock
+
+import peewee
+from kodi_six import xbmc
+
+from slyguy import database
+from slyguy.log import log
+from slyguy.constants import ADDON_PROFILE
+
+
+INDEX_PATH = os.path.join(ADDON_PROFILE, 'index.db')
+BATCH_SIZE = 200
+
+# content -> (list method, details method, id key, indexed fields)
+SOURCES = {
+    'movies': ('VideoLibrary.GetMovies', 'VideoLibrary.GetMovieDetails', 'movieid', ['title', 'originaltitle', 'tag', 'cast', 'director']),
+    'tvshows': ('VideoLibrary.GetTVShows', 'VideoLibrary.GetTVShowDetails', 'tvshowid', ['title', 'originaltitle', 'tag', 'cast']),
+    'episodes': ('VideoLibrary.GetEpisodes', 'VideoLibrary.GetEpisodeDetails', 'episodeid', ['title', 'originaltitle']),
+    'musicvideos': ('VideoLibrary.GetMusicVideos', 'VideoLibrary.GetMusicVideoDetails', 'musicvideoid', ['title', 'artist']),
+    'artists': ('AudioLibrary.GetArtists', 'AudioLibrary.GetArtistDetails', 'artistid', ['artist']),
+    'albums': ('AudioLibrary.GetAlbums', 'AudioLibrary.GetAlbumDetails', 'albumid', ['title']),
+    'songs': ('AudioLibrary.GetSongs', 'AudioLibrary.GetSongDetails', 'songid', ['title']),
+}
+
+# content -> (details method, id key). includes content that isn't indexed
+DETAILS = dict((content, (SOURCES[content][1], SOURCES[content][2])) for content in SOURCES)
+DETAILS.update({
+    'sets': ('VideoLibrary.GetMovieSetDetails', 'setid'),
+    'seasons': ('VideoLibrary.GetSeasonDetails', 'seasonid'),
+})
+
+# library notification item type -> content
+TYPES = {
+    'movie': 'movies',
+    'tvshow': 'tvshows',
+    'episode': 'episodes',
+    'musicvideo': 'musicvideos',
+    'artist': 'artists',
+    'album': 'albums',
+    'song': 'songs',
+}
+
+# word characters except _ which unicode61 treats as a separator
+TOKEN_PATTERN = re.compile(r'[^\W_]+', re.U)
+
+db = database.init([], INDEX_PATH)
+_lock = Lock()
+_fts = None
+
+
+def json_rpc(method, params):
+    return json.loads(xbmc.executeJSONRPC(json.dumps({'jsonrpc': '2.0', 'method': method, 'params': params, 'id': 1})))
+
+
+def json_rpc_batch(requests):
+    """Sends [(method, params), ...] as a single JSON-RPC batch and returns the results in order"""
+    if not requests:
+        return []
+
+    payload = [{'jsonrpc': '2.0', 'method': method, 'params': params, 'id': i} for i, (method, params) in enumerate(requests)]
+    results = [None] * len(requests)
+    for row in json.loads(xbmc.executeJSONRPC(json.dumps(payload))):
+        if 'result' in row:
+            results[row['id']] = row['result']
+    return results
+
+
+def _table(content):
+    return 'fts_{}'.format(content)
+
+
+def _columns(content):
+    # quoted as cast is a keyword
+    return ', '.join('"{}"'.format(x) for x in SOURCES[content][3])
+
+
+def _fts_available():
+    try:
+        db.execute_sql('CREATE VIRTUAL TABLE temp.fts_probe USING fts4(text, tokenize=unicode61 "remove_diacritics=1")')
+    except peewee.OperationalError as e:
+        log.debug('Search index: fts4 unavailable ({}). Using LIKE'.format(e))
+        return False
+
+    db.execute_sql('DROP TABLE temp.fts_probe')
+    return True
+
+
+def _setup():
+    global _fts
+    if _fts is not None:
+        return
+
+    with _lock:
+        if _fts is not None:
+            return
+
+        fts = _fts_available()
+        db.execute_sql('CREATE TABLE IF NOT EXISTS state (content TEXT PRIMARY KEY, total INTEGER)')
+        for content in SOURCES:
+            # a table left by a sqlite build with / without fts (or an older LIKE table) is dropped and rebuilt
+            row = db.execute_sql('SELECT sql FROM sqlite_master WHERE name = ?', (_table(content),)).fetchone()
+            if row and (('VIRTUAL TABLE' in row[0].upper()) != fts or (not fts and 'label TEXT' not in row[0])):
+                db.execute_sql('DROP TABLE {}'.format(_table(content)))
+                db.execute_sql('DELETE FROM state WHERE content = ?', (content,))
+
+            if fts:
+                db.execute_sql('CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts4({}, tokenize=unicode61 "remove_diacritics=1")'.format(_table(content), _columns(content)))
+            else:
+                # fields hold their folded words (see _words) so LIKE '% word%' matches on word prefix like fts does
+                db.execute_sql('CREATE TABLE IF NOT EXISTS {} (docid INTEGER PRIMARY KEY, label TEXT, {})'.format(_table(content), _columns(content)))
+
+        _fts = fts
+
+
+def _words(text):
+    # same folding as the unicode61 tokenizer. lowercase, diacritics removed, split on non word characters
+    text = unicodedata.normalize('NFKD', text.lower())
+    return TOKEN_PATTERN.findall(u''.join(x for x in text if not unicodedata.combining(x)))
+
+
+def _to_text(value):
+    if isinstance(value, list):
+        # cast is a list of dicts, tag / director / artist are lists of strings
+        value = ' / '.join(x['name'] if isinstance(x, dict) else x for x in value)
+    return value or ''
+
+
+def _rows(content, items):
+    id_key, fields = SOURCES[content][2], SOURCES[content][3]
+    for item in items:
+        if content == 'artists':
+            item.setdefault('artist', item.get('label'))
+        values = [_to_text(item.get(field)) for field in fields]
+        if _fts:
+            yield [item[id_key]] + values
+        else:
+            yield [item[id_key], values[0]] + [u' ' + u' '.join(_words(x)) for x in values]
+
+
+def _insert_sql(content):
+    fields = SOURCES[content][3]
+    if _fts:
+        return 'INSERT INTO {} (docid, {}) VALUES ({})'.format(_table(content), _columns(content), ', '.join('?' * (len(fields) + 1)))
+    else:
+        return 'INSERT INTO {} (docid, label, {}) VALUES ({})'.format(_table(content), _columns(content), ', '.join('?' * (len(fields) + 2)))
+
+
+def _properties(content):
+    return [x for x in SOURCES[content][3] if not (content == 'artists' and x == 'artist')]
+
+
+def _total(content):
+    result = json_rpc(SOURCES[content][0], {'limits': {'start': 0, 'end': 1}}).get('result') or {}
+    return result.get('limits', {}).get('total', 0)
+
+
+def is_ready(content):
+    _setup()
+    return db.execute_sql('SELECT 1 FROM state WHERE content = ?', (content,)).fetchone() is not None
+
+
+def build(content):
+    """Re-indexes all items of content from the library"""
+    _setup()
+    result = json_rpc(SOURCES[content][0], {'properties': _properties(content)}).get('result') or {}
+    items = result.get(content) or []
+
+    with db.atomic():
+        db.execute_sql('DELETE FROM {}'.format(_table(content)))
+        db.cursor().executemany(_insert_sql(content), _rows(content, items))
+        db.execute_sql('REPLACE INTO state (content, total) VALUES (?, ?)', (content, len(items)))
+
+    log.info('Search index: indexed {} {}'.format(len(items), content))
+
+
+def refresh():
+    """Rebuilds any content that isn't indexed yet or whose library total has changed"""
+    _setup()
+    for content in SOURCES:
+        row = db.execute_sql('SELECT total FROM state WHERE content = ?', (content,)).fetchone()
+        if row is None or row[0] != _total(content):
+            build(content)
+
+
+def update(content, ids):
+    """Re-indexes just the given ids. Ids no longer in the library are removed"""
+    if not is_ready(content):
+        return
+
+    ids = list(ids)
+    items = get_details(content, ids, _properties(content))
+
+    with db.atomic():
+        db.cursor().executemany('DELETE FROM {} WHERE docid = ?'.format(_table(content)), [(x,) for x in ids])
+        db.cursor().executemany(_insert_sql(content), _rows(content, items))
+        db.execute_sql('UPDATE state SET total = (SELECT COUNT(*) FROM {}) WHERE content = ?'.format(_table(content)), (content,))
+
+    log.debug('Search index: updated {} {}'.format(len(ids), content))
+
+
+def search(content, fields, query):
+    """Returns [(id, label), ...] of content with any of fields matching every word in query
+    Words match on prefix. Returns None if content isn't indexed or query has no words
+    """
+    tokens = _words(query)
+    fields = [x for x in fields if x in SOURCES[content][3]]
+    if not tokens or not fields or not is_ready(content):
+        return None
+
+    if _fts:
+        # first field is the title (or artist name)
+        select = 'SELECT docid, "{}" FROM {}'.format(SOURCES[content][3][0], _table(content))
+        match = ' '.join('{}*'.format(x) for x in tokens)
+        sql = ' UNION '.join('{} WHERE "{}" MATCH ?'.format(select, field) for field in fields)
+        params = [match] * len(fields)
+    else:
+        # words never contain LIKE wildcards
+        select = 'SELECT docid, label FROM {}'.format(_table(content))
+        sql = ' UNION '.join('{} WHERE {}'.format(select, ' AND '.join(['"{}" LIKE ?'.format(field)] * len(tokens))) for field in fields)
+        params = [u'% {}%'.format(x) for x in tokens] * len(fields)
+
+    return [(row[0], row[1]) for row in db.execute_sql(sql, params)]
+
+
+def get_details(content, ids, properties):
+    """Fetches the library details of ids in batched JSON-RPC calls"""
+    details_method, id_key = DETAILS[content]
+    items = []
+    for i in range(0, len(ids), BATCH_SIZE):
+        requests = [(details_method, {id_key: dbid, 'properties': properties}) for dbid in ids[i:i+BATCH_SIZE]]
+        for result in json_rpc_batch(requests):
+            if result:
+                items.append(result[content[:-1]+'details'])
+    return items
@@ -9,6 +9,8 @@ class Language(BaseLanguage):
     SEARCH_TAGS         = 30004
     CLEAR_HISTORY       = 30005
     HISTORY_CLEARED     = 30006
+    USE_INDEX           = 30007
+    LIVETV_HOURS        = 30008
 
     SEARCH_MOVIES       = 32001
     SEARCH_TV_SHOWS     = 32002
@@ -1,8 +1,9 @@
 from slyguy import plugin
+from slyguy.library import LibraryMonitor
 from slyguy.constants import ROUTE_SCRIPT, ADDON_PATH, ADDON_ID, KODI_VERSION
 from kodi_six import xbmc
 
-from . import gui
+from . import gui, index
 from .language import _
 from .settings import settings
 
@@ -34,3 +35,8 @@ def script(searchstring=None, **kwargs):
     ui = gui.GUI('script-globalsearch.xml', ADDON_PATH, 'default', '1080i', True, searchstring=searchstring, params={})
     ui.doModal()
     del ui
+
+
+def service():
+    monitor = LibraryMonitor(index.TYPES, index.update, index.refresh, libraries=('VideoLibrary', 'AudioLibrary'))
+    monitor.run(enabled=lambda: settings.getBool('use_index', True), error_msg='Search index update failed')
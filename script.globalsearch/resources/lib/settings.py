@@ -17,6 +17,7 @@ class Settings(CommonSettings):
     SEARCH_TITLE = Bool('search_title', _.SEARCH_TITLE, default=True)
     SEARCH_ORIG_TITLE = Bool('search_originaltitle', _.SEARCH_ORIG_TITLE, default=True)
     SEARCH_TAGS = Bool('search_tags', _.SEARCH_TAGS, default=False)
+    USE_INDEX = Bool('use_index', _.USE_INDEX, default=True)
 
     SEARCH_MOVIES = Bool('movies', _.SEARCH_MOVIES, default=True)
     SEARCH_MOVIE_SETS = Bool('moviesets', _.SEARCH_MOVIE_SETS, default=True)
@@ -27,6 +28,7 @@ class Settings(CommonSettings):
     SEARCH_TV_ACTORS = Bool('tvactors', _.SEARCH_TV_ACTORS, default=False)
     SEARCH_MUSIC_VIDEOS = Bool('musicvideos', _.SEARCH_MUSIC_VIDEOS, default=False)
     SEARCH_LIVE_TV = Bool('livetv', _.SEARCH_LIVE_TV, default=False)
+    LIVETV_HOURS = Number('livetv_hours', _.LIVETV_HOURS, default=0, lower_limit=0, upper_limit=336, parent=SEARCH_LIVE_TV)
     SEARCH_ARTISTS = Bool('artists', _.SEARCH_ARTISTS, default=False)
     SEARCH_ALBUMS = Bool('albums', _.SEARCH_ALBUMS, default=False)
     SEARCH_SONGS = Bool('songs', _.SEARCH_SONGS, default=False)
@@ -0,0 +1,3 @@
+from resources.lib import plugin
+
+plugin.service()
@@ -6,3 +6,4 @@ ADDONS_URL = REPO_DOMAIN+'/.repo/addons.json.gz'
 ADDONS_MD5 = REPO_DOMAIN+'/.repo/addons.json.md5'
 NEWS_CHECK_TIME = 3600 #60mins
 UPDATES_CHECK_TIME = 1800 #30mins
+DB_MAINTENANCE_TIME = 86400 #24hours
@@ -2,17 +2,23 @@ import os
 import re
 import time
 import json
+import copy
 import base64
 import shutil
+import select
+import socket
 import binascii
 import threading
 
+import xml.etree.ElementTree as ET
 from xml.dom.minidom import parseString
 from functools import cmp_to_key
+from io import BytesIO
 
 import arrow
+from six import PY2
 from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
-from six.moves.socketserver import ThreadingMixIn
+from six.moves import queue, http_cookiejar
 from six.moves.urllib.parse import urlparse, urljoin, unquote_plus, parse_qsl
 from kodi_six import xbmc
 from pycaption import detect_format, WebVTTWriter
@@ -49,6 +55,10 @@ CODECS = [[re.compile(x[0], re.IGNORECASE), x[1]] for x in CODECS]
 
 ATTRIBUTELISTPATTERN = re.compile(r'''((?:[^,"']|"[^"]*"|'[^']*')+)''')
 DEFAULT_KID_PATTERN = re.compile(':default_KID="([0-9a-fA-F]{32})"')
+MEDIA_SEQUENCE_PATTERN = re.compile(r'#EXT-X-MEDIA-SEQUENCE:\s*(\d+)')
+# whole line urls, or any other line with quotes which may hold attribute urls
+M3U8_URL_PATTERN = re.compile(r'''^(?:(?P<line>(?:/|\.\./|https?://).*)|(?P<quoted>.*".*))$''', re.I|re.M)
+M3U8_ATTRIB_PATTERN = re.compile(r'''(?P<attrib>URI=)?"(?P<value>(?:/|\.\./|https?://)[^"]*)(?P<end>"?)''', re.I)
 
 DEFAULT_SESSION_NAME = 'playback'
 PROXY_GLOBAL = {
@@ -56,6 +66,7 @@ PROXY_GLOBAL = {
     'sessions': {},
     'error_count': 0,
 }
+STATS_LOCK = threading.Lock()
 
 
 class Redirect(Exception):
@@ -127,7 +138,42 @@ def codec_rank(_codecs):
 
     return highest
 
+XML_LOCK = threading.Lock()
+
+
+def parse_xml(data):
+    # returns the root element and the namespace declarations so prefixes can be kept on output
+    namespaces = []
+    context = ET.iterparse(BytesIO(data), events=('start-ns',))
+    for event, item in context:
+        namespaces.append(item)
+    return context.root, namespaces
+
+
+def xml_bytes(root, namespaces):
+    # ElementTree only keeps prefixes that are registered (globally), otherwise it writes ns0, ns1..
+    with XML_LOCK:
+        for prefix, uri in namespaces:
+            try:
+                ET.register_namespace(prefix, uri)
+            except ValueError:
+                pass
+        if PY2:
+            return b'<?xml version="1.0" encoding="utf-8"?>' + ET.tostring(root, encoding='utf-8')
+        # serializing to text then encoding once is much faster than encoding every write
+        return (u'<?xml version="1.0" encoding="utf-8"?>' + ET.tostring(root, encoding='unicode')).encode('utf8')
+
+
+class BlockCookies(http_cookiejar.DefaultCookiePolicy):
+    # api sessions hand cookies back to the addon session instead of keeping them
+    def set_ok(self, cookie, request):
+        return False
+
+
 class RequestHandler(BaseHTTPRequestHandler):
+    # persistent connections. every response is framed with content-length or chunked encoding
+    protocol_version = 'HTTP/1.1'
+
     def __init__(self, request, client_address, server):
         try:
             BaseHTTPRequestHandler.__init__(self, request, client_address, server)
@@ -138,13 +184,51 @@ class RequestHandler(BaseHTTPRequestHandler):
         return
 
     def handle(self):
+        # one request per call. between requests, keep-alive connections go back to the server's idle watcher
+        self.close_connection = True
         try:
-            BaseHTTPRequestHandler.handle(self)
+            self.handle_one_request()
         except Exception as e:
             log.error("PROXY ERROR: {}".format(e))
+            self.close_connection = True
             self.send_response(204) # stop retries
+            self.send_header('Connection', 'close')
             self.end_headers()
 
+    def handle_next(self):
+        try:
+            self.handle()
+        except (IOError, OSError) as e:
+            self.close_connection = True
+        self.finish()
+
+    def finish(self):
+        if self.close_connection:
+            BaseHTTPRequestHandler.finish(self)
+            return
+
+        # kept alive. the worker hands it to the server once it's done with it
+        try:
+            self.wfile.flush()
+        except (IOError, OSError):
+            self.close_connection = True
+            BaseHTTPRequestHandler.finish(self)
+
+    def has_buffered(self):
+        # request data already read from the socket, eg. pipelined requests. select wont see it
+        rbuf = getattr(self.rfile, '_rbuf', None)
+        if rbuf is not None:
+            # python 2 socket._fileobject
+            return rbuf.tell() > 0
+
+        self.request.settimeout(0)
+        try:
+            return bool(self.rfile.peek(1))
+        except (IOError, OSError):
+            return False
+        finally:
+            self.request.settimeout(5)
+
     def setup(self):
         BaseHTTPRequestHandler.setup(self)
         self.request.settimeout(5)
@@ -166,9 +250,18 @@ class RequestHandler(BaseHTTPRequestHandler):
             if key not in REMOVE_IN_HEADERS:
                 self._headers[key] = value
 
+        self._api = False
+        self._timeout = self._headers.pop('session_timeout', None)
         session_addonid = self._headers.pop('session_addonid', None)
         if session_addonid:
             session_type = self._headers.pop('session_type', DEFAULT_SESSION_NAME)
+            if session_type == PROXY_API_SESSION:
+                # api requests from addons. kept per addon so their connections stay alive between plugin invocations
+                self._api = True
+                session_type = '{}.{}'.format(session_type, session_addonid)
+                if self.headers.get('accept-encoding'):
+                    self._headers['accept-encoding'] = self.headers.get('accept-encoding')
+
             self._session = PROXY_GLOBAL['sessions'].get(session_type) or {}
             if session_addonid != self._session.get('addon_id'):
                 self._session = {
@@ -524,22 +617,26 @@ class RequestHandler(BaseHTTPRequestHandler):
         data = fix_default_kids(data)
 
         try:
-            root = parseString(data.encode('utf8'))
+            root, namespaces = parse_xml(data.encode('utf8'))
         except Exception as e:
             raise ProxyException('Failed to parse dash: {}'.format(data))
 
         if ADDON_DEV:
-            pretty = root.toprettyxml(encoding='utf-8')
+            pretty = parseString(xml_bytes(root, namespaces)).toprettyxml(encoding='utf-8')
             pretty = b"\n".join([ll.rstrip() for ll in pretty.splitlines() if ll.strip()])
             with open(xbmc.translatePath('special://temp/in.mpd'), 'wb') as f:
                 f.write(pretty)
 
-        mpd = root.getElementsByTagName("MPD")[0]
-        mpd_attribs = list(mpd.attributes.keys())
+        # elements are matched by their tag in the MPD namespace so iter() filters them in C
+        mpd = root
+        ns = mpd.tag[:mpd.tag.index('}')+1] if mpd.tag.startswith('{') else ''
+        def tag(name):
+            return ns + name
+
         # ## Fix mpd overalseconds bug issue: https://github.com/xbmc/inputstream.adaptive/issues/731 / https://github.com/xbmc/inputstream.adaptive/pull/881
-        if KODI_VERSION < 21 and mpd.getAttribute('type') == 'dynamic' and 'timeShiftBufferDepth' not in mpd_attribs and 'mediaPresentationDuration' not in mpd_attribs:
-            buffer_seconds = (arrow.now() - arrow.get(mpd.getAttribute('availabilityStartTime'))).total_seconds()
-            mpd.setAttribute('mediaPresentationDuration', 'PT{}S'.format(buffer_seconds))
+        if KODI_VERSION < 21 and mpd.get('type') == 'dynamic' and 'timeShiftBufferDepth' not in mpd.attrib and 'mediaPresentationDuration' not in mpd.attrib:
+            buffer_seconds = (arrow.now() - arrow.get(mpd.get('availabilityStartTime'))).total_seconds()
+            mpd.set('mediaPresentationDuration', 'PT{}S'.format(buffer_seconds))
             log.debug('Dash Fix: {}S mediaPresentationDuration added'.format(buffer_seconds))
 
         ## SORT ADAPTION SETS BY BITRATE ##
@@ -573,31 +670,33 @@ class RequestHandler(BaseHTTPRequestHandler):
         max_channels = self._session.get('max_channels') or 0
 
         all_streams = {}
-        for period_index, period in enumerate(root.getElementsByTagName('Period')):
+        for period_index, period in enumerate(mpd.iter(tag('Period'))):
             all_streams[period_index] = []
-            for adap_set in period.getElementsByTagName('AdaptationSet'):
-                adap_parent = adap_set.parentNode
+            adap_sets = period.findall(tag('AdaptationSet'))
+            if adap_sets:
+                adap_parent = period
 
+            for adap_set in adap_sets:
                 highest_bandwidth = 0
                 is_video = False
                 is_trick = False
 
-                for stream in adap_set.getElementsByTagName("Representation"):
+                for stream in adap_set.findall(tag('Representation')):
                     attribs = {}
 
                     ## Make sure Representation are last in adaptionset
-                    adap_set.removeChild(stream)
+                    adap_set.remove(stream)
                     #######
 
-                    for key in list(adap_set.attributes.keys()):
-                        attribs[key] = adap_set.getAttribute(key)
+                    for key in list(adap_set.attrib):
+                        attribs[key] = adap_set.get(key)
                         if remove_framerate and key == 'frameRate':
-                            adap_set.removeAttribute(key)
+                            del adap_set.attrib[key]
 
-                    for key in list(stream.attributes.keys()):
-                        attribs[key] = stream.getAttribute(key)
+                    for key in list(stream.attrib):
+                        attribs[key] = stream.get(key)
                         if remove_framerate and key == 'frameRate':
-                            stream.removeAttribute(key)
+                            del stream.attrib[key]
 
                     bandwidth = 0
                     if 'bandwidth' in attribs:
@@ -612,42 +711,42 @@ class RequestHandler(BaseHTTPRequestHandler):
                         codecs = attribs.get('codecs', '')
                         channels = 0
 
-                        for supplem in stream.getElementsByTagName('AudioChannelConfiguration'):
-                            if 'audio_channel_configuration' in supplem.getAttribute('schemeIdUri'):
+                        for supplem in stream.iter(tag('AudioChannelConfiguration')):
+                            if 'audio_channel_configuration' in supplem.get('schemeIdUri', ''):
                                 try:
-                                    channels = int(supplem.getAttribute('value').replace('F801','6').replace('FE01','8'))
+                                    channels = int(supplem.get('value', '').replace('F801','6').replace('FE01','8'))
                                 except:
                                     channels = 0
 
-                        for supplem in stream.getElementsByTagName('SupplementalProperty'):
-                            if supplem.getAttribute('value') == 'JOC':
+                        for supplem in stream.iter(tag('SupplementalProperty')):
+                            if supplem.get('value') == 'JOC':
                                 is_atmos = True
-                            if 'EC3_ExtensionComplexityIndex' in (supplem.getAttribute('schemeIdUri') or ''):
-                                channels = atmos_channels = int(supplem.getAttribute('value'))
+                            if 'EC3_ExtensionComplexityIndex' in supplem.get('schemeIdUri', ''):
+                                channels = atmos_channels = int(supplem.get('value'))
 
                         if (not atmos_enabled and is_atmos) or (not ac3_enabled and codecs == 'ac-3') or (not ec3_enabled and codecs == 'ec-3') or (max_channels and channels > max_channels):
                             continue
 
                         if is_atmos:
-                            new_set = adap_set.cloneNode(deep=True)
+                            new_set = copy.deepcopy(adap_set)
 
                             if KODI_VERSION < 21:
-                                new_set.setAttribute('name', 'ATMOS')
-                            new_set.setAttribute('id', '{}-atmos'.format(attribs.get('id','')))
-                            new_set.setAttribute('lang', attribs.get('lang',''))
+                                new_set.set('name', 'ATMOS')
+                            new_set.set('id', '{}-atmos'.format(attribs.get('id','')))
+                            new_set.set('lang', attribs.get('lang',''))
 
-                            for elem in new_set.getElementsByTagName("Representation"):
-                                new_set.removeChild(elem)
-                            new_set.appendChild(stream)
+                            for elem in new_set.findall(tag('Representation')):
+                                new_set.remove(elem)
+                            new_set.append(stream)
 
                             if atmos_channels and KODI_VERSION < 21:
-                                for elem in stream.getElementsByTagName("AudioChannelConfiguration"):
-                                    stream.removeChild(elem)
+                                for elem in stream.findall(tag('AudioChannelConfiguration')):
+                                    stream.remove(elem)
 
-                                elem = root.createElement('AudioChannelConfiguration')
-                                elem.setAttribute('schemeIdUri', 'urn:mpeg:dash:23003:3:audio_channel_configuration:2011')
-                                elem.setAttribute('value', str(atmos_channels))
-                                stream.appendChild(elem)
+                                ET.SubElement(stream, tag('AudioChannelConfiguration'), {
+                                    'schemeIdUri': 'urn:mpeg:dash:23003:3:audio_channel_configuration:2011',
+                                    'value': str(atmos_channels),
+                                })
 
                             audio_sets.append([bandwidth, new_set, adap_parent])
                             if adap_set in lang_adap_sets:
@@ -660,9 +759,9 @@ class RequestHandler(BaseHTTPRequestHandler):
 
                     if 'video' in attribs.get('mimeType', '') and not is_trick:
                         is_hdr = False
-                        for supplem in adap_set.getElementsByTagName('SupplementalProperty'):
-                            if supplem.getAttribute('schemeIdUri') == 'http://dashif.org/metadata/hdr' or \
-                                    (supplem.getAttribute('schemeIdUri') == 'urn:mpeg:mpegB:cicp:TransferCharacteristics' and supplem.getAttribute('value') == '16'):
+                        for supplem in adap_set.iter(tag('SupplementalProperty')):
+                            if supplem.get('schemeIdUri') == 'http://dashif.org/metadata/hdr' or \
+                                    (supplem.get('schemeIdUri') == 'urn:mpeg:mpegB:cicp:TransferCharacteristics' and supplem.get('value') == '16'):
                                 is_hdr = True
                                 break
 
@@ -691,7 +790,7 @@ class RequestHandler(BaseHTTPRequestHandler):
                         if 'hdr' in codec_string.lower():
                             codecs.append('hdr')
 
-                        stream_data = {'bandwidth': bandwidth, 'width': int(attribs.get('width','0')), 'height': int(attribs.get('height','0')), 'frame_rate': frame_rate, 'codecs': codecs, 'elem': stream, 'res_ok': True, 'compatible': True}
+                        stream_data = {'bandwidth': bandwidth, 'width': int(attribs.get('width','0')), 'height': int(attribs.get('height','0')), 'frame_rate': frame_rate, 'codecs': codecs, 'elem': stream, 'parent': adap_set, 'res_ok': True, 'compatible': True}
                         if stream_data['bandwidth'] > max_bandwidth*1000000:
                             stream_data['res_ok'] = False
 
@@ -718,17 +817,17 @@ class RequestHandler(BaseHTTPRequestHandler):
                         all_streams[period_index].append(stream_data)
 
                     # add rep to end of adap set
-                    adap_set.appendChild(stream)
+                    adap_set.append(stream)
 
-                adap_parent.removeChild(adap_set)
+                period.remove(adap_set)
 
                 if is_trick:
                     continue
 
                 if is_video:
-                    video_sets.append([highest_bandwidth, adap_set, adap_parent])
+                    video_sets.append([highest_bandwidth, adap_set, period])
                 else:
-                    audio_sets.append([highest_bandwidth, adap_set, adap_parent])
+                    audio_sets.append([highest_bandwidth, adap_set, period])
 
         buckets = {}
         for period_index in all_streams:
@@ -747,66 +846,73 @@ class RequestHandler(BaseHTTPRequestHandler):
         if selected:
             for period_index in all_streams:
                 for stream in sorted(all_streams[period_index], key=lambda x: (x == selected, x['compatible'] == selected['compatible'], x['codec'] == selected['codec'], x['bandwidth'] <= selected['bandwidth'], x['bandwidth']))[:-1]:
-                    stream['elem'].parentNode.removeChild(stream['elem'])
-        elif any(x['compatible'] and x['res_ok'] for x in all_streams[0]):
+                    stream['parent'].remove(stream['elem'])
+        elif any(x['compatible'] and x['res_ok'] for x in all_streams.get(0, [])):
             # skip quality, remove non-ok streams
             for period_index in all_streams:
                 for stream in all_streams[period_index]:
                     if not stream['compatible'] or not stream['res_ok']:
-                        stream['elem'].parentNode.removeChild(stream['elem'])
+                        stream['parent'].remove(stream['elem'])
 
         video_sets.sort(key=lambda  x: x[0], reverse=True)
         audio_sets.sort(key=lambda  x: x[0], reverse=True)
 
         for elem in video_sets:
-            elem[2].appendChild(elem[1])
+            elem[2].append(elem[1])
 
         for elem in audio_sets:
-            elem[2].appendChild(elem[1])
+            elem[2].append(elem[1])
+
+        # single indexed pass for parent lookups from here on. kept up to date as nodes are added / removed
+        parents = {child: parent for parent in mpd.iter() for child in parent}
+        sibling_index = {}
+        def remove(elem):
+            parent = parents.pop(elem, None)
+            if parent is not None:
+                parent.remove(elem)
+                sibling_index.pop(parent, None)
 
         overwrite_subs = self._session.get('subtitles') or []
 
         def is_subs(adap_set):
-            return adap_set.getAttribute('contentType').lower() == 'text' or adap_set.getAttribute('mimeType').lower().startswith('text/')
+            return (adap_set.get('contentType') or '').lower() == 'text' or (adap_set.get('mimeType') or '').lower().startswith('text/')
 
         def is_audio(adap_set):
-            return adap_set.getAttribute('contentType').lower() == 'audio' or adap_set.getAttribute('mimeType').lower().startswith('audio/')
+            return (adap_set.get('contentType') or '').lower() == 'audio' or (adap_set.get('mimeType') or '').lower().startswith('audio/')
 
         ## Insert subtitles
-        if overwrite_subs and adap_parent:
+        if overwrite_subs and adap_parent is not None:
             # remove all built-in subs
-            for adap_set in root.getElementsByTagName('AdaptationSet'):
+            for adap_set in list(mpd.iter(tag('AdaptationSet'))):
                 if is_subs(adap_set):
-                    adap_set.parentNode.removeChild(adap_set)
+                    remove(adap_set)
 
             # add our subs
             for idx, subtitle in enumerate(overwrite_subs):
-                elem = root.createElement('AdaptationSet')
-                elem.setAttribute('contentType', 'text')
-                elem.setAttribute('mimeType', subtitle[0])
-                elem.setAttribute('lang', subtitle[1])
-                elem.setAttribute('id', 'caption_{}'.format(idx))
+                elem = ET.SubElement(adap_parent, tag('AdaptationSet'))
+                elem.set('contentType', 'text')
+                elem.set('mimeType', subtitle[0])
+                elem.set('lang', subtitle[1])
+                elem.set('id', 'caption_{}'.format(idx))
 
                 if subtitle[4] == 'impaired':
-                    elem.setAttribute('impaired', 'true')
+                    elem.set('impaired', 'true')
 
                 if subtitle[3] == 'forced':
-                    elem.setAttribute('forced', 'true')
+                    elem.set('forced', 'true')
 
-                elem2 = root.createElement('Representation')
-                elem2.setAttribute('id', 'caption_rep_{}'.format(idx))
+                elem2 = ET.SubElement(elem, tag('Representation'))
+                elem2.set('id', 'caption_rep_{}'.format(idx))
 
                 if 'ttml' in subtitle[0]:
-                    elem2.setAttribute('codecs', 'ttml')
-
-                elem3 = root.createElement('BaseURL')
-                elem4 = root.createTextNode(subtitle[2])
+                    elem2.set('codecs', 'ttml')
 
-                elem3.appendChild(elem4)
-                elem2.appendChild(elem3)
-                elem.appendChild(elem2)
+                elem3 = ET.SubElement(elem2, tag('BaseURL'))
+                elem3.text = subtitle[2]
 
-                adap_parent.appendChild(elem)
+                parents[elem] = adap_parent
+                parents[elem2] = elem
+                parents[elem3] = elem2
         ##################
 
         ## Fix up languages
@@ -814,70 +920,70 @@ class RequestHandler(BaseHTTPRequestHandler):
         audios = []
         default_languages = []
         default_subtitles = []
-        for adap_set in root.getElementsByTagName('AdaptationSet'):
-            language = adap_set.getAttribute('lang')
+        for adap_set in list(mpd.iter(tag('AdaptationSet'))):
+            language = adap_set.get('lang')
             if not language:
                 continue
 
-            adap_set.setAttribute('lang', fix_language(language))
+            adap_set.set('lang', fix_language(language))
 
             if is_audio(adap_set):
-                if adap_set.getAttribute('default') == 'true':
+                if adap_set.get('default') == 'true':
                     default_languages.append(language)
-                    adap_set.removeAttribute('default')
+                    del adap_set.attrib['default']
 
-                for elem in adap_set.getElementsByTagName('Role'):
-                    if elem.getAttribute('schemeIdUri') == 'urn:mpeg:dash:role:2011' and elem.getAttribute('value') == 'main':
+                for elem in list(adap_set.iter(tag('Role'))):
+                    if elem.get('schemeIdUri') == 'urn:mpeg:dash:role:2011' and elem.get('value') == 'main':
                         default_languages.append(language)
-                        elem.parentNode.removeChild(elem)
+                        remove(elem)
 
                 if lang_allowed(language, [original_language]):
-                    adap_set.setAttribute('original', 'true')
+                    adap_set.set('original', 'true')
 
                 # only remove languages that are not original and not in whitelist or default languages
                 if audio_whitelist and not lang_allowed(language, audio_whitelist + default_languages + user_default_languages + [original_language]):
-                    adap_set.parentNode.removeChild(adap_set)
-                    log.debug('Removed audio adapt set: {}'.format(adap_set.getAttribute('id')))
+                    remove(adap_set)
+                    log.debug('Removed audio adapt set: {}'.format(adap_set.get('id', '')))
                     continue
 
-                is_audio_description = any([elem for elem in adap_set.getElementsByTagName('Accessibility') if elem.getAttribute('schemeIdUri') == 'urn:tva:metadata:cs:AudioPurposeCS:2007'])
-                #any([elem for elem in adap_set.getElementsByTagName('Role') if elem.getAttribute('schemeIdUri') == 'urn:mpeg:dash:role:2011' and elem.getAttribute('value') == 'description'])
+                is_audio_description = any(elem.get('schemeIdUri') == 'urn:tva:metadata:cs:AudioPurposeCS:2007' for elem in adap_set.iter(tag('Accessibility')))
+                #any(elem.get('schemeIdUri') == 'urn:mpeg:dash:role:2011' and elem.get('value') == 'description' for elem in adap_set.iter(tag('Role')))
                 if is_audio_description:
                     if not audio_description:
-                        log.debug('Removed audio description adapt set: {}'.format(adap_set.getAttribute('id')))
-                        adap_set.parentNode.removeChild(adap_set)
+                        log.debug('Removed audio description adapt set: {}'.format(adap_set.get('id', '')))
+                        remove(adap_set)
                         continue
                     else:
-                        adap_set.setAttribute('impaired', 'true')
+                        adap_set.set('impaired', 'true')
 
                 audios.append([language, adap_set])
 
             elif is_subs(adap_set):
-                if adap_set.getAttribute('default') == 'true':
+                if adap_set.get('default') == 'true':
                     default_subtitles.append(language)
-                    adap_set.removeAttribute('default')
+                    del adap_set.attrib['default']
 
-                for elem in adap_set.getElementsByTagName('Role'):
-                    if elem.getAttribute('schemeIdUri') == 'urn:mpeg:dash:role:2011' and elem.getAttribute('value') == 'forced-subtitle':
-                        adap_set.setAttribute('forced', 'true')
+                for elem in list(adap_set.iter(tag('Role'))):
+                    if elem.get('schemeIdUri') == 'urn:mpeg:dash:role:2011' and elem.get('value') == 'forced-subtitle':
+                        adap_set.set('forced', 'true')
 
-                    elif elem.getAttribute('schemeIdUri') == 'urn:mpeg:dash:role:2011' and elem.getAttribute('value') == 'main':
+                    elif elem.get('schemeIdUri') == 'urn:mpeg:dash:role:2011' and elem.get('value') == 'main':
                         default_subtitles.append(language)
-                        elem.parentNode.removeChild(elem)
+                        remove(elem)
 
-                forced = adap_set.getAttribute('forced') == 'true'
+                forced = adap_set.get('forced') == 'true'
                 if (forced and not subs_forced) or (not forced and not subs_non_forced):
-                    adap_set.parentNode.removeChild(adap_set)
-                    log.debug('Removed subs: {}'.format(adap_set.getAttribute('id')))
+                    remove(adap_set)
+                    log.debug('Removed subs: {}'.format(adap_set.get('id', '')))
                     continue
 
                 if lang_allowed(language, [original_language]):
-                    adap_set.setAttribute('original', 'true')
+                    adap_set.set('original', 'true')
 
                 # only remove subs that are not in whitelist or default subs
                 if subs_whitelist and not lang_allowed(language, subs_whitelist + default_subtitles + user_default_subtitles):
-                    adap_set.parentNode.removeChild(adap_set)
-                    log.debug('Removed subtitle adapt set: {}'.format(adap_set.getAttribute('id')))
+                    remove(adap_set)
+                    log.debug('Removed subtitle adapt set: {}'.format(adap_set.get('id', '')))
                     continue
 
                 subs.append([language, adap_set])
@@ -905,7 +1011,7 @@ class RequestHandler(BaseHTTPRequestHandler):
 
                 for row in rows:
                     if lang_allowed(row[0], [lang]):
-                        row[1].setAttribute('default', 'true')
+                        row[1].set('default', 'true')
                         found = True
 
                 if found:
@@ -916,75 +1022,83 @@ class RequestHandler(BaseHTTPRequestHandler):
         ################
 
         ## Convert BaseURLS
-        base_url_parents = []
-        for elem in root.getElementsByTagName('BaseURL'):
-            url = elem.firstChild.nodeValue
+        base_url_parents = set()
+        for elem in list(mpd.iter(tag('BaseURL'))):
+            url = elem.text or ''
 
-            if elem.parentNode in base_url_parents:
+            if parents[elem] in base_url_parents:
                 log.debug('Non-1st BaseURL removed: {}'.format(url))
-                elem.parentNode.removeChild(elem)
+                remove(elem)
                 continue
 
             if url.startswith('/'):
                 url = urljoin(response.url, url)
 
             if '://' in url:
-                elem.firstChild.nodeValue = self.proxy_path + url
+                elem.text = self.proxy_path + url
 
-            base_url_parents.append(elem.parentNode)
+            base_url_parents.add(parents[elem])
         ################
 
         # wipe out manifest so not passed again
         self._session['manifest'] = None
 
         ## Convert Location
-        for elem in root.getElementsByTagName('Location'):
-            url = elem.firstChild.nodeValue
+        for elem in mpd.iter(tag('Location')):
+            url = elem.text or ''
             if '://' not in url:
                 url = urljoin(response.url, url)
 
-            elem.firstChild.nodeValue = self.proxy_path + url
+            elem.text = self.proxy_path + url
             # update our manifest url to the location url
             self._session['manifest'] = url
         ################
 
         ## Convert to proxy paths
-        elems = root.getElementsByTagName('SegmentTemplate')
-        elems.extend(root.getElementsByTagName('SegmentURL'))
+        elems = list(mpd.iter(tag('SegmentTemplate')))
+        elems.extend(mpd.iter(tag('SegmentURL')))
 
+        # children by tag per parent (sibling_index). avoids rescanning thousands of SegmentURL siblings for every SegmentURL
         def get_parent_node(node, tag_name, levels=99):
-            if not node.parentNode or levels == 0:
+            parent = parents.get(node)
+            if parent is None or levels == 0:
                 return None
 
-            siblings = [x for x in node.parentNode.childNodes if x != node and x.nodeType == x.ELEMENT_NODE and x.tagName == tag_name]
-            if siblings:
-                return siblings[0]
-            else:
-                return get_parent_node(node.parentNode, tag_name, levels-1)
+            children = sibling_index.get(parent)
+            if children is None:
+                children = sibling_index[parent] = {}
+                for child in parent:
+                    children.setdefault(child.tag, []).append(child)
+
+            for sibling in children.get(tag(tag_name), []):
+                if sibling is not node:
+                    return sibling
+
+            return get_parent_node(parent, tag_name, levels-1)
 
         for e in elems:
             def process_attrib(attrib):
-                if attrib not in e.attributes.keys():
+                if attrib not in e.attrib:
                     return
 
-                url = e.getAttribute(attrib)
+                url = e.get(attrib)
                 if '://' in url:
-                    e.setAttribute(attrib, self.proxy_path + url)
+                    e.set(attrib, self.proxy_path + url)
                 else:
                     ## Fixed with https://github.com/xbmc/inputstream.adaptive/pull/606
                     base_url = get_parent_node(e, 'BaseURL')
-                    if base_url and not base_url.firstChild.nodeValue.endswith('/'):
-                        base_url.firstChild.nodeValue = base_url.firstChild.nodeValue + '/'
+                    if base_url is not None and not (base_url.text or '').endswith('/'):
+                        base_url.text = (base_url.text or '') + '/'
                         log.debug('Dash Fix: base_url / fixed')
 
                     # Fixed with https://github.com/xbmc/inputstream.adaptive/pull/668
                     parent_template = get_parent_node(e, 'SegmentTemplate', levels=2)
-                    if parent_template:
-                        for key in parent_template.attributes.keys():
-                            if key not in e.attributes.keys():
-                                e.setAttribute(key, parent_template.getAttribute(key))
+                    if parent_template is not None:
+                        for key in parent_template.attrib:
+                            if key not in e.attrib:
+                                e.set(key, parent_template.get(key))
 
-                        parent_template.parentNode.removeChild(parent_template)
+                        remove(parent_template)
                         log.debug('Dash Fix: Double SegmentTemplate removed')
 
             process_attrib('initialization')
@@ -992,68 +1106,180 @@ class RequestHandler(BaseHTTPRequestHandler):
 
             ## Remove presentationTimeOffset PR: https://github.com/xbmc/inputstream.adaptive/pull/564/
             # Removing below in Kodi 21 breaks some live streams
-            if KODI_VERSION < 21 and 'presentationTimeOffset' in e.attributes.keys():
-                e.removeAttribute('presentationTimeOffset')
+            if KODI_VERSION < 21 and 'presentationTimeOffset' in e.attrib:
+                del e.attrib['presentationTimeOffset']
                 log.debug('Dash Fix: presentationTimeOffset removed')
         ###############
 
         ## Remove empty adaption sets
-        for adap_set in root.getElementsByTagName('AdaptationSet'):
-            if not adap_set.getElementsByTagName('Representation'):
-                adap_set.parentNode.removeChild(adap_set)
+        for adap_set in list(mpd.iter(tag('AdaptationSet'))):
+            if next(adap_set.iter(tag('Representation')), None) is None:
+                remove(adap_set)
         #################
 
         log.debug("Parse Dash: {}s".format(time.time() - start - self._session.get('selected_quality_time', 0)))
 
+        mpd = xml_bytes(root, namespaces)
         if ADDON_DEV:
-            mpd = root.toprettyxml(encoding='utf-8')
+            mpd = parseString(mpd).toprettyxml(encoding='utf-8')
             mpd = b"\n".join([ll.rstrip() for ll in mpd.splitlines() if ll.strip()])
             with open(xbmc.translatePath('special://temp/out.mpd'), 'wb') as f:
                 f.write(mpd)
-        else:
-            mpd = root.toxml(encoding='utf-8')
 
         response.stream.content = mpd
 
     def _parse_m3u8_sub(self, m3u8, url):
-        lines = []
-        segments = []
+        # Remove sample-aes apple streaming
+        # See https://github.com/xbmc/inputstream.adaptive/issues/1007
+        remove_sample_aes = 'urn:uuid:edef8ba9-79d6-4ace-a3c8-27dcd51d21ed' in m3u8
+
+        # live playlists repeat most of the previous window with a few segments appended.
+        # rewritten segments are cached per url so a refresh only rewrites the header and new segments
+        cache = self._session.setdefault('m3u8_cache', {})
+        context = [url, self.proxy_path, remove_sample_aes]
+        previous = cache.pop(url, None)
+
+        if '#EXT-X-ENDLIST' in m3u8:
+            # complete playlists never change so there is nothing to cache
+            return '\n'.join([line for line in self._rewrite_m3u8_lines(m3u8, url, remove_sample_aes)[1] if line])
+
+        match = MEDIA_SEQUENCE_PATTERN.search(m3u8)
+        sequence = int(match.group(1)) if match else 0
+
+        kept = []
+        if previous and previous['context'] == context:
+            dropped = sequence - previous['sequence']
+            if 0 <= dropped < len(previous['segments']):
+                kept = previous['segments'][dropped:]
+                raw = ''.join(segment[0] for segment in kept)
+                index = m3u8.find(raw)
+                if index >= 0:
+                    head, tail = m3u8[:index], m3u8[index+len(raw):]
+                else:
+                    kept = []
+
+        if kept:
+            head_lines, head_segments, head_after = self._rewrite_m3u8_sub(head, url, remove_sample_aes)
+            if head_segments:
+                kept = []
+            else:
+                tail_lines, tail_segments, tail_after = self._rewrite_m3u8_sub(tail, url, remove_sample_aes, in_segment=True)
+                segments = kept + tail_segments
+                pieces = head_lines + head_after + [segment[1] for segment in segments] + tail_after
+                log.debug('M3U8 Cache: {} segments reused, {} new'.format(len(kept), len(tail_segments)))
 
-        def line_ok(line):
-            # Remove sample-aes apple streaming
-            # See https://github.com/xbmc/inputstream.adaptive/issues/1007
-            if 'com.apple.streamingkeydelivery' in line and 'urn:uuid:edef8ba9-79d6-4ace-a3c8-27dcd51d21ed' in m3u8:
-                return False
+        if not kept:
+            lines, segments, after = self._rewrite_m3u8_sub(m3u8, url, remove_sample_aes)
+            pieces = lines + [segment[1] for segment in segments] + after
 
-            # Remove x-disc lines (BREAKS DISNEY)
-            # if line.startswith('#EXT-X-DISCONTINUITY'):
-            #     return False
+        if len(cache) >= 20:
+            cache.clear()
+        cache[url] = {'context': context, 'sequence': sequence, 'segments': segments}
 
-            return True
+        return '\n'.join(pieces)
 
-        for line in m3u8.splitlines():
-            line = line.strip()
-            if not line:
-                continue
+    def _rewrite_m3u8_lines(self, m3u8, url, remove_sample_aes):
+        # returns the raw lines and their rewritten output. removed lines are output as empty strings
+        raw_lines = m3u8.splitlines(True)
+        lines = [line.strip() for line in raw_lines]
 
-            if line.startswith('#'):
-                if not line_ok(line):
+        if remove_sample_aes:
+            for index, line in enumerate(lines):
+                if line.startswith('#') and 'com.apple.streamingkeydelivery' in line:
                     log.debug('Removed: {}'.format(line))
-                    continue
-            else:
-                # below not needed with IA version >= 20.3.3 (https://github.com/xbmc/inputstream.adaptive/pull/1108)
-                segments.append(line.lower())
-                if '/beacon?' in line.lower() or '/beacon/' in line.lower():
+                    lines[index] = ''
+
+        # Remove x-disc lines (BREAKS DISNEY)
+        # lines = ['' if line.startswith('#EXT-X-DISCONTINUITY') else line for line in lines]
+
+        # below not needed with IA version >= 20.3.3 (https://github.com/xbmc/inputstream.adaptive/pull/1108)
+        lower = m3u8.lower()
+        if '/beacon' in lower:
+            for index, lower_line in enumerate(lower.splitlines()):
+                line = lines[index]
+                if ('/beacon?' in lower_line or '/beacon/' in lower_line) and line and line[0] != '#':
                     parse = urlparse(line)
                     params = dict(parse_qsl(parse.query))
                     for key in params:
                         if key.lower() == 'redirect_path' or key.lower() == 'redirect_url':
-                            line = params[key]
+                            lines[index] = params[key].replace('\r', '').replace('\n', '')
                             log.debug('M3U8 Fix: Beacon removed')
 
-            lines.append(line)
+        # proxy urls in one pass then split back out. rewriting never adds or removes lines
+        lines = self._proxy_m3u8_urls('\n'.join(lines), url).split('\n') if lines else []
+        return raw_lines, lines
+
+    def _rewrite_m3u8_sub(self, m3u8, url, remove_sample_aes, in_segment=False):
+        # returns output lines before the first segment, [raw, output] per segment and output lines after the last segment
+        # a raw segment runs from the end of the previous segment url through to the end of its own url
+        raw_lines, lines = self._rewrite_m3u8_lines(m3u8, url, remove_sample_aes)
+        urls = [index for index, line in enumerate(raw_lines) if line.strip()[:1] not in ('', '#')]
+
+        start = 0
+        if not in_segment:
+            start = len(lines)
+            for index, line in enumerate(raw_lines):
+                line = line.lstrip()
+                if line.startswith('#EXTINF') or (line and line[0] != '#'):
+                    start = index
+                    break
+
+        before = [line for line in lines[:start] if line]
+        segments = []
+        for end in urls:
+            end += 1
+            segments.append([''.join(raw_lines[start:end]), '\n'.join([line for line in lines[start:end] if line])])
+            start = end
+
+        return before, segments, [line for line in lines[start:] if line]
+
+    def _proxy_m3u8_urls(self, m3u8, url):
+        # resolves relative urls and converts to proxy paths in a single pass
+        base_url = urljoin(url, '/')
+        proxy_path = self.proxy_path
+        joined = {}
+
+        def join(value):
+            # segments share a few relative directories, so only resolve each directory once
+            head, sep, rest = value.partition('?')
+            directory, _, name = head.rpartition('/')
+            if name in ('.', '..') or '#' in value:
+                return urljoin(url, value)
+            if directory not in joined:
+                joined[directory] = urljoin(url, directory + '/')
+            return joined[directory] + name + sep + rest
+
+        def proxy(value):
+            if value[:7].lower() == 'http://' or value[:8].lower() == 'https://':
+                return proxy_path + value
+            return value
+
+        def replace(match):
+            line = match.group('line')
+            if line is None:
+                return M3U8_ATTRIB_PATTERN.sub(replace_attrib, match.group('quoted'))
+
+            if line[0] == '/':
+                return proxy(base_url + line[1:])
+            elif line[0] == '.':
+                return proxy(join(line))
+            else:
+                return proxy_path + line
+
+        def replace_attrib(match):
+            attrib, value = match.group('attrib'), match.group('value')
+            if value.startswith('../'):
+                if not attrib or not match.group('end'):
+                    return match.group(0)
+                return '{}"{}"'.format(attrib, proxy(join(value)))
+            elif value.startswith('/'):
+                if not attrib:
+                    return match.group(0)
+                return 'URI="{}{}'.format(proxy(base_url + value[1:]), match.group('end'))
+            else:
+                return '{}"{}{}{}'.format(attrib or '', proxy_path, value, match.group('end'))
 
-        return '\n'.join(lines)
+        return M3U8_URL_PATTERN.sub(replace, m3u8)
 
     def _parse_m3u8_master(self, m3u8, manifest_url):
         def _remove_quotes(string):
@@ -1327,23 +1553,11 @@ class RequestHandler(BaseHTTPRequestHandler):
 
         if is_master:
             m3u8 = self._parse_m3u8_master(m3u8, response.url)
+            m3u8 = self._proxy_m3u8_urls(m3u8, response.url)
         else:
+            # also proxies urls, incrementally for live playlists
             m3u8 = self._parse_m3u8_sub(m3u8, response.url)
 
-        base_url = urljoin(response.url, '/')
-
-        def relative_replace(match):
-            return match.group(0).replace(match.group(1), urljoin(response.url, match.group(1)))
-
-        m3u8 = re.sub(r'^/', r'{}'.format(base_url), m3u8, flags=re.I|re.M)
-        m3u8 = re.sub(r'^(\.\./.*)$', relative_replace, m3u8, flags=re.I|re.M)
-        m3u8 = re.sub(r'URI="(\.\./.*)"', relative_replace, m3u8, flags=re.I|re.M)
-        m3u8 = re.sub(r'URI="/', r'URI="{}'.format(base_url), m3u8, flags=re.I|re.M)
-
-        ## Convert to proxy paths
-        m3u8 = re.sub(r'^(https?)://', r'{}\1://'.format(self.proxy_path), m3u8, flags=re.I|re.M)
-        m3u8 = re.sub(r'"(https?)://', r'"{}\1://'.format(self.proxy_path), m3u8, flags=re.I|re.M)
-
         m3u8 = m3u8.encode('utf8')
         response.stream.content = m3u8
 
@@ -1394,17 +1608,34 @@ class RequestHandler(BaseHTTPRequestHandler):
             self._session['session'].set_proxy(self._session.get('proxy_server'))
             self._session['session'].set_cert(self._session.get('cert'))
             self._session['session'].cookies.update(self._session.pop('cookies', {}))
+            if self._api:
+                self._session['session'].cookies.set_policy(BlockCookies())
         else:
             self._session['session'].headers.clear()
             #self._session['session'].cookies.clear() #lets handle cookies in session
 
         log.debug('REQUEST OUT: {} ({})'.format(url, method.upper()))
         start = time.time()
+        kwargs = {}
+        if self._api and self._timeout:
+            # use the addons own timeout instead of the service one
+            timeout = [float(x) if x != 'None' else None for x in self._timeout.split(',')]
+            kwargs['timeout'] = tuple(timeout) if len(timeout) > 1 else timeout[0]
+
         try:
-            response = self._session['session'].request(method=method, url=url, headers=self._headers, data=self._post_data, allow_redirects=False, stream=True)
+            response = self._session['session'].request(method=method, url=url, headers=self._headers, data=self._post_data, allow_redirects=False, stream=True, **kwargs)
         except Exception as e:
             log.exception(e)
-            raise ProxyException(e)
+            if not self._api:
+                raise ProxyException(e)
+
+            # the addon raises the matching requests exception or retries direct
+            response = Response()
+            response.status_code = 502
+            response.headers = {PROXY_ERROR_HEADER: type(e).__name__}
+            response.stream = ResponseStream(response)
+            response.stream.content = str(e).encode('utf8')
+            return response
 
         log.debug('REQUEST TIME: {}'.format(time.time() - start))
         log.debug('RESPONSE IN: {} ({})'.format(url, response.status_code))
@@ -1422,13 +1653,18 @@ class RequestHandler(BaseHTTPRequestHandler):
 
             self._session['redirecting'] = True
             self._update_urls(url, response.headers['location'])
-            response.headers['location'] = self.proxy_path + response.headers['location']
+            if not self._api:
+                response.headers['location'] = self.proxy_path + response.headers['location']
             response.stream.content = b''
 
         if 'set-cookie' in response.headers:
             log.debug('set-cookie: {}'.format(response.headers['set-cookie']))
-            ## we handle cookies in the cookiejar
-            response.headers.pop('set-cookie')
+            if self._api:
+                # each cookie needs its own header
+                response.headers['set-cookie'] = response.raw.headers.getlist('set-cookie')
+            else:
+                ## we handle cookies in the cookiejar
+                response.headers.pop('set-cookie')
 
         if response.ok and not self._session['redirecting']:
             self._middleware(url, response)
@@ -1439,29 +1675,72 @@ class RequestHandler(BaseHTTPRequestHandler):
         self.send_response(response.status_code)
 
         for d in list(response.headers.items()):
-            self.send_header(d[0], d[1])
+            for value in (d[1] if isinstance(d[1], list) else [d[1]]):
+                self.send_header(d[0], value)
 
         self.end_headers()
 
     def _output_response(self, response):
         log.debug('RESPONSE OUT: {} ({})'.format(self._url, response.status_code))
+
+        has_body = self.command != 'HEAD' and response.status_code not in (204, 304)
+        length = response.headers.get('content-length')
+        chunked = has_body and length is None
+        if chunked:
+            response.headers['transfer-encoding'] = 'chunked'
+
         self._output_headers(response)
+        if not has_body:
+            return
 
         if ADDON_DEV:
             f = open(xbmc.translatePath('special://temp/response.data'), 'wb')
         else:
             f = None
 
+        start = time.time()
+        sent = 0
+        complete = False
         try:
             for chunk in response.stream.iter_content():
                 try:
-                    self.wfile.write(chunk)
+                    if chunked:
+                        self.wfile.write(b''.join(('{:x}\r\n'.format(len(chunk)).encode('utf8'), chunk, b'\r\n')))
+                    else:
+                        self.wfile.write(chunk)
                 except Exception as e:
                     break
+                sent += len(chunk)
                 if f: f.write(chunk)
+            else:
+                if chunked:
+                    try:
+                        self.wfile.write(b'0\r\n\r\n')
+                        complete = True
+                    except Exception as e:
+                        pass
+                else:
+                    complete = str(sent) == length
         finally:
             if f: f.close()
 
+        if not complete:
+            # client or upstream dropped out mid body. connection can't be reused
+            self.close_connection = True
+
+        if sent:
+            self._update_stats(sent, time.time() - start)
+
+    def _update_stats(self, sent, took):
+        with STATS_LOCK:
+            stats = self._session.setdefault('stats', {'bytes': 0, 'time': 0})
+            stats['bytes'] += sent
+            stats['time'] += took
+            session_rate = stats['bytes'] * 8 / max(stats['time'], 0.001) / 1000000
+
+        log.debug('RELAYED: {} bytes in {:.3f}s ({:.2f} Mbit/s, session {:.2f} Mbit/s)'.format(
+            sent, took, sent * 8 / max(took, 0.001) / 1000000, session_rate))
+
     def do_HEAD(self):
         url = self._get_url('HEAD')
         if url in (STOP_URL, ERROR_URL):
@@ -1551,18 +1830,27 @@ class ResponseStream(object):
     def iter_content(self):
         if self._bytes is not None:
             yield self._bytes
-        else:
-            while True:
-                try:
-                    # 4096 best for shoutcast streams and quick playback start
-                    chunk = self._response.raw.read(4096)
-                except:
-                    chunk = None
+            return
 
-                if not chunk:
-                    break
+        # small reads are best for shoutcast streams and quick playback start.
+        # raw.read blocks until the full amount arrives, so only bodies with a known
+        # length (media segments) ramp up to large reads to cut per-chunk overhead
+        read_size = PROXY_MIN_READ
+        grow = 'content-length' in self._response.headers
+
+        while True:
+            try:
+                chunk = self._response.raw.read(read_size)
+            except:
+                chunk = None
+
+            if not chunk:
+                break
 
-                yield chunk
+            yield chunk
+
+            if grow and read_size < PROXY_MAX_READ:
+                read_size = min(read_size * 2, PROXY_MAX_READ)
 
 
 def save_session():
@@ -1571,6 +1859,7 @@ def save_session():
     if not session:
         return
 
+    session.pop('m3u8_cache', None)
     requests_session = session.pop('session', None)
     if requests_session:
         session['cookies'] = requests_session.cookies.get_dict()
@@ -1579,8 +1868,160 @@ def save_session():
     log.debug('Session saved')
 
 
-class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
-    daemon_threads = True
+def _socketpair():
+    try:
+        return socket.socketpair()
+    except (AttributeError, OSError):
+        # python 2 on windows
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        client = socket.create_connection(listener.getsockname())
+        server = listener.accept()[0]
+        listener.close()
+        return server, client
+
+
+class ThreadedHTTPServer(HTTPServer):
+    # bounded worker pool instead of a new thread per connection
+    # workers handle a single request. idle keep-alive connections are watched by one thread and
+    # only handed back to a worker once their next request arrives
+    # players, artwork grids and api requests can all connect at once. default listen backlog is 5
+    request_queue_size = 64
+
+    def __init__(self, *args, **kwargs):
+        HTTPServer.__init__(self, *args, **kwargs)
+        self._requests = queue.Queue()
+        self._idle = {}
+        self._idle_lock = threading.Lock()
+        self._wake_r, self._wake_w = _socketpair()
+        self._running = True
+
+        for i in range(PROXY_WORKERS):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+
+        thread = threading.Thread(target=self._watch_idle)
+        thread.daemon = True
+        thread.start()
+
+    def _worker(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                break
+
+            request, client_address, handler = item
+            try:
+                if handler:
+                    handler.handle_next()
+                else:
+                    handler = self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+                if handler:
+                    handler.close_connection = True
+
+            # another worker may own the connection as soon as keep_idle succeeds, so handler isn't used after it
+            if not handler or handler.close_connection:
+                self.shutdown_request(request)
+            elif not self.keep_idle(handler):
+                self._close_idle(handler)
+
+    def finish_request(self, request, client_address):
+        return self.RequestHandlerClass(request, client_address, self)
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address, None))
+
+    def keep_idle(self, handler):
+        # False if the server is stopping and the connection should be closed instead
+        if not self._running:
+            return False
+
+        if handler.has_buffered():
+            self._requests.put((handler.request, handler.client_address, handler))
+            return True
+
+        oldest = None
+        with self._idle_lock:
+            if len(self._idle) >= PROXY_MAX_IDLE:
+                # make room by dropping the connection that has been idle the longest
+                sock = min(self._idle, key=lambda x: self._idle[x][1])
+                oldest = self._idle.pop(sock)[0]
+            self._idle[handler.request] = (handler, time.time() + PROXY_IDLE_TIMEOUT)
+
+        if oldest:
+            self._close_idle(oldest)
+
+        self._wake()
+        return True
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b'x')
+        except (IOError, OSError):
+            pass
+
+    def _close_idle(self, handler):
+        handler.close_connection = True
+        try:
+            handler.finish()
+        except Exception:
+            pass
+        self.shutdown_request(handler.request)
+
+    def _watch_idle(self):
+        while self._running:
+            with self._idle_lock:
+                sockets = list(self._idle)
+
+            try:
+                readable = select.select([self._wake_r] + sockets, [], [], 1)[0]
+            except (select.error, IOError, OSError, ValueError):
+                readable = []
+                # a socket went bad. check them one by one
+                for sock in sockets:
+                    try:
+                        select.select([sock], [], [], 0)
+                    except Exception:
+                        readable.append(sock)
+
+            if self._wake_r in readable:
+                readable.remove(self._wake_r)
+                try:
+                    self._wake_r.recv(1024)
+                except (IOError, OSError):
+                    pass
+
+            now = time.time()
+            expired = []
+            with self._idle_lock:
+                for sock in readable:
+                    handler = self._idle.pop(sock, (None, None))[0]
+                    if handler:
+                        # next request (or the client closing) is ready. handle_one_request deals with either
+                        self._requests.put((sock, handler.client_address, handler))
+
+                for sock in list(self._idle):
+                    if self._idle[sock][1] < now:
+                        expired.append(self._idle.pop(sock)[0])
+
+            for handler in expired:
+                self._close_idle(handler)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self._running = False
+        self._wake()
+        for i in range(PROXY_WORKERS):
+            self._requests.put(None)
+
+        with self._idle_lock:
+            idle, self._idle = self._idle, {}
+        for handler, expires in idle.values():
+            self._close_idle(handler)
 
 
 class Proxy(object):
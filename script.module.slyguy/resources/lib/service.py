@@ -1,12 +1,16 @@
+import os
 import sys
 import uuid
 from time import time
 
-from slyguy import monitor, gui, settings, log, check_donor, is_donor, set_drm_level, _
+from kodi_six import xbmc
+
+from slyguy import monitor, gui, settings, log, database, check_donor, is_donor, set_drm_level, _
 from slyguy.keep_alive import call_keep_alives
 from slyguy.session import Session
 from slyguy.util import get_system_arch
-from slyguy.settings.db_storage import db
+from slyguy.constants import DB_PATH
+from slyguy.settings.db_storage import db, Settings
 
 from .proxy import Proxy
 from .player import Player
@@ -32,6 +36,36 @@ def _check_news():
     settings.setDict('_news', news)
 
 
+def _db_maintenance():
+    _time = int(time())
+    if _time < settings.getInt('_last_db_maintenance', 0) + DB_MAINTENANCE_TIME:
+        return
+
+    settings.setInt('_last_db_maintenance', _time)
+
+    # vacuuming is done here instead of on every db close in the addons
+    addon_data = xbmc.translatePath('special://profile/addon_data/')
+    paths = [db.database, DB_PATH]
+    for row in Settings.select(Settings.addon_id).distinct():
+        path = os.path.join(addon_data, row.addon_id, os.path.basename(DB_PATH))
+        if path not in paths:
+            paths.append(path)
+
+    start = time()
+    freed = 0
+    for path in paths:
+        try:
+            stats = database.maintain(path)
+        except Exception as e:
+            log.warning('DB Maintenance failed for {}: {}'.format(path, e))
+            continue
+
+        if stats and stats['vacuumed']:
+            freed += stats['free']
+
+    log.info('DB Maintenance: checked {} dbs, freed {} bytes in {:.3f}s'.format(len(paths), freed, time() - start))
+
+
 def check_arch():
     arch = get_system_arch()[1]
     mac = int(uuid.getnode())
@@ -92,6 +126,7 @@ def _run():
 
                 call_keep_alives()
                 check_repo()
+                _db_maintenance()
             except Exception as e:
                 log.exception(e)
                 log.warning('Service loop failed')
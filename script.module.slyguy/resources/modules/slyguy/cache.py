@@ -1,20 +1,32 @@
+import threading
 from time import time
 from functools import wraps
+from collections import OrderedDict
 
 import peewee
+from six.moves import cPickle
 
-from slyguy import database, settings, signals, gui, router, log, _
-from slyguy.constants import CACHE_TABLENAME, CACHE_EXPIRY, CACHE_CHECKSUM, ROUTE_CLEAR_CACHE
+from slyguy import database, settings, signals, gui, router, userdata, log, _
+from slyguy.constants import CACHE_TABLENAME, CACHE_OLD_TABLENAME, CACHE_EXPIRY, CACHE_CHECKSUM, ROUTE_CLEAR_CACHE
+from slyguy.constants import CACHE_CLEAN_INTERVAL, CACHE_CLEAN_KEY, CACHE_MAX_ROWS, CACHE_ACCESS_RESOLUTION, CACHE_MEM_SIZE
 from slyguy.util import hash_6
 
 funcs = []
 
+# in-process tier in front of the db. key -> [expires, pickled value]
+# values are kept pickled so callers can't mutate each others results
+_mem = OrderedDict()
+_lock = threading.Lock()
+_inflight = {}
+_stats = {}
+
 class Cache(database.Model):
     checksum = CACHE_CHECKSUM
 
     key     = database.HashField(unique=True)
     value   = database.PickleField()
-    expires = peewee.IntegerField()
+    expires = peewee.IntegerField(index=True)
+    accessed = peewee.IntegerField(default=0)
 
     class Meta:
         table_name = CACHE_TABLENAME
@@ -58,53 +70,156 @@ def _build_key(func_name, *args, **kwargs):
 
 def cached(*args, **kwargs):
     def decorator(f, expires=CACHE_EXPIRY, key=None):
+        stats = _stats[f.__name__] = {'mem': 0, 'db': 0, 'miss': 0, 'wait': 0, 'time': 0.0}
+
         @wraps(f)
         def decorated_function(*args, **kwargs):
             _key = key or _build_key(f.__name__, *args, **kwargs)
             if callable(_key):
                 _key = _key(*args, **kwargs)
 
-            if not kwargs.pop('_skip_cache', False):
-                value = get(_key)
+            if kwargs.pop('_skip_cache', False) or not enabled():
+                value = f(*args, **kwargs)
                 if value != None:
-                    log('Cache Hit: {}'.format(_key))
-                    return value
+                    set(_key, value, expires)
+                return value
 
-            value = f(*args, **kwargs)
+            value = _get_mem(_key)
             if value != None:
-                set(_key, value, expires)
+                stats['mem'] += 1
+                return value
+
+            # single-flight. only one thread fetches a key, the others wait for its result
+            with _lock:
+                event = _inflight.get(_key)
+                owner = event is None
+                if owner:
+                    event = _inflight[_key] = threading.Event()
+
+            if not owner:
+                stats['wait'] += 1
+                event.wait()
+                value = _get_mem(_key)
+                if value != None:
+                    stats['mem'] += 1
+                    return value
+                # owner failed or got nothing to cache
+                return f(*args, **kwargs)
 
-            return value
+            start = time()
+            try:
+                value = _get_db(_key)
+                if value != None:
+                    stats['db'] += 1
+                    log('Cache Hit: {}'.format(_key))
+                    return value
+
+                stats['miss'] += 1
+                value = f(*args, **kwargs)
+                if value != None:
+                    set(_key, value, expires)
+                return value
+            finally:
+                stats['time'] += time() - start
+                with _lock:
+                    _inflight.pop(_key, None)
+                event.set()
 
         funcs.append(f.__name__)
         return decorated_function
 
     return lambda f: decorator(f, *args, **kwargs)
 
+def _get_mem(key):
+    with _lock:
+        row = _mem.get(key)
+        if row is None:
+            return None
+
+        if row[0] <= time():
+            _mem.pop(key, None)
+            return None
+
+        _mem.pop(key)
+        _mem[key] = row
+
+    return cPickle.loads(row[1])
+
+def _set_mem(key, value, expires):
+    row = [expires, cPickle.dumps(value, protocol=cPickle.HIGHEST_PROTOCOL)]
+    with _lock:
+        _mem.pop(key, None)
+        _mem[key] = row
+        while len(_mem) > CACHE_MEM_SIZE:
+            _mem.popitem(last=False)
+
 def get(key, default=None):
     if not enabled():
         return default
 
+    value = _get_mem(key)
+    if value == None:
+        value = _get_db(key)
+    return default if value == None else value
+
+def _get_db(key):
+    now = int(time())
     try:
-        return Cache.get(Cache.key == key, Cache.expires > time()).value
+        row = Cache.get(Cache.key == key, Cache.expires > now)
     except Cache.DoesNotExist:
-        return default
+        return None
+
+    # only bump for lru eviction when stale so repeated hits stay read only
+    if row.accessed < now - CACHE_ACCESS_RESOLUTION:
+        Cache.update(accessed=now).where(Cache.id == row.id).execute()
+
+    value = row.value
+    _set_mem(key, value, row.expires)
+    return value
 
 def set(key, value, expires=CACHE_EXPIRY):
-    expires = int(time() + expires)
-    Cache.set(key=key, value=value, expires=expires)
+    now = int(time())
+    _set_mem(key, value, now + expires)
+    Cache.set(key=key, value=value, expires=now + expires, accessed=now)
 
 def delete(key):
+    with _lock:
+        _mem.pop(key, None)
     return Cache.delete_where(Cache.key == key)
 
 def empty():
+    with _lock:
+        _mem.clear()
     deleted = Cache.truncate()
     log('Cache: Deleted {} Rows'.format(deleted))
 
-@signals.on(signals.BEFORE_DISPATCH)
-def remove_expired():
-    deleted = Cache.delete_where(Cache.expires < int(time()))
-    log('Cache: Deleted {} Expired Rows'.format(deleted))
+@signals.on(signals.AFTER_DISPATCH)
+def remove_expired(force=False):
+    # get() already ignores expired rows, so this only needs to run every CACHE_CLEAN_INTERVAL
+    now = int(time())
+    if not force and now < userdata.get(CACHE_CLEAN_KEY, 0) + CACHE_CLEAN_INTERVAL:
+        return
+
+    userdata.set(CACHE_CLEAN_KEY, now)
+    db = Cache._meta.database
+    with db.connection_context():
+        db.execute_sql('DROP TABLE IF EXISTS "{}"'.format(CACHE_OLD_TABLENAME))
+        deleted = Cache.delete_where(Cache.expires < now)
+
+        # lru eviction down to CACHE_MAX_ROWS
+        keep = Cache.select(Cache.id).order_by(Cache.accessed.desc()).limit(CACHE_MAX_ROWS)
+        evicted = Cache.delete_where(Cache.id.not_in(keep))
+
+    log('Cache: Deleted {} Expired Rows. Evicted {} Rows'.format(deleted, evicted))
+
+@signals.on(signals.AFTER_DISPATCH)
+def log_stats():
+    for name in sorted(_stats):
+        stats = _stats[name]
+        fetches = stats['db'] + stats['miss']
+        if fetches or stats['mem']:
+            log.debug('Cache Stats: {name} mem_hits={mem} db_hits={db} misses={miss} waited={wait} avg_fetch={avg:.1f}ms'.format(
+                name=name, avg=stats['time'] / max(fetches, 1) * 1000, **stats))
 
 @router.route(ROUTE_CLEAR_CACHE)
 def clear_cache(key, **kwargs):
@@ -59,6 +59,8 @@ DB_PRAGMAS      = {
     'synchronous': 1
 }
 DB_TABLENAME = '_db'
+DB_VACUUM_MIN_FREE = 1024 * 1024 # bytes
+DB_VACUUM_FREE_RATIO = 0.2
 ###################
 
 ##### USERDATA ####
@@ -66,11 +68,17 @@ USERDATA_KEY = '_userdata'
 ###############
 
 ##### CACHE #####
-CACHE_TABLENAME      = '_cache'
+CACHE_TABLENAME      = '_cache_v2'
+CACHE_OLD_TABLENAME  = '_cache' # no expiry index or accessed column. dropped on first clean
 CACHE_CHECKSUM       = ADDON_VERSION # Recreates cache when new addon version
 CACHE_EXPIRY         = (60*60*24) # 24 Hours
 CACHE_CLEAN_INTERVAL = (60*60*4)  # 4 Hours
 CACHE_CLEAN_KEY      = '_cache_cleaned'
+CACHE_MAX_ROWS       = 1000
+CACHE_ACCESS_RESOLUTION = (60*15) # 15 Minutes. accessed is only rewritten once older than this
+CACHE_MEM_SIZE       = 100 # in-process entries in front of the db
+MEM_CACHE_MAX_ENTRIES = 500
+MEM_CACHE_MAX_SIZE   = 1024*1024*20 # 20MB of pickled values
 #################
 
 IPTV_MERGE_ID        = 'plugin.program.iptv.merge'
@@ -152,10 +160,21 @@ REMOVE_OUT_HEADERS = ['date', 'server', 'transfer-encoding', 'keep-alive', 'conn
 ERROR_URL = 'error.m3u8'
 STOP_URL = 'stop.m3u8'
 EMPTY_TS = 'empty.ts' if KODI_VERSION < 19 else ''
+PROXY_MIN_READ = 4096 # small first reads for shoutcast / live streams and quick playback start
+PROXY_MAX_READ = 256 * 1024
+PROXY_WORKERS = 20 # workers only hold a connection while a request is in progress
+PROXY_IDLE_TIMEOUT = 15 # idle keep-alive connections are watched by a single thread until this
+PROXY_MAX_IDLE = 512 # beyond this, the longest idle connection is closed. stays under select's 1024 fd limit
+PROXY_API_SESSION = 'api'
+PROXY_ERROR_HEADER = 'x-slyguy-proxy-error'
 #################
 
 CHUNK_SIZE = 64 * 1024
 INVALID_IPS = ['0.0.0.0', '::']
+SMART_URL_CACHE_SIZE = 256 # hosts
+DNS_NEGATIVE_TTL = 30
+DNS_SYSTEM_TTL = 60 # system dns doesn't give us a ttl
+DNS_PREFETCH = 0.2 # refresh hosts still in use during the last 20% of their ttl
 LIVE_HEAD = 25*60*60
 NEWS_MAX_TIME = 432000 #5 Days
 MAX_SEARCH_HISTORY = 10
@@ -8,7 +8,7 @@ from six.moves import cPickle
 from slyguy import signals
 from slyguy.log import log
 from slyguy.util import hash_6, makedirs
-from slyguy.constants import DB_PATH, DB_PRAGMAS, DB_TABLENAME, ADDON_DEV
+from slyguy.constants import DB_PATH, DB_PRAGMAS, DB_TABLENAME, ADDON_DEV, DB_VACUUM_MIN_FREE, DB_VACUUM_FREE_RATIO
 
 
 if ADDON_DEV and not int(os.environ.get('QUIET', 0)):
@@ -80,6 +80,29 @@ class Model(peewee.Model):
 
         return super(Model, cls).bulk_create(*args, **kwargs)
 
+    @classmethod
+    def insert_rows(cls, rows, fields=None):
+        # fast path for large inserts. skips building model instances and query nodes
+        # rows are dicts of python values keyed by field name
+        fields = fields or cls._meta.sorted_fields
+        sql = 'INSERT INTO "{}" ({}) VALUES ({})'.format(
+            cls._meta.table_name,
+            ', '.join('"{}"'.format(field.column_name) for field in fields),
+            ', '.join('?' * len(fields)),
+        )
+        values = (tuple(field.db_value(cls._row_value(field, row)) for field in fields) for row in rows)
+        return cls._meta.database.cursor().executemany(sql, values)
+
+    @staticmethod
+    def _row_value(field, row):
+        # missing keys get the field default like a normal insert would
+        if field.name in row:
+            return row[field.name]
+        elif callable(field.default):
+            return field.default()
+        else:
+            return field.default
+
     @classmethod
     def bulk_update(cls, *args, **kwargs):
         if not kwargs.get('batch_size'):
@@ -142,6 +165,36 @@ def delete(db=None):
         os.remove(db.database)
 
 
+def maintain(db_path=DB_PATH):
+    """VACUUMs the db once its free pages pass DB_VACUUM_MIN_FREE and DB_VACUUM_FREE_RATIO
+
+    Can block other connections for a while, so should only be called from the service
+    """
+    db = get_db(db_path)
+    temp = db is None
+    if temp:
+        if not os.path.exists(db_path):
+            return None
+        db = peewee.SqliteDatabase(db_path, pragmas=DB_PRAGMAS, timeout=10)
+
+    try:
+        page_size, pages, free = [db.execute_sql('PRAGMA {}'.format(x)).fetchone()[0] for x in ('page_size', 'page_count', 'freelist_count')]
+        stats = {'path': db_path, 'size': pages * page_size, 'free': free * page_size, 'vacuumed': False, 'time': 0}
+        if stats['free'] < DB_VACUUM_MIN_FREE or free < pages * DB_VACUUM_FREE_RATIO:
+            return stats
+
+        start = time.time()
+        db.execute_sql('VACUUM')
+        stats['vacuumed'] = True
+        stats['time'] = time.time() - start
+
+        log.info("DB Maintenance: {path} vacuumed {free} of {size} bytes free in {time:.3f}s".format(**stats))
+        return stats
+    finally:
+        if temp:
+            db.close()
+
+
 DBS = {}
 def get_db(db_path=DB_PATH):
     return DBS.get(db_path)
@@ -165,7 +218,6 @@ class Database(peewee.SqliteDatabase):
             return
 
         log.debug("Closing db: {}".format(self.database))
-        self.execute_sql('VACUUM')
         super(Database, self).close(*args, **kwargs)
 
     def connect(self, *args, **kwargs):
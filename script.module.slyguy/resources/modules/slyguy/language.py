@@ -317,6 +317,7 @@ class BaseLanguage(object):
     VALID_TO                    = 32228
     EXTRAS                      = 32229
     REMOVE_FRAMERATE            = 32230
+    SERVICE_SESSIONS            = 32231
 
     def __init__(self):
         self._addon_map = {}    
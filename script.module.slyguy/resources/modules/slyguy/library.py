@@ -0,0 +1,61 @@
+import json
+from collections import defaultdict
+
+from kodi_six import xbmc
+
+from slyguy.log import log
+
+
+class LibraryMonitor(xbmc.Monitor):
+    """Batches kodi library notifications for addons that keep their own index of the library
+
+    types maps a notification item type (movie, tvshow, ...) to the key passed to update.
+    update(key, ids) is called with the ids added / changed / removed since the last process()
+    and refresh() after a library scan or clean (and once on start)
+    """
+    def __init__(self, types, update, refresh, libraries=('VideoLibrary',)):
+        xbmc.Monitor.__init__(self)
+        self._types = types
+        self._update = update
+        self._refresh = refresh
+        self._item_methods = ['{}.{}'.format(x, y) for x in libraries for y in ('OnUpdate', 'OnRemove')]
+        self._rescan_methods = ['{}.{}'.format(x, y) for x in libraries for y in ('OnScanFinished', 'OnCleanFinished')]
+        self.pending = defaultdict(set)
+        self.rescan = True
+
+    def onNotification(self, sender, method, data):
+        if method in self._item_methods:
+            try:
+                data = json.loads(data)
+            except ValueError:
+                return
+
+            # OnUpdate nests the item, OnRemove doesn't
+            item = data.get('item', data)
+            key = self._types.get(item.get('type'))
+            if key and 'id' in item:
+                self.pending[key].add(item['id'])
+
+        elif method in self._rescan_methods:
+            self.rescan = True
+
+    def process(self):
+        pending, self.pending = self.pending, defaultdict(set)
+        for key in pending:
+            self._update(key, pending[key])
+
+        if self.rescan:
+            self.rescan = False
+            self._refresh()
+
+    def run(self, interval=5, enabled=None, error_msg='Library index update failed'):
+        """Processes pending changes every interval seconds until kodi exits. Skipped while enabled() returns False"""
+        while not self.waitForAbort(interval):
+            if enabled and not enabled():
+                continue
+
+            try:
+                self.process()
+            except Exception as e:
+                log.exception(e)
+                log.warning(error_msg)
@@ -1,76 +1,149 @@
+import sys
 from time import time
+from threading import RLock
 from functools import wraps
 from copy import deepcopy
+from collections import OrderedDict
 
 from six.moves import cPickle
 
 from slyguy import signals, router
 from slyguy.log import log
 from slyguy.util import hash_6, set_kodi_string, get_kodi_string
-from slyguy.constants import ADDON_ID, CACHE_EXPIRY, ROUTE_CLEAR_CACHE, ADDON_VERSION, KODI_VERSION
+from slyguy.constants import ADDON_ID, CACHE_EXPIRY, ROUTE_CLEAR_CACHE, ADDON_VERSION, KODI_VERSION, MEM_CACHE_MAX_ENTRIES, MEM_CACHE_MAX_SIZE
 
 
 cache_key = 'cache.'+ADDON_ID+ADDON_VERSION
 class Cache(object):
     data = None
+    size = 0
 cache = Cache()
+# guards cache.data and cache.size. gui worker threads use the cache concurrently
+_lock = RLock()
 
+# how a row's value is stored. row = [value, expires, mode, size]
+PICKLED = 0 # pickled bytes. loaded into a fresh copy on get
+SHARED = 1 # the object itself. returned as is, so callers must not mutate it. not size counted
+COPIED = 2 # for values that can't be pickled. deepcopied on get
 
-def _get_cache():
-    if cache.data is None:
-        cache.data = {}
-
-        if KODI_VERSION < 18:
-            data = get_kodi_string(cache_key)
-            if data:
-                set_kodi_string(cache_key, "")
-                try:
-                    cache.data = cPickle.loads(data.encode('latin1')) or {}
-                except Exception as e:
-                    log.debug('Memcache: load failed: {}'.format(e))
-                else:
-                    log.debug("Memcache: loaded from kodi string")
+# defined before set() below shadows the builtin
+CONTAINER_TYPES = (list, tuple, set, frozenset)
 
-    return cache.data
 
-
-def set(key, value, expires=CACHE_EXPIRY):
+def _get_cache():
+    with _lock:
+        if cache.data is None:
+            cache.data = OrderedDict()
+            cache.size = 0
+
+            if KODI_VERSION < 18:
+                data = get_kodi_string(cache_key)
+                if data:
+                    set_kodi_string(cache_key, "")
+                    try:
+                        cache.data = cPickle.loads(data.encode('latin1')) or OrderedDict()
+                        cache.size = sum(row[3] for row in cache.data.values())
+                    except Exception as e:
+                        cache.data = OrderedDict()
+                        log.debug('Memcache: load failed: {}'.format(e))
+                    else:
+                        log.debug("Memcache: loaded from kodi string")
+
+        return cache.data
+
+
+def _pop(key):
+    with _lock:
+        row = _get_cache().pop(key, None)
+        if row is not None:
+            cache.size -= row[3]
+        return row
+
+
+def _sizeof(value, seen=None):
+    # rough size of values that can't be pickled
+    seen = seen if seen is not None else {}
+    if id(value) in seen:
+        return 0
+    seen[id(value)] = True
+
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_sizeof(k, seen) + _sizeof(v, seen) for k, v in value.items())
+    elif isinstance(value, CONTAINER_TYPES):
+        size += sum(_sizeof(x, seen) for x in value)
+    return size
+
+
+def set(key, value, expires=CACHE_EXPIRY, shared=False):
+    """shared=True stores and returns the value itself instead of a copy.
+    Only use it for values the caller will never mutate. They don't count towards MEM_CACHE_MAX_SIZE"""
     if expires == 0:
         return
 
     elif expires != None:
         expires = int(time() + expires)
 
+    if shared:
+        # sizing would mean walking or pickling the value. MEM_CACHE_MAX_ENTRIES still bounds them
+        row = [value, expires, SHARED, 0]
+    else:
+        try:
+            pickled = cPickle.dumps(value, protocol=cPickle.HIGHEST_PROTOCOL)
+        except Exception:
+            row = [deepcopy(value), expires, COPIED, _sizeof(value)]
+        else:
+            row = [pickled, expires, PICKLED, len(pickled)]
+
     log('Cache Set: {}'.format(key))
-    _get_cache()[key] = [deepcopy(value), expires]
+    with _lock:
+        data = _get_cache()
+        _pop(key)
+        data[key] = row
+        cache.size += row[3]
+
+        # evict least recently used
+        while data and (len(data) > MEM_CACHE_MAX_ENTRIES or cache.size > MEM_CACHE_MAX_SIZE):
+            evicted = data.popitem(last=False)[1]
+            cache.size -= evicted[3]
 
 
 def get(key, default=None):
-    cache = _get_cache()
-    try:
-        row = cache[key]
-    except KeyError:
-        return default
-
-    if row[1] != None and row[1] < time():
-        cache.pop(key, None)
-        return default
+    with _lock:
+        # pop and re-insert to mark as recently used
+        row = _pop(key)
+        if row is None:
+            return default
+
+        if row[1] != None and row[1] < time():
+            return default
+
+        _get_cache()[key] = row
+        cache.size += row[3]
+
+    log('Cache Hit: {}'.format(key))
+    # loads / copies are done outside the lock
+    if row[2] == PICKLED:
+        return cPickle.loads(row[0])
+    elif row[2] == SHARED:
+        return row[0]
     else:
-        log('Cache Hit: {}'.format(key))
         return deepcopy(row[0])
 
 
 def delete(key):
-    if int(_get_cache().pop(key, None) != None):
+    if _pop(key) is not None:
         log('Cache Delete: {}'.format(key))
         return True
     return False
 
 
 def empty():
-    cache = _get_cache()
-    deleted = len(cache)
-    cache.clear()
+    with _lock:
+        data = _get_cache()
+        deleted = len(data)
+        data.clear()
+        cache.size = 0
     log('Memcache: Deleted {} Rows'.format(deleted))
 
 
@@ -108,7 +181,7 @@ def _build_key(func_name, *args, **kwargs):
 
 
 def cached(*args, **kwargs):
-    def decorator(f, expires=CACHE_EXPIRY, key=None):
+    def decorator(f, expires=CACHE_EXPIRY, key=None, shared=False):
         @wraps(f)
         def decorated_function(*args, **kwargs):
             _key = key or kwargs.pop('_cache_key', None) or _build_key(f.__name__, *args, **kwargs)
@@ -123,7 +196,7 @@ def cached(*args, **kwargs):
 
             value = f(*args, **kwargs)
             if value != None:
-                set(_key, value, expires)
+                set(_key, value, expires, shared=shared)
 
             return value
 
@@ -135,8 +208,11 @@ def cached(*args, **kwargs):
 @signals.on(signals.ON_EXIT)
 def remove_expired():
     if KODI_VERSION < 18:
-        log('Memcache: persisting via kodi string')
-        set_kodi_string(cache_key, cPickle.dumps(cache.data or {}, protocol=0).decode('latin1'))
+        # only pickled rows. shared / copied values can be large or unpicklable
+        with _lock:
+            data = OrderedDict((key, row) for key, row in (cache.data or {}).items() if row[2] == PICKLED)
+        log('Memcache: persisting {} rows via kodi string'.format(len(data)))
+        set_kodi_string(cache_key, cPickle.dumps(data, protocol=0).decode('latin1'))
 
 
 @router.route(ROUTE_CLEAR_CACHE)
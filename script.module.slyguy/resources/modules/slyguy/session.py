@@ -7,8 +7,10 @@ import time
 import os
 import functools
 import random
+import threading
 from gzip import GzipFile
 from ssl import OPENSSL_VERSION
+from collections import OrderedDict
 
 import requests
 import urllib3
@@ -17,11 +19,12 @@ from six.moves.urllib_parse import urlparse
 from kodi_six import xbmc
 import dns.resolver
 
-from slyguy import userdata, settings, signals, mem_cache, log, _
-from slyguy.util import get_kodi_proxy, remove_duplicates
+from slyguy import userdata, settings, signals, log, _
+from slyguy.util import get_kodi_proxy, remove_duplicates, get_kodi_string, set_kodi_string, hash_6
 from slyguy.smart_urls import get_dns_rewrites
 from slyguy.exceptions import SessionError, Error
-from slyguy.constants import DEFAULT_USERAGENT, CHUNK_SIZE, KODI_VERSION, DEPENDENCIES_ADDON_ID, INVALID_IPS
+from slyguy.constants import DEFAULT_USERAGENT, CHUNK_SIZE, KODI_VERSION, DEPENDENCIES_ADDON_ID, INVALID_IPS, SMART_URL_CACHE_SIZE, DNS_NEGATIVE_TTL, DNS_SYSTEM_TTL, DNS_PREFETCH
+from slyguy.constants import ADDON_ID, COMMON_ADDON_ID, PROXY_API_SESSION, PROXY_ERROR_HEADER
 from slyguy.settings import IPMode
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -62,60 +65,134 @@ def close_sessions():
         session.close()
 
 
-class DOHResolver(object):
+DNS_KEY = 'slyguy.dns.{}'
+DNS_ANSWERS = {}
+DNS_REFRESHING = set()
+DNS_LOCK = threading.Lock()
+DOH_SESSIONS = {}
+# getaddrinfo errors equivalent to NXDOMAIN / NoAnswer. not every platform defines them all
+DNS_NEGATIVE_GAI_ERRORS = set(getattr(socket, name) for name in ('EAI_NONAME', 'EAI_NODATA', 'EAI_ADDRFAMILY') if hasattr(socket, name))
+
+
+class CachedResolver(object):
+    """Caches answers for their ttl in this process and in a kodi window property
+    so they are shared between addons and plugin invocations.
+    Empty answers are cached for DNS_NEGATIVE_TTL and hosts still in use are refreshed in the background before they expire
+    Subclasses define _lookup(host, family, interface_ip=None) which returns (ips, ttl)
+    """
+    nameservers = []
+
+    def resolve(self, host, family, interface_ip=None):
+        key = DNS_KEY.format(hash_6([self.nameservers, host, family, interface_ip], length=12))
+
+        row = DNS_ANSWERS.get(key)
+        if row is None:
+            try:
+                row = json.loads(get_kodi_string(key)) or None
+            except:
+                row = None
+
+        now = time.time()
+        if row is None or row[1] < now:
+            return self._store(key, host, family, interface_ip)
+
+        DNS_ANSWERS[key] = row
+        if row[1] - now < row[2] * DNS_PREFETCH:
+            with DNS_LOCK:
+                refresh = key not in DNS_REFRESHING
+                DNS_REFRESHING.add(key)
+
+            if refresh:
+                thread = threading.Thread(target=self._refresh, args=(key, host, family, interface_ip))
+                thread.daemon = True
+                thread.start()
+
+        return row[0]
+
+    def _refresh(self, key, host, family, interface_ip):
+        try:
+            self._store(key, host, family, interface_ip)
+        finally:
+            with DNS_LOCK:
+                DNS_REFRESHING.discard(key)
+
+    def _store(self, key, host, family, interface_ip):
+        try:
+            ips, ttl = self._lookup(host, family, interface_ip=interface_ip)
+        except Exception as e:
+            # failures (timeouts etc) are not cached
+            log.debug('DNS lookup failed: {}'.format(e))
+            return []
+
+        ttl = max(int(ttl), 1) if ips else DNS_NEGATIVE_TTL
+        row = [ips, time.time() + ttl, ttl]
+        DNS_ANSWERS[key] = row
+        set_kodi_string(key, json.dumps(row))
+        return ips
+
+
+class DOHResolver(CachedResolver):
     def __init__(self, nameservers=None):
         self.nameservers = nameservers or []
 
-    def resolve(self, host, family, interface_ip=None):
+    def _lookup(self, host, family, interface_ip=None):
         ip_type = 'AAAA' if family == socket.AF_INET6 else 'A'
+        error = None
+
         for server in self.nameservers:
-            key = (server, host, ip_type)
-            ips = mem_cache.get(key, None)
+            headers = {'accept': 'application/dns-json'}
+            params = {'name': host, 'type': ip_type}
 
-            if ips is None:
-                headers = {'accept': 'application/dns-json'}
-                params = {'name': host, 'type': ip_type}
+            # keep the doh connection alive between lookups
+            session_key = (ip_type, interface_ip)
+            session = DOH_SESSIONS.get(session_key)
+            if session is None:
+                session = DOH_SESSIONS[session_key] = RawSession(ip_mode=IPMode.ONLY_IPV6 if ip_type == 'AAAA' else IPMode.ONLY_IPV4, interface_ip=interface_ip, auto_close=False)
 
-                log.debug("DOH Request: {} for {} type {}".format(server, host, ip_type))
-                try:
-                    session = RawSession(ip_mode=IPMode.ONLY_IPV6 if ip_type == 'AAAA' else IPMode.ONLY_IPV4, interface_ip=interface_ip)
-                    data = super(RawSession, session).request('get', server, params=params, headers=headers).json()
-                except Exception as e:
-                    log.debug("DOH request failed: {}".format(e))
-                    continue
+            log.debug("DOH Request: {} for {} type {}".format(server, host, ip_type))
+            try:
+                data = super(RawSession, session).request('get', server, params=params, headers=headers).json()
+            except Exception as e:
+                log.debug("DOH request failed: {}".format(e))
+                error = e
+                continue
 
-                ip_type = 28 if ip_type == 'AAAA' else 1
-                suitable = [x for x in data['Answer'] if x['type'] == ip_type]
-                ttl = min([x['TTL'] for x in suitable])
-                ips = [x['data'] for x in suitable]
-                mem_cache.set(key, ips, expires=ttl)
+            rr_type = 28 if ip_type == 'AAAA' else 1
+            suitable = [x for x in data.get('Answer', []) if x['type'] == rr_type]
+            if suitable:
+                return [x['data'] for x in suitable], min([x['TTL'] for x in suitable])
 
-            if ips:
-                return ips
+        if error:
+            raise error
 
-        return []
+        return [], DNS_NEGATIVE_TTL
 
 
-class SocketResolver(object):
+class SocketResolver(CachedResolver):
     def __init__(self):
         self.nameservers = ['system dns']
 
-    def resolve(self, host, family, interface_ip=None):
+    def _lookup(self, host, family, interface_ip=None):
         if interface_ip:
             log.warning("DNS leak! DNS request sent using default interface and not specified '{}'. Specify a DNS server in smart urls to fix".format(interface_ip))
 
         try:
-            return [x[4][0] for x in socket.getaddrinfo(host, None, family)]
-        except:
-            return []
+            return [x[4][0] for x in socket.getaddrinfo(host, None, family)], DNS_SYSTEM_TTL
+        except socket.gaierror as e:
+            # only cache "no such host / no address" answers. transient errors (EAI_AGAIN, EAI_FAIL etc) are raised and not cached
+            if e.args and e.args[0] in DNS_NEGATIVE_GAI_ERRORS:
+                return [], DNS_NEGATIVE_TTL
+            raise
 
 
-class DNSResolver(dns.resolver.Resolver):
-    def resolve(self, host, family, interface_ip=None):
+class DNSResolver(CachedResolver, dns.resolver.Resolver):
+    def _lookup(self, host, family, interface_ip=None):
         try:
-            return [x.to_text() for x in self.query(host, rdtype='AAAA' if family == socket.AF_INET6 else 'A', source=interface_ip)]
-        except:
-            return []
+            answer = self.query(host, rdtype='AAAA' if family == socket.AF_INET6 else 'A', source=interface_ip)
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            return [], DNS_NEGATIVE_TTL
+
+        return [x.to_text() for x in answer], answer.rrset.ttl
 
 
 class SessionAdapter(requests.adapters.HTTPAdapter):
@@ -263,6 +340,58 @@ class SessionAdapter(requests.adapters.HTTPAdapter):
         return addresses
 
 
+class ServiceAdapter(SessionAdapter):
+    # sends requests through the slyguy service so its keep-alive connections
+    # and tls sessions are reused between plugin invocations
+    def send(self, request, **kwargs):
+        proxy_path = settings.get('_proxy_path')
+        if not proxy_path or request.method not in ('GET', 'HEAD', 'POST') or kwargs.get('cert') or kwargs.get('proxies') \
+                or kwargs.get('verify') != settings.getBool('verify_ssl', True) or (request.body is not None and 'Content-Length' not in request.headers):
+            return super(ServiceAdapter, self).send(request, **kwargs)
+
+        proxied = request.copy()
+        proxied.url = proxy_path + request.url
+        proxied.headers['session_type'] = PROXY_API_SESSION
+        proxied.headers['session_addonid'] = ADDON_ID
+        timeout = kwargs.get('timeout')
+        if isinstance(timeout, (int, float)):
+            proxied.headers['session_timeout'] = str(timeout)
+        elif isinstance(timeout, tuple):
+            proxied.headers['session_timeout'] = ','.join(str(x) for x in timeout)
+
+        try:
+            response = super(ServiceAdapter, self).send(proxied, **kwargs)
+        except requests.exceptions.ConnectionError as e:
+            # only safe to resend if the service was never reached
+            reason = getattr(e.args[0], 'reason', None) if e.args else None
+            if not isinstance(reason, urllib3.exceptions.ConnectTimeoutError) and (request.method == 'POST' or isinstance(e, requests.exceptions.Timeout)):
+                raise
+            log.debug('Service request failed. Retrying direct')
+            return super(ServiceAdapter, self).send(request, **kwargs)
+
+        error = response.headers.get(PROXY_ERROR_HEADER)
+        if error:
+            message = response.content.decode('utf8', 'replace')
+            response.close()
+
+            # raise the upstream error instead of waiting on it again or sending a post twice
+            exception = getattr(requests.exceptions, error, None)
+            if not isinstance(exception, type) or not issubclass(exception, requests.exceptions.RequestException):
+                exception = requests.exceptions.RequestException
+            if request.method == 'POST' or issubclass(exception, requests.exceptions.Timeout):
+                raise exception(message, request=request)
+
+            log.debug('Service upstream request failed. Retrying direct')
+            return super(ServiceAdapter, self).send(request, **kwargs)
+
+        # make the response look like it came direct so cookies and redirects are handled against the real url
+        response.url = request.url
+        response.request = request
+        response.cookies = requests.cookies.RequestsCookieJar()
+        requests.cookies.extract_cookies_to_jar(response.cookies, request, response.raw)
+        return response
+
+
 class RawSession(requests.Session):
     def __init__(self, verify=None, timeout=None, auto_close=True, ssl_ciphers=SSL_CIPHERS, ssl_options=SSL_OPTIONS, proxy=None, ip_mode=None, interface_ip=None):
         if DEPENDENCIES_ADDON_ID.lower() not in str(urllib3).lower():
@@ -272,7 +401,9 @@ class RawSession(requests.Session):
         self._verify = verify
         self._timeout = timeout
         self._rewrites = []
-        self._session_cache = {}
+        self._session_cache = OrderedDict()
+        self._cache_hits = 0
+        self._cache_misses = 0
         self._proxy = proxy
         self._ip_mode = ip_mode
         self._interface_ip = interface_ip
@@ -300,8 +431,11 @@ class RawSession(requests.Session):
         self._adapter.session_data = session_data
 
     def set_dns_rewrites(self, rewrites):
+        self._session_cache.clear()
         for entries in rewrites:
             pattern = entries[-1]
+            # patterns with a path are matched against the full url, others only against scheme://host
+            is_path = '/' in pattern.split('://', 1)[-1]
             pattern = re.escape(pattern).replace(r'\*', '.*')
             pattern = re.compile(pattern, flags=re.IGNORECASE)
 
@@ -328,9 +462,19 @@ class RawSession(requests.Session):
                     _type = 'dns'
                 else:
                     _type = 'url_sub'
+
+                if _type == 'resolver' and entry:
+                    if entry.lower().startswith('http'):
+                        resolver = DOHResolver()
+                    else:
+                        resolver = DNSResolver(configure=False)
+                        resolver.cache = DNS_CACHE
+                    resolver.nameservers = [entry,]
+                    entry = resolver
+
                 new_entries.append([_type, entry])
 
-            self._rewrites.append([pattern, sorted(new_entries, key=lambda x: x[0] == 'dns')])
+            self._rewrites.append([pattern, sorted(new_entries, key=lambda x: x[0] == 'dns'), is_path])
 
     def set_cert(self, cert):
         self._cert = cert
@@ -356,6 +500,7 @@ class RawSession(requests.Session):
 
     def set_proxy(self, proxy):
         self._proxy = proxy
+        self._session_cache.clear()
 
     def _get_proxy(self):
         if not self._proxy or self._proxy.lower().strip() == 'kodi':
@@ -363,6 +508,8 @@ class RawSession(requests.Session):
         return self._proxy
 
     def close(self):
+        if self._cache_misses:
+            log.debug('Smart URL Cache: {} hits, {} misses, {} hosts'.format(self._cache_hits, self._cache_misses, len(self._session_cache)))
         super(RawSession, self).close()
         if self in OPEN_SESSIONS:
             OPEN_SESSIONS.remove(self)
@@ -370,33 +517,57 @@ class RawSession(requests.Session):
     def __del__(self):
         self.close()
 
-    def request(self, method, url, **kwargs):
-        req = requests.Request(method, url, params=kwargs.pop('params', None))
-        url = req.prepare().url
+    def _get_session_data(self, url):
+        # the rewrite decision is cached per scheme://host in a bounded lru (oldest first)
+        # so long running sessions (eg. the proxy) don't grow with every segment url
+        parsed = urlparse(url)
+        origin = '{}://{}'.format(parsed.scheme, parsed.netloc).lower()
+
+        cached = self._session_cache.pop(origin, None)
+        if cached is None:
+            self._cache_misses += 1
+            index = len(self._rewrites)
+            for i, row in enumerate(self._rewrites):
+                if not row[2] and row[0].search(origin):
+                    index = i
+                    break
+            cached = [index, {}]
+        else:
+            self._cache_hits += 1
 
-        session_data = {
-            'ip_mode': self._ip_mode,
-            'interface_ip': self._interface_ip,
-            'ssl_ciphers': self._ssl_ciphers,
-            'ssl_options': self._ssl_options,
-            'proxy': None,
-            'rewrite': None,
-            'resolver': None,
-            'url': url,
-        }
+        self._session_cache[origin] = cached
+        if len(self._session_cache) > SMART_URL_CACHE_SIZE:
+            self._session_cache.popitem(last=False)
 
-        if url in self._session_cache:
-            session_data = self._session_cache[url]
-        elif self._rewrites:
-            for row in self._rewrites:
-                if not row[0].search(url):
-                    continue
+        # rules with a path depend on the full url so are checked every request
+        index = cached[0]
+        for i, row in enumerate(self._rewrites[:index]):
+            if row[2] and row[0].search(url):
+                index = i
+                break
+
+        session_data = cached[1].get(index)
+        if session_data is None:
+            session_data = {
+                'ip_mode': self._ip_mode,
+                'interface_ip': self._interface_ip,
+                'ssl_ciphers': self._ssl_ciphers,
+                'ssl_options': self._ssl_options,
+                'proxy': None,
+                'rewrite': None,
+                'resolver': None,
+                'url': url,
+                'url_sub': None,
+            }
 
+            if index < len(self._rewrites):
+                row = self._rewrites[index]
                 for entry in row[1]:
                     if entry[0] == 'skip':
                         continue
                     if entry[0] == 'url_sub':
-                        session_data['url'] = re.sub(row[0], entry[1], url, count=1)
+                        session_data['url_sub'] = entry[1]
+                        session_data['url'] = row[0].sub(entry[1], url, count=1)
                     elif entry[0] == 'proxy':
                         session_data['proxy'] = entry[1]
                     elif entry[0] == 'interface_ip':
@@ -404,24 +575,30 @@ class RawSession(requests.Session):
                     elif entry[0] == 'dns':
                         session_data['rewrite'] = [urlparse(session_data['url']).netloc.lower(), entry[1]]
                     elif entry[0] == 'resolver' and entry[1]:
-                        if entry[1].lower().startswith('http'):
-                            resolver = DOHResolver()
-                        else:
-                            resolver = DNSResolver(configure=False)
-                            resolver.cache = DNS_CACHE
-
-                        resolver.nameservers = [entry[1],]
-                        session_data['resolver'] = [urlparse(session_data['url']).netloc.lower(), resolver]
-                break
+                        session_data['resolver'] = [urlparse(session_data['url']).netloc.lower(), entry[1]]
+
+            if session_data['proxy'] is None:
+                session_data['proxy'] = self._get_proxy()
+
+            cached[1][index] = session_data
+
+        session_data = dict(session_data)
+        if session_data['url_sub'] is None:
+            session_data['url'] = url
+        else:
+            session_data['url'] = self._rewrites[index][0].sub(session_data['url_sub'], url, count=1)
+
+        return session_data
+
+    def request(self, method, url, **kwargs):
+        req = requests.Request(method, url, params=kwargs.pop('params', None))
+        url = req.prepare().url
 
-            self._session_cache[url] = session_data
+        session_data = self._get_session_data(url)
 
         if session_data['url'] != url:
             log.debug("URL Changed: {}".format(session_data['url']))
 
-        if session_data['proxy'] is None:
-            session_data['proxy'] = self._get_proxy()
-
         if session_data['proxy']:
             # remove username, password from proxy for logging
             parsed = urlparse(session_data['proxy'])
@@ -473,6 +650,12 @@ class Session(RawSession):
         self.set_dns_rewrites(get_dns_rewrites() if dns_rewrites is None else dns_rewrites)
         self.set_proxy(settings.get('proxy_server') or settings.get('proxy_server'))
 
+        # the service builds its sessions from the addons settings, so only default sessions can be sent through it
+        if ADDON_ID != COMMON_ADDON_ID and dns_rewrites is None and not kwargs and settings.SERVICE_SESSIONS.value and settings.PROXY_ENABLED.value:
+            self._adapter = ServiceAdapter()
+            for prefix in ('http://', 'https://'):
+                self.mount(prefix, self._adapter)
+
         self.headers.update(DEFAULT_HEADERS)
         self.headers.update(self._headers)
 
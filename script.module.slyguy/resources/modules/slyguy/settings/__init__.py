@@ -295,6 +295,7 @@ class CommonSettings(BaseSettings):
     IP_MODE = Enum('ip_mode', options=[[_.PREFER_IPV4, IPMode.PREFER_IPV4], [_.PREFER_IPV6, IPMode.PREFER_IPV6], [_.ONLY_IPV4, IPMode.ONLY_IPV4], [_.ONLY_IPV6, IPMode.ONLY_IPV6]],
                     default=IPMode.PREFER_IPV4, owner=COMMON_ADDON_ID, category=Categories.NETWORK, enable=is_donor, disabled_reason=_.SUPPORTER_ONLY)
     PROXY_SERVER = Text('proxy_server', owner=COMMON_ADDON_ID, enable=is_donor, disabled_reason=_.SUPPORTER_ONLY, default_label=_.DEFAULT, category=Categories.NETWORK)
+    SERVICE_SESSIONS = Bool('service_sessions', default=False, visible=lambda: settings.PROXY_ENABLED.value, owner=COMMON_ADDON_ID, category=Categories.NETWORK)
 
     # INTERFACE
     BOOKMARKS = Bool('bookmarks', default=True, owner=COMMON_ADDON_ID, category=Categories.INTERFACE)
@@ -330,6 +331,7 @@ class CommonSettings(BaseSettings):
     LAST_SUPPORT_REMINDER = Number('last_support_reminder', visible=False, override=False, owner=COMMON_ADDON_ID)
     LAST_NEWS_CHECK = Number('last_news_check', visible=False, override=False, owner=COMMON_ADDON_ID)
     LAST_NEWS_ID = Text('last_news_id', visible=False, override=False, owner=COMMON_ADDON_ID)
+    LAST_DB_MAINTENANCE = Number('last_db_maintenance', visible=False, override=False, owner=COMMON_ADDON_ID)
     PROXY_PATH = Text('proxy_path', visible=False, override=False, owner=COMMON_ADDON_ID)
     UPDATES = Dict('updates', visible=False, override=False, owner=COMMON_ADDON_ID)
     NEWS = Dict('news', visible=False, override=False, owner=COMMON_ADDON_ID)
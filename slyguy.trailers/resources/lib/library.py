@@ -0,0 +1,112 @@
+from slyguy.log import log
+from slyguy.util import kodi_rpc
+
+from .models import Trailer, Library
+from .settings import settings
+from .youtube import get_youtube_id
+
+
+# mediatype -> (list method, details method, id key, list key, details key)
+MEDIATYPES = {
+    'movie': ('VideoLibrary.GetMovies', 'VideoLibrary.GetMovieDetails', 'movieid', 'movies', 'moviedetails'),
+    'tvshow': ('VideoLibrary.GetTvShows', 'VideoLibrary.GetTvShowDetails', 'tvshowid', 'tvshows', 'tvshowdetails'),
+}
+PROPERTIES = ['title', 'year', 'imdbnumber', 'uniqueid', 'file', 'trailer']
+HAS_TRAILER = {'field': 'hastrailer', 'operator': 'true', 'value': '1'}
+
+
+def enabled():
+    mediatypes = []
+    if settings.REVERSE_LOOKUP_MOVIE.value:
+        mediatypes.append('movie')
+    if settings.REVERSE_LOOKUP_TVSHOW.value:
+        mediatypes.append('tvshow')
+    return mediatypes
+
+
+def _row(mediatype, data):
+    return {
+        'mediatype': mediatype,
+        'dbid': data[MEDIATYPES[mediatype][2]],
+        'trailer': data['trailer'].lower(),
+        'video_id': get_youtube_id(data['trailer']),
+        'details': data,
+    }
+
+
+def _total(mediatype):
+    result = kodi_rpc(MEDIATYPES[mediatype][0], {'filter': HAS_TRAILER, 'limits': {'start': 0, 'end': 1}}, raise_on_error=True)
+    return result.get('limits', {}).get('total', 0)
+
+
+def is_ready(mediatype):
+    return Library.exists_or_false(Library.mediatype == mediatype)
+
+
+def build(mediatype):
+    """Re-indexes all items of mediatype that have a trailer"""
+    method, list_key = MEDIATYPES[mediatype][0], MEDIATYPES[mediatype][3]
+    rows = kodi_rpc(method, {'filter': HAS_TRAILER, 'properties': PROPERTIES}, raise_on_error=True).get(list_key) or []
+
+    with Trailer._meta.database.atomic():
+        Trailer.delete_where(Trailer.mediatype == mediatype)
+        Trailer.insert_rows([_row(mediatype, data) for data in rows if data.get('trailer')])
+        Library.set(mediatype=mediatype, total=len(rows))
+
+    log.info('Trailer index: indexed {} {}s'.format(len(rows), mediatype))
+
+
+def refresh():
+    """Rebuilds any enabled mediatype that isn't indexed yet or any indexed mediatype whose library total has changed"""
+    mediatypes = enabled()
+    for mediatype in MEDIATYPES:
+        row = Library.get_or_none(Library.mediatype == mediatype)
+        if row is None and mediatype not in mediatypes:
+            continue
+
+        if row is None or row.total != _total(mediatype):
+            build(mediatype)
+
+
+def update(mediatype, ids):
+    """Re-indexes just the given ids. Ids no longer in the library or without a trailer are removed"""
+    if not is_ready(mediatype):
+        return
+
+    method, id_key, details_key = MEDIATYPES[mediatype][1], MEDIATYPES[mediatype][2], MEDIATYPES[mediatype][4]
+    ids = list(ids)
+    rows = []
+    for dbid in ids:
+        data = kodi_rpc(method, {id_key: dbid, 'properties': PROPERTIES}).get(details_key)
+        if data and data.get('trailer'):
+            rows.append(_row(mediatype, data))
+
+    with Trailer._meta.database.atomic():
+        Trailer.delete_where(Trailer.mediatype == mediatype, Trailer.dbid.in_(ids))
+        Trailer.insert_rows(rows)
+        Library.set(mediatype=mediatype, total=Trailer.select().where(Trailer.mediatype == mediatype).count())
+
+    log.debug('Trailer index: updated {} {}s'.format(len(ids), mediatype))
+
+
+def lookup(mediatype, trailer):
+    """Returns the library details of mediatype items with trailer
+    Matches the whole trailer url first. Youtube urls then match on the video id, any other url
+    falls back to the library trailer containing it. Builds the index on first use
+    """
+    if not is_ready(mediatype):
+        build(mediatype)
+
+    rows = Trailer.select(Trailer.details).where(Trailer.mediatype == mediatype, Trailer.trailer == trailer.lower())
+    results = [row.details for row in rows]
+    if results:
+        return results
+
+    video_id = get_youtube_id(trailer)
+    if video_id:
+        rows = Trailer.select(Trailer.details).where(Trailer.mediatype == mediatype, Trailer.video_id == video_id)
+    else:
+        # not indexed. only hit for non youtube trailers without an exact match
+        rows = Trailer.select(Trailer.details).where(Trailer.mediatype == mediatype, Trailer.trailer.contains(trailer.lower()))
+
+    return [row.details for row in rows]
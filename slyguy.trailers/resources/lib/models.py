@@ -0,0 +1,22 @@
+import peewee
+
+from slyguy import database
+
+
+class Trailer(database.Model):
+    mediatype = peewee.TextField()
+    dbid = peewee.IntegerField()
+    trailer = peewee.TextField(index=True)
+    video_id = peewee.TextField(null=True, index=True)
+    details = database.JSONField()
+
+    class Meta:
+        primary_key = peewee.CompositeKey('mediatype', 'dbid')
+
+
+class Library(database.Model):
+    mediatype = peewee.TextField(primary_key=True)
+    total = peewee.IntegerField()
+
+
+database.init([Trailer, Library])
@@ -7,7 +7,8 @@ from six.moves.urllib_parse import urlparse
 from slyguy import plugin, gui
 from slyguy.constants import ROUTE_CONTEXT, ROUTE_SETTINGS, KODI_VERSION, ADDON_ID
 from slyguy.log import log
-from slyguy.util import get_addon, kodi_rpc, remove_kodi_formatting
+from slyguy.library import LibraryMonitor
+from slyguy.util import get_addon, remove_kodi_formatting
 
 from .settings import settings
 from .youtube import play_youtube, get_youtube_id
@@ -15,6 +16,7 @@ from .mdblist import API
 from .imdb import play_imdb
 from .language import _
 from .constants import SEARCH_MATCH_RATIO
+from . import library
 
 mdblist_api = API()
 
@@ -208,22 +210,14 @@ def _process_item(item):
 
 def _reverse_lookup_trailer(trailer):
     results = []
-    trailer = trailer.lower()
-
     if not trailer:
         return results
 
-    if settings.REVERSE_LOOKUP_MOVIE.value:
-        rows = kodi_rpc('VideoLibrary.GetMovies', {'filter': {'field': 'hastrailer', 'operator': 'true', 'value': '1'}, 'properties': ['trailer']})['movies']
-        for row in rows:
-            if trailer in row["trailer"].lower():
-                results.append(kodi_rpc('VideoLibrary.GetMovieDetails', {'movieid': row['movieid'], 'properties': ['title', 'year', 'imdbnumber', 'uniqueid', 'file', 'trailer']})['moviedetails'])
-
-    if not results and settings.REVERSE_LOOKUP_TVSHOW.value:
-        rows = kodi_rpc('VideoLibrary.GetTvShows', {'filter': {'field': 'hastrailer', 'operator': 'true', 'value': '1'}, 'properties': ['trailer']})['tvshows']
-        for row in rows:
-            if trailer in row["trailer"].lower():
-                results.append(kodi_rpc('VideoLibrary.GetTvShowDetails', {'tvshowid': row['tvshowid'], 'properties': ['title', 'year', 'imdbnumber', 'uniqueid', 'file', 'trailer']})['tvshowdetails'])
+    # tvshows are only checked if no movie matches
+    for mediatype in library.enabled():
+        results = library.lookup(mediatype, trailer)
+        if results:
+            break
 
     return [_rpc_to_item(result) for result in results]
 
@@ -370,3 +364,10 @@ def test_streams(**kwargs):
     for stream in STREAMS:
         folder.add_item(label=stream[0], is_folder=False, path=stream[1])
     return folder
+
+
+def service():
+    settings.set_trailer_context()
+
+    monitor = LibraryMonitor({x: x for x in library.MEDIATYPES}, library.update, library.refresh)
+    monitor.run(error_msg='Trailer index update failed')
@@ -1,3 +1,3 @@
-from resources.lib import settings
+from resources.lib import plugin
 
-settings.set_trailer_context()
+plugin.service()